@@ -0,0 +1,321 @@
+#!/usr/bin/python
+# LICENSE: GPL2
+
+# Annotates APDU traces: instruction and file names, status words, FCP,
+# proactive commands and other SAT TLVs. Works offline on apdu.log files,
+# decoded in parallel for big logs, and online as a sink of the router
+# trace, see DecoderSink.
+
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import logging
+import multiprocessing
+from optparse import OptionParser
+
+from sim import apdu_replay
+from sim import apdu_trace
+from sim import sim_files
+from sim_soft import sat_types
+from util import hextools
+from util import types
+from util import types_g
+
+# Bytes of the log decoded by one worker.
+CHUNK_SIZE = 16 * 1024 * 1024
+
+INDENT = "  "
+
+# Instructions which respond with FCP.
+FCP_INS = [types_g.iso7816.SELECT_FILE,
+           types_g.iso7816.GET_RESPONSE,
+           types_g.iso7816.STATUS]
+
+def symbols(cls):
+    """Name by value of the constants of a sat_types class."""
+    names = {}
+    for name in sorted(vars(cls).keys(), reverse=True):
+        if not name.startswith("_"):
+            names[getattr(cls, name)] = name
+    return names
+
+berTagNames = symbols(sat_types.ber_tag)
+comprehensionTagNames = symbols(sat_types.comprehension_tag)
+cmdTypeNames = symbols(sat_types.cmd_type)
+
+def symbol(table, value):
+    try:
+        return table[value]
+    except:
+        return "%02X" %value
+
+def parseTlvs(data):
+    """Returns (tag, value) of the TLVs, the rest of the data if truncated."""
+    tlvs = []
+    offset = 0
+    while offset + 2 <= len(data):
+        start = offset
+        tag = data[offset]
+        length = data[offset + 1]
+        offset += 2
+        if length == 0x81 and offset < len(data):
+            length = data[offset]
+            offset += 1
+        elif length == 0x82 and offset + 1 < len(data):
+            length = (data[offset] << 8) + data[offset + 1]
+            offset += 2
+        if offset + length > len(data):
+            offset = start
+            break
+        tlvs.append((tag, data[offset:offset + length]))
+        offset += length
+    return tlvs, data[offset:]
+
+class ApduDecoder(object):
+    def __init__(self, simType=types.TYPE_USIM, simFiles=None):
+        if not simFiles:
+            simFiles = sim_files.SimFiles(simType)
+        self.simFiles = simFiles
+        # Built once, see SimFiles.getFidNames().
+        self.fidNames = simFiles.getFidNames()
+
+    def fidName(self, fid):
+        fid = "%04X" %fid
+        if fid == "7FFF":
+            return "ADF"
+        return self.fidNames.get(fid, fid)
+
+    def fileName(self, apdu):
+        if types.p1(apdu) == types.SELECT_BY_DF_NAME:
+            return hextools.bytes2hex(types.aid(apdu))
+        return self.fidName(types.fileId(apdu))
+
+    def decodeCommand(self, apdu):
+        text = types.insName(apdu)
+        if text == 'SELECT_FILE' and len(apdu) > 6:
+            text += " " + self.fileName(apdu)
+        return text
+
+    def decodeSw(self, rapdu):
+        sw1Name, swName = types.swName(types.sw1(rapdu), types.sw2(rapdu))
+        if types.sw(rapdu) in types_g.sw.n2s:
+            return swName
+        return "%s %02X" %(sw1Name, types.sw2(rapdu))
+
+    def decodeTlvs(self, data, tagName, indent=INDENT):
+        lines = []
+        tlvs, rest = parseTlvs(data)
+        for tag, value in tlvs:
+            lines.append("%s%s: %s" %(indent, tagName(tag), hextools.bytes2hex(value)))
+        if rest:
+            lines.append("%sundecoded: %s" %(indent, hextools.bytes2hex(rest)))
+        return lines
+
+    def decodeFcp(self, data):
+        lines = []
+        fcp, rest = parseTlvs(data)
+        for tag, value in fcp:
+            lines.append("%s: %s" %(symbol(types_g.selectTag, tag), hextools.bytes2hex(value)))
+            if tag != types.FCP_TEMPLATE_TAG:
+                continue
+            tlvs, rest = parseTlvs(value)
+            for tag, value in tlvs:
+                text = "%s%s: %s" %(INDENT, symbol(types_g.selectTag, tag), hextools.bytes2hex(value))
+                if tag == types_g.selectTag.FILE_IDENTIFIER and len(value) == 2:
+                    text += " (%s)" %self.fidName((value[0] << 8) + value[1])
+                lines.append(text)
+                if tag == types_g.selectTag.PROPRIETARY_INF:
+                    lines += self.decodeTlvs(value, lambda tag: symbol(types_g.properietaryTag, tag),
+                                             INDENT * 2)
+                elif tag == types_g.selectTag.PIN_STATUS_TEMPLATE:
+                    lines += self.decodeTlvs(value, lambda tag: symbol(types_g.pinStatusTag, tag),
+                                             INDENT * 2)
+        return [INDENT + line for line in lines]
+
+    def comprehensionTagName(self, tag):
+        return symbol(comprehensionTagNames, tag & ~sat_types.comprehension_tag.COMPREHENSION_REQUIRED)
+
+    def decodeSat(self, data):
+        """Comprehension TLVs, e.g. of a terminal response."""
+        lines = []
+        tlvs, rest = parseTlvs(data)
+        for tag, value in tlvs:
+            text = "%s%s: %s" %(INDENT, self.comprehensionTagName(tag), hextools.bytes2hex(value))
+            if (tag & 0x7F == sat_types.comprehension_tag.COMMAND_DETAILS and
+                    len(value) == sat_types.TLV_COMMAND_DETAILS_LENGTH):
+                text += " (%s)" %symbol(cmdTypeNames, value[1])
+            lines.append(text)
+        if rest:
+            lines.append("%sundecoded: %s" %(INDENT, hextools.bytes2hex(rest)))
+        return lines
+
+    def decodeBerTlv(self, data):
+        """Proactive command or envelope."""
+        lines = []
+        tlvs, rest = parseTlvs(data)
+        for tag, value in tlvs:
+            lines.append("%s%s" %(INDENT, symbol(berTagNames, tag)))
+            lines += [INDENT + line for line in self.decodeSat(value)]
+        return lines
+
+    def decode(self, simId, apdu, rapdu=None):
+        """Returns the annotated lines of a C-APDU and R-APDU pair."""
+        lines = ["C-APDU%d: %s %s" %(simId, hextools.bytes2hex(apdu), self.decodeCommand(apdu))]
+        ins = types.ins(apdu)
+        if ins == types_g.iso7816.ENVELOPE and len(apdu) > 5:
+            lines += self.decodeBerTlv(apdu[5:])
+        elif ins == types_g.iso7816.TERMINAL_RESPONSE and len(apdu) > 5:
+            lines += self.decodeSat(apdu[5:])
+        if rapdu == None:
+            return lines
+        if len(rapdu) < 2:
+            lines.append("R-APDU%d: %s" %(simId, hextools.bytes2hex(rapdu)))
+            return lines
+        lines.append("R-APDU%d: %s %s" %(simId, hextools.bytes2hex(rapdu), self.decodeSw(rapdu)))
+        data = types.responseData(rapdu)
+        if not data:
+            return lines
+        if data[0] == types.FCP_TEMPLATE_TAG and ins in FCP_INS:
+            lines += self.decodeFcp(data)
+        elif ins == types_g.iso7816.FETCH and data[0] == sat_types.ber_tag.PROACTIVE:
+            lines += self.decodeBerTlv(data)
+        return lines
+
+    def decodeRecords(self, records):
+        lines = []
+        for record in records:
+            lines += self.decode(record.simId, record.apdu, record.rapdu)
+        return lines
+
+class DecoderSink(apdu_trace.TextSink):
+    """Logs the decoded APDUs of the router, see ApduTrace.addSink()."""
+    def __init__(self, logger, decoder):
+        apdu_trace.TextSink.__init__(self, logger)
+        self.decoder = decoder
+        # Time and data of the last C-APDU by card.
+        self.apdus = {}
+
+    def write(self, record):
+        if record.kind == apdu_trace.TRACE_C_APDU:
+            self.apdus[record.simId] = (record.time, record.data)
+            return
+        if record.kind != apdu_trace.TRACE_R_APDU or record.data == None:
+            return
+        if record.simId not in self.apdus:
+            return
+        apduTime, apdu = self.apdus.pop(record.simId)
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        for line in self.decoder.decode(record.simId, apdu, record.data):
+            self.log(logging.INFO, line, apduTime)
+
+def parseApduLines(lines, records=None):
+    """
+    Same as apdu_replay.parseApduLog() for the lines of a chunk. Returns
+    False when the last C-APDU still waits for its R-APDU.
+    """
+    if records == None:
+        records = []
+    for line in lines:
+        match = apdu_replay.APDU_LOG_RE.search(line)
+        if not match:
+            continue
+        stars, direction, simId, data = match.groups()
+        if stars:
+            continue
+        if direction == 'C':
+            records.append(apdu_replay.ApduRecord(int(simId), hextools.hex2bytes(data), None))
+        elif records and records[-1].rapdu is None:
+            records[-1].rapdu = hextools.hex2bytes(data)
+        # R-APDUs before the first C-APDU belong to the previous chunk.
+    return records
+
+def readChunk(file, start, end):
+    """
+    C-APDU and R-APDU records of the lines starting within [start, end).
+    The R-APDU of the last C-APDU is read from the next chunk.
+    """
+    records = []
+    with open(file, "rb") as f:
+        if start:
+            # Skip the line started in the previous chunk.
+            f.seek(start - 1)
+            f.readline()
+        lines = []
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            lines.append(line)
+        parseApduLines(lines, records)
+        if records and records[-1].rapdu is None:
+            for line in f:
+                match = apdu_replay.APDU_LOG_RE.search(line)
+                if not match or match.group(1):
+                    continue
+                if match.group(2) == 'R':
+                    records[-1].rapdu = hextools.hex2bytes(match.group(4))
+                break
+    return records
+
+workerDecoder = None
+
+def initWorker(simType):
+    global workerDecoder
+    workerDecoder = ApduDecoder(simType)
+
+def decodeChunk(args):
+    file, start, end = args
+    return workerDecoder.decodeRecords(readChunk(file, start, end))
+
+def getChunks(file, chunkSize=CHUNK_SIZE):
+    size = os.path.getsize(file)
+    return [(file, start, min(start + chunkSize, size)) for start in range(0, size, chunkSize)]
+
+def decodeLog(file, output, simType=types.TYPE_USIM, processes=None, chunkSize=CHUNK_SIZE):
+    """
+    Write the decoded APDUs of apdu.log to the output file object. Chunks
+    of the log are decoded by a pool of processes, in order.
+    """
+    chunks = getChunks(file, chunkSize)
+    if len(chunks) <= 1 or processes == 1:
+        initWorker(simType)
+        for chunk in chunks:
+            output.write("".join([line + "\n" for line in decodeChunk(chunk)]))
+        return
+    pool = multiprocessing.Pool(processes, initWorker, (simType,))
+    try:
+        for lines in pool.imap(decodeChunk, chunks):
+            output.write("".join([line + "\n" for line in lines]))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="%prog [options] apdu.log")
+    parser.add_option("-t", "--type", dest="type", default="usim",
+                      help="Card type: usim or sim")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="Output file, default stdout")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=None,
+                      help="Number of processes, default number of CPUs")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("Expecting apdu.log path")
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+    if options.type == "sim":
+        simType = types.TYPE_SIM
+    else:
+        simType = types.TYPE_USIM
+    if options.output:
+        output = open(options.output, "w")
+    else:
+        output = sys.stdout
+    try:
+        decodeLog(args[0], output, simType, options.jobs)
+    finally:
+        if options.output:
+            output.close()
@@ -0,0 +1,206 @@
+#!/usr/bin/python
+# LICENSE: GPL2
+
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import logging
+import re
+import shutil
+import tempfile
+import time
+from optparse import OptionParser
+
+from sim import sim_router
+from sim import sim_card
+from sim import sim_reader
+from sim_soft import sim_xml
+from util import hextools
+from util import types
+
+# Matches "C-APDU0: 00A40004023F00" and "R-APDU0: 9000" lines in apdu.log.
+# Lines prefixed with '*' are internal retransmissions of the router.
+APDU_LOG_RE = re.compile(r"(\**)([CR])-APDU(\d+): ([0-9A-Fa-f]*)\s*$")
+
+class ApduRecord(object):
+    def __init__(self, simId, apdu, line):
+        self.simId = simId
+        self.apdu = apdu
+        self.rapdu = None
+        self.line = line
+
+def parseApduLog(file):
+    """
+    Parse C-APDU and R-APDU pairs from apdu.log. The first R-APDU logged
+    after a C-APDU is the one sent back to the terminal.
+    """
+    records = []
+    record = None
+    with open(file) as f:
+        for lineNbr, line in enumerate(f, 1):
+            match = APDU_LOG_RE.search(line)
+            if not match:
+                continue
+            stars, direction, simId, data = match.groups()
+            if stars:
+                continue
+            if direction == 'C':
+                record = ApduRecord(int(simId), hextools.hex2bytes(data), lineNbr)
+                records.append(record)
+            elif record and record.rapdu is None:
+                record.rapdu = hextools.hex2bytes(data)
+    return records
+
+class ApduReplay(object):
+    """
+    Feed recorded C-APDUs through SimRouter.tick() in SIMTRACE_OFFLINE mode
+    and compare the R-APDUs with the recorded ones.
+    """
+    def __init__(self, simRouter, records):
+        self.simRouter = simRouter
+        self.records = records
+        self.index = 0
+        self.current = None
+        self.responses = 0
+        self.mismatches = []
+        self.duration = 0
+
+    def receiveCommandApdu(self):
+        self.checkResponseSent()
+        if self.index >= len(self.records):
+            return None, None
+        self.current = self.records[self.index]
+        self.index += 1
+        return sim_router.EVT_C_APDU, self.current.apdu[:]
+
+    def sendResponseApdu(self, rapdu):
+        record = self.current
+        self.current = None
+        if not record:
+            return
+        self.responses += 1
+        if record.rapdu is not None and rapdu != record.rapdu:
+            self.mismatches.append((record, rapdu))
+
+    def checkResponseSent(self):
+        if self.current:
+            # No R-APDU for the previous C-APDU.
+            self.sendResponseApdu(None)
+
+    def run(self, stopOnMismatch=False):
+        self.simRouter.setReplay(self)
+        startTime = time.time()
+        try:
+            while self.simRouter.tick():
+                if stopOnMismatch and self.mismatches:
+                    break
+            self.checkResponseSent()
+        finally:
+            self.duration = time.time() - startTime
+            self.simRouter.setReplay(None)
+        return not self.mismatches
+
+    def getFirstMismatch(self):
+        if not self.mismatches:
+            return None
+        return self.mismatches[0]
+
+    def apdusPerSecond(self):
+        if not self.duration:
+            return 0
+        return self.index / self.duration
+
+    def __str__(self):
+        text = ("Replayed %d of %d C-APDUs in %.3fs (%d APDUs/s), mismatches: %d"
+                %(self.index, len(self.records), self.duration,
+                  self.apdusPerSecond(), len(self.mismatches)))
+        mismatch = self.getFirstMismatch()
+        if mismatch:
+            record, rapdu = mismatch
+            if rapdu is None:
+                rapdu = "none"
+            else:
+                rapdu = hextools.bytes2hex(rapdu)
+            text += ("\nFirst mismatch at line %d\nC-APDU%d: %s\n"
+                     "expected R-APDU: %s\nreceived R-APDU: %s"
+                     %(record.line, record.simId, hextools.bytes2hex(record.apdu),
+                       hextools.bytes2hex(record.rapdu), rapdu))
+        return text
+
+def getSoftCard(simCard):
+    return simCard.simReader.getHandler().getCard(simCard.index)
+
+def copyImage(softCard, dir):
+    file = os.path.join(dir, os.path.basename(softCard.file))
+    if os.path.exists(softCard.file):
+        shutil.copy2(softCard.file, file)
+    else:
+        shutil.copy2(softCard.file + ".bak", file)
+    return file
+
+def createSoftRouter(simType=types.TYPE_USIM, imageDir=None,
+                     savePolicy=sim_xml.SAVE_EXPLICIT):
+    """
+    Create router with a soft card. If imageDir is set, the card works
+    on a copy of its image in that directory.
+    """
+    simCard = sim_card.SimCard(mode=sim_reader.MODE_SIM_SOFT, type=simType)
+    simCard.removeAllReaders()
+    simCard.connect(sim_reader.READER_ID_0)
+    if imageDir:
+        softCard = getSoftCard(simCard)
+        softCard.file = copyImage(softCard, imageDir)
+        softCard.savePolicy = savePolicy
+        softCard.init()
+    simRouter = sim_router.SimRouter(cards=[simCard],
+                                     type=simType,
+                                     mode=sim_router.SIMTRACE_OFFLINE)
+    # Needed to resolve file names for routing, no APDUs are sent.
+    simRouter.simCtrl = simRouter.createSimCtrl()
+    return simRouter
+
+def replayApduLog(file, simType=types.TYPE_USIM, stopOnMismatch=False):
+    records = parseApduLog(file)
+    if os.path.abspath(file) == os.path.abspath(sim_router.APDU_LOG_FILE):
+        # Keep the recording, the router truncates apdu.log.
+        shutil.copy2(file, file + ".replay")
+    # Replay on a copy of the card image, so it can be repeated.
+    dir = tempfile.mkdtemp()
+    simRouter = None
+    loggers = [logging.getLogger("router"), logging.getLogger("sim_soft")]
+    levels = [logger.level for logger in loggers]
+    try:
+        simRouter = createSoftRouter(simType, dir)
+        # Logging every APDU would dominate the replay time.
+        for logger in loggers:
+            logger.setLevel(logging.WARNING)
+        simRouter.trace.update()
+        replay = ApduReplay(simRouter, records)
+        replay.run(stopOnMismatch)
+        getSoftCard(simRouter.getMainCard(0)).flush()
+    finally:
+        if simRouter:
+            simRouter.close()
+        for logger, level in zip(loggers, levels):
+            logger.setLevel(level)
+        shutil.rmtree(dir)
+    return replay
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="%prog [options] apdu.log")
+    parser.add_option("-t", "--type", dest="type", default="usim",
+                      help="Soft card type: usim or sim")
+    parser.add_option("-s", "--stop", dest="stop", action="store_true",
+                      default=False, help="Stop on first mismatch")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("Expecting apdu.log path")
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+    if options.type == "sim":
+        simType = types.TYPE_SIM
+    else:
+        simType = types.TYPE_USIM
+    replay = replayApduLog(args[0], simType, options.stop)
+    print replay
+    if replay.mismatches:
+        sys.exit(1)
@@ -0,0 +1,421 @@
+# LICENSE: GPL2
+
+# APDU trace of the router. The main loop only stores raw APDUs in a
+# preallocated ring, a writer thread formats them and passes them to the
+# sinks: text log (console, apdu.log, test runner), GSMTAP, pcapng and
+# a binary capture file. When the ring is full the main loop writes the
+# pending records itself, records are dropped only if all the sinks are
+# lossy (e.g. GSMTAP over UDP).
+
+import atexit
+import logging
+import os
+import struct
+import threading
+import time
+import weakref
+
+from util import gsmtap
+from util import hextools
+from util import pcapng
+from util import types
+
+TRACE_SIZE = 4096
+# Seconds between writes of the pending records.
+WRITE_INTERVAL = 0.05
+
+TRACE_C_APDU = 0
+TRACE_R_APDU = 1
+# Instruction (and file) name of the C-APDU.
+TRACE_INS = 2
+TRACE_TEXT = 3
+
+CAPTURE_MAGIC = "SIMTRACE"
+# time, kind, simId, length of data
+CAPTURE_RECORD = struct.Struct(">dBBH")
+
+# Traces with a running writer, closed before the interpreter shuts down.
+openTraces = weakref.WeakSet()
+
+def closeTraces():
+    for trace in list(openTraces):
+        trace.close()
+
+atexit.register(closeTraces)
+
+class TraceRecord(object):
+    __slots__ = ("kind", "time", "simId", "data", "prefix", "separator", "level")
+
+class ApduTrace(object):
+    def __init__(self, size=TRACE_SIZE, writeInterval=WRITE_INTERVAL):
+        self.size = size
+        self.writeInterval = writeInterval
+        self.records = [TraceRecord() for i in range(size)]
+        # Number of records stored and written.
+        self.head = 0
+        self.tail = 0
+        self.dropped = 0
+        self.sinks = []
+        # Checked by the router before tracing, see update().
+        self.enabled = False
+        # Records are dropped instead of waiting for the sinks.
+        self.lossy = False
+        self.lock = threading.Lock()
+        self.writeLock = threading.RLock()
+        # Thread passing the records to the sinks.
+        self.writing = None
+        self.wakeup = threading.Event()
+        self.writer = None
+
+    def addSink(self, sink):
+        with self.writeLock:
+            self.sinks.append(sink)
+        self.update()
+        if not self.writer:
+            self.writer = TraceWriterThread(self)
+            self.writer.setDaemon(True)
+            self.writer.start()
+            openTraces.add(self)
+
+    def removeSink(self, sink):
+        with self.writeLock:
+            self.write()
+            self.sinks.remove(sink)
+            sink.close()
+        self.update()
+
+    def update(self):
+        """
+        Check if any sink is enabled, e.g. after the log level has changed.
+        Also done by the writer every write interval.
+        """
+        sinks = [sink for sink in self.sinks if sink.isEnabled()]
+        self.enabled = bool(sinks)
+        self.lossy = bool(sinks) and all([sink.lossy for sink in sinks])
+
+    def grow(self):
+        """Double the size of the ring, called with the lock held."""
+        size = self.size * 2
+        records = [TraceRecord() for i in range(size)]
+        for i in range(self.tail, self.head):
+            records[i % size] = self.records[i % self.size]
+        self.records = records
+        self.size = size
+
+    def record(self, kind, simId, data, prefix="", separator=False, level=logging.INFO):
+        with self.lock:
+            while self.head - self.tail >= self.size:
+                if self.lossy:
+                    self.dropped += 1
+                    return
+                if self.writing == threading.current_thread():
+                    # Traced by a sink, the records can't be written now.
+                    self.grow()
+                    break
+                # Don't wait for the writer thread, write the pending
+                # records in this thread.
+                self.lock.release()
+                try:
+                    self.write()
+                finally:
+                    self.lock.acquire()
+            record = self.records[self.head % self.size]
+            record.kind = kind
+            record.time = time.time()
+            record.simId = simId
+            record.data = data
+            record.prefix = prefix
+            record.separator = separator
+            record.level = level
+            self.head += 1
+            if self.head - self.tail == self.size / 2:
+                self.wakeup.set()
+
+    def cApdu(self, simId, apdu, prefix="", separator=False):
+        # The APDU might be modified for another card, keep a copy.
+        self.record(TRACE_C_APDU, simId, list(apdu), prefix, separator)
+
+    def rApdu(self, simId, rapdu, prefix=""):
+        """R-APDU, None if only the card which responded is logged."""
+        if rapdu != None:
+            rapdu = list(rapdu)
+        self.record(TRACE_R_APDU, simId, rapdu, prefix)
+
+    def ins(self, simId, apdu):
+        self.record(TRACE_INS, simId, list(apdu))
+
+    def text(self, text, level=logging.INFO):
+        self.record(TRACE_TEXT, None, text, level=level)
+
+    def write(self):
+        """Pass the pending records to the sinks."""
+        with self.writeLock:
+            writing = self.writing
+            self.writing = threading.current_thread()
+            try:
+                self.writeRecords()
+            finally:
+                self.writing = writing
+
+    def writeRecords(self):
+        head = self.head
+        while self.tail < head:
+            record = self.records[self.tail % self.size]
+            for sink in self.sinks:
+                try:
+                    sink.write(record)
+                except Exception as e:
+                    logging.error("Trace sink %s failed: %s" %(sink.__class__.__name__, str(e)))
+            record.data = None
+            self.tail += 1
+        if self.dropped:
+            with self.lock:
+                dropped = self.dropped
+                self.dropped = 0
+            # The records were dropped after the ones written.
+            for sink in self.sinks:
+                sink.drop(dropped)
+            logging.warning("APDU trace full, %d records dropped" %dropped)
+        for sink in self.sinks:
+            sink.flush()
+
+    def flush(self):
+        """Write the pending records now, e.g. before logging directly."""
+        if self.tail < self.head:
+            self.write()
+
+    def close(self):
+        if self.writer:
+            self.writer.stop()
+            self.writer = None
+        openTraces.discard(self)
+        with self.writeLock:
+            self.write()
+            for sink in self.sinks:
+                sink.close()
+            self.sinks = []
+        self.update()
+
+class TraceWriterThread(threading.Thread):
+    def __init__(self, trace):
+        threading.Thread.__init__(self)
+        threading.Thread.setName(self, 'TraceWriterThread')
+        self.trace = trace
+        self.stopped = False
+
+    def run(self):
+        while not self.stopped:
+            self.trace.wakeup.wait(self.trace.writeInterval)
+            self.trace.wakeup.clear()
+            self.trace.update()
+            self.trace.write()
+
+    def stop(self):
+        self.stopped = True
+        self.trace.wakeup.set()
+        self.join()
+
+class TextSink(object):
+    """
+    Formats the records as apdu.log lines, logged with their own time.
+    fileName(apdu) returns the name of the file selected by the C-APDU.
+    """
+    lossy = False
+
+    def __init__(self, logger, fileName=None):
+        self.logger = logger
+        self.fileName = fileName
+
+    def isEnabled(self):
+        return self.logger.isEnabledFor(logging.INFO)
+
+    def log(self, level, text, created):
+        if not self.logger.isEnabledFor(level):
+            return
+        logRecord = self.logger.makeRecord(self.logger.name, level, __file__, 0, text, None, None)
+        logRecord.created = created
+        logRecord.msecs = (created - int(created)) * 1000
+        self.logger.handle(logRecord)
+
+    def write(self, record):
+        if record.kind == TRACE_TEXT:
+            self.log(record.level, record.data, record.time)
+            return
+        if not self.logger.isEnabledFor(logging.INFO):
+            # Traced for another sink.
+            return
+        if record.separator:
+            self.log(logging.INFO, "", record.time)
+        if record.kind == TRACE_C_APDU:
+            text = "%sC-APDU%d: %s" %(record.prefix, record.simId, hextools.bytes2hex(record.data))
+        elif record.kind == TRACE_R_APDU and record.data == None:
+            text = "%sR-APDU%d" %(record.prefix, record.simId)
+        elif record.kind == TRACE_R_APDU:
+            text = "%sR-APDU%d: %s" %(record.prefix, record.simId, hextools.bytes2hex(record.data))
+        elif record.kind == TRACE_INS:
+            text = types.insName(record.data)
+            if text == 'SELECT_FILE' and self.fileName:
+                text += " " + self.fileName(record.data)
+        self.log(logging.INFO, text, record.time)
+
+    def drop(self, count):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class GsmtapSink(object):
+    """Sends C-APDU and R-APDU pairs to Wireshark, see util/gsmtap.py."""
+    # Sent over UDP, records can be dropped rather than waiting for it.
+    lossy = True
+
+    def __init__(self):
+        self.apdus = {}
+
+    def isEnabled(self):
+        return True
+
+    def write(self, record):
+        if record.kind == TRACE_C_APDU:
+            self.apdus[record.simId] = record.data
+        elif record.kind == TRACE_R_APDU and record.data != None:
+            apdu = self.apdus.pop(record.simId, None)
+            if apdu != None:
+                gsmtap.log(apdu, record.data)
+
+    def drop(self, count):
+        # The pairs might be split.
+        self.apdus = {}
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class PcapngSink(object):
+    """
+    Captures C-APDU and R-APDU pairs as GSMTAP SIM packets in a pcapng
+    file, one interface per card. If maxSize (bytes) or maxDuration
+    (seconds) is set, the capture continues in a new file when reached,
+    e.g. capture_000.pcapng, capture_001.pcapng.
+    By default the router waits for the capture to be written. If lossy
+    is set, records can be dropped instead. The number of dropped records
+    is written in a comment of the next packet, or in the interface
+    statistics when the capture is closed.
+    """
+    def __init__(self, file, maxSize=None, maxDuration=None, lossy=False):
+        self.file = file
+        self.maxSize = maxSize
+        self.maxDuration = maxDuration
+        self.lossy = lossy
+        # Records dropped since the last packet and in total.
+        self.dropped = 0
+        self.droppedTotal = 0
+        self.files = []
+        self.writer = None
+        # Time and data of the last C-APDU by card.
+        self.apdus = {}
+        self.open()
+
+    def getFileName(self, index):
+        if not self.maxSize and not self.maxDuration:
+            return self.file
+        root, ext = os.path.splitext(self.file)
+        return "%s_%03d%s" %(root, index, ext)
+
+    def open(self):
+        if self.writer:
+            self.writer.close()
+        file = self.getFileName(len(self.files))
+        self.writer = pcapng.PcapngWriter(file)
+        self.files.append(file)
+        # Interface id by card.
+        self.interfaces = {}
+        self.startTime = time.time()
+
+    def isEnabled(self):
+        return True
+
+    def write(self, record):
+        if record.kind == TRACE_C_APDU:
+            self.apdus[record.simId] = (record.time, record.data)
+            return
+        if record.kind != TRACE_R_APDU or record.data == None:
+            return
+        if record.simId not in self.apdus:
+            return
+        apduTime, apdu = self.apdus.pop(record.simId)
+        if ((self.maxSize and self.writer.size >= self.maxSize) or
+                (self.maxDuration and apduTime - self.startTime >= self.maxDuration)):
+            self.open()
+        if record.simId not in self.interfaces:
+            self.interfaces[record.simId] = self.writer.addInterface("SIM%d" %record.simId)
+        packet = gsmtap.ipPacket(gsmtap.packet(apdu, record.data))
+        comment = None
+        if self.dropped:
+            comment = "%d APDU trace records dropped before this packet" %self.dropped
+            self.dropped = 0
+        self.writer.writePacket(self.interfaces[record.simId], int(apduTime * 1e9), packet, comment)
+
+    def drop(self, count):
+        # The C-APDU of a pending pair might be followed by a dropped R-APDU.
+        self.apdus = {}
+        self.dropped += count
+        self.droppedTotal += count
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        if self.dropped:
+            if not self.interfaces:
+                self.interfaces[None] = self.writer.addInterface("SIM")
+            comment = "%d APDU trace records dropped at the end" %self.dropped
+            self.writer.writeStatistics(min(self.interfaces.values()), int(time.time() * 1e9),
+                                        self.droppedTotal, comment)
+            self.dropped = 0
+        self.writer.close()
+
+class CaptureSink(object):
+    """Binary capture of the raw C-APDUs and R-APDUs, see readCapture()."""
+    lossy = False
+
+    def __init__(self, file):
+        self.file = open(file, "wb")
+        self.file.write(CAPTURE_MAGIC)
+
+    def isEnabled(self):
+        return True
+
+    def write(self, record):
+        if record.kind not in (TRACE_C_APDU, TRACE_R_APDU) or record.data == None:
+            return
+        self.file.write(CAPTURE_RECORD.pack(record.time, record.kind, record.simId, len(record.data)))
+        self.file.write(str(bytearray(record.data)))
+
+    def drop(self, count):
+        pass
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def readCapture(file):
+    """Returns the captured (time, kind, simId, data) records."""
+    records = []
+    with open(file, "rb") as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise Exception("%s is not an APDU capture" %file)
+        while True:
+            header = f.read(CAPTURE_RECORD.size)
+            if len(header) < CAPTURE_RECORD.size:
+                break
+            recordTime, kind, simId, length = CAPTURE_RECORD.unpack(header)
+            records.append((recordTime, kind, simId, list(bytearray(f.read(length)))))
+    return records
@@ -0,0 +1,348 @@
+#!/usr/bin/python
+# LICENSE: GPL2
+
+# Backup, restore and diff of many cards in parallel: the cards attached
+# to a SimRouter or the cards leased from a card farm (reader pool). Every
+# card gets its own shell; a farm card also gets its own router, so the
+# cards are served in parallel. Cards of one router share its main loop.
+#
+# The outcome of every card is saved in bulk_backup.json of the output
+# directory. A repeated backup skips the cards already done, recognized
+# by ICCID. Restore always compares the card with the image again and
+# writes only the EFs which differ, so an interrupted restore continues
+# with the files not written yet and a card changed since is restored.
+
+import sys,os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import collections
+import json
+import logging
+import Queue
+import threading
+import time
+from optparse import OptionParser
+
+from sim import card_farm
+from sim import sim_backup
+from sim import sim_router
+from sim import sim_shell
+from sim_soft import sim_xml
+from util import hextools
+from util import types
+
+STATE_FILE = "bulk_backup.json"
+
+STATUS_DONE = "done"
+STATUS_SKIPPED = "skipped" # done in a previous run
+STATUS_FAILED = "failed"
+
+OPERATION_BACKUP = "backup"
+OPERATION_DIFF = "diff"
+OPERATION_RESTORE = "restore"
+
+def getImageFiles(image):
+    """EF values and record lengths of a card image by path, e.g. /ADF0/6F07."""
+    files = collections.OrderedDict()
+    root = sim_xml.readXml(image)
+    for node in root.findall("mf"):
+        addImageFiles(files, node, "")
+    return files
+
+def addImageFiles(files, dir, path):
+    for node in dir:
+        if node.tag not in ["df", "ef"]:
+            continue
+        filePath = path + "/" + node.attrib['id']
+        if node.tag == "df":
+            addImageFiles(files, node, filePath)
+            continue
+        value = (node.findtext("value") or "").replace(" ", "").upper()
+        recordLength = int(node.findtext("record_len") or 0)
+        files[filePath] = (value, recordLength)
+
+def diffFiles(cardValues, imageFiles):
+    """
+    Returns (path, cardValue, imageValue) of the EFs which differ, the
+    value is None if the EF is missing. Image values shorter than the
+    file are padded with FF, as when written.
+    """
+    differences = []
+    for path, (imageValue, recordLength) in imageFiles.items():
+        cardValue = cardValues.get(path)
+        if cardValue == None:
+            differences.append((path, None, imageValue))
+        elif types.addTrailingBytes(imageValue, 0xFF, len(cardValue)/2) != cardValue:
+            differences.append((path, cardValue, imageValue))
+    for path, cardValue in cardValues.items():
+        if path not in imageFiles:
+            differences.append((path, cardValue, None))
+    return differences
+
+def formatDiff(name, differences):
+    lines = []
+    for path, cardValue, imageValue in differences:
+        if cardValue == None:
+            lines.append("%s %s: missing on the card" %(name, path))
+        elif imageValue == None:
+            lines.append("%s %s: missing in the image" %(name, path))
+        else:
+            lines.append("%s %s:" %(name, path))
+            lines.append("  card:  %s" %cardValue)
+            lines.append("  image: %s" %imageValue)
+    return lines
+
+class CardTarget(object):
+    """Card of a bulk operation, with its own shell."""
+    def __init__(self, name, shell, lease=None, router=None):
+        self.name = name
+        self.shell = shell
+        self.lease = lease
+        # Router created for the target, closed with it.
+        self.router = router
+
+    def close(self):
+        if self.router:
+            self.router.close()
+            self.router = None
+        if self.lease:
+            self.lease.release()
+            self.lease = None
+
+def getRouterTargets(router):
+    """Targets for all cards of the router, their APDUs go through its main loop."""
+    targets = []
+    for simId in range(router.getNbrOfCards()):
+        simCtrl = router.createSimCtrl()
+        simCtrl.setSrvCtrlId(simId)
+        simCtrl.init()
+        targets.append(CardTarget("sim%d" %simId, sim_shell.SimShell(simCtrl)))
+    return targets
+
+def getFarmTargets(farm, count=None, simType=types.TYPE_USIM):
+    """
+    Lease idle cards of the farm, all of them if count is None. Every card
+    is served by its own router. Close the targets to release the cards.
+    """
+    targets = []
+    while count == None or len(targets) < count:
+        lease = farm.lease(simType, timeout=0)
+        if not lease:
+            break
+        router = sim_router.SimRouter(cards=[lease.simCard], type=simType,
+                                      mode=sim_router.SIMTRACE_OFFLINE)
+        router.run(mode=sim_router.ROUTER_MODE_DISABLED)
+        targets.append(CardTarget("card%d" %lease.card.id, router.shell, lease, router))
+    return targets
+
+class BulkBackup(object):
+    """
+    Runs backup, diff and restore on the targets in parallel, up to jobs
+    cards at once (all if None). progress(operation, name, status, done,
+    total) is called when a card is finished.
+    """
+    def __init__(self, dir, jobs=None, progress=None, resume=True):
+        self.dir = dir
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        self.jobs = jobs
+        self.progress = progress
+        self.lock = threading.Lock()
+        self.stateFile = os.path.join(dir, STATE_FILE)
+        self.state = {}
+        if resume and os.path.exists(self.stateFile):
+            with open(self.stateFile) as file:
+                self.state = json.load(file)
+
+    def getState(self, operation, target):
+        with self.lock:
+            return self.state.get(operation, {}).get(target.name)
+
+    def setState(self, operation, target, state):
+        with self.lock:
+            self.state.setdefault(operation, {})[target.name] = state
+            sim_xml.writeFile(self.stateFile, json.dumps(self.state, indent=1, sort_keys=True))
+
+    def isDone(self, operation, target, iccid):
+        state = self.getState(operation, target)
+        return bool(state and state["status"] == STATUS_DONE and state["iccid"] == iccid)
+
+    def getIccid(self, shell):
+        status, data = shell.read("/2FE2")
+        if not shell.statusOk(status):
+            raise Exception("Failed to read ICCID")
+        return types.getDataValue(data)
+
+    def getImage(self, images, target):
+        """images is the image of all cards or a dict of images by target name."""
+        if isinstance(images, dict):
+            return images[target.name]
+        return images
+
+    def run(self, operation, targets, function):
+        """Call function(target) on the targets in parallel. Returns (status, result) by name."""
+        queue = Queue.Queue()
+        results = collections.OrderedDict()
+        for target in targets:
+            queue.put(target)
+            results[target.name] = None
+        self.done = 0
+        threads = []
+        for i in range(min(self.jobs or len(targets), len(targets))):
+            thread = threading.Thread(target=self.runTargets,
+                                      args=(operation, function, queue, results))
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return results
+
+    def runTargets(self, operation, function, queue, results):
+        while True:
+            try:
+                target = queue.get_nowait()
+            except Queue.Empty:
+                return
+            startTime = time.time()
+            try:
+                status, result = function(target)
+            except Exception as e:
+                logging.error("%s of %s failed: %s" %(operation, target.name, str(e)))
+                status, result = STATUS_FAILED, str(e)
+            with self.lock:
+                results[target.name] = (status, result)
+                self.done += 1
+                done = self.done
+            logging.info("%s %d/%d: %s %s (%.1fs)" %(operation, done, len(results), target.name,
+                                                     status, time.time() - startTime))
+            if self.progress:
+                self.progress(operation, target.name, status, done, len(results))
+
+    def readCard(self, shell):
+        simBackup = sim_backup.SimBackup(shell, None, None)
+        if not simBackup.run():
+            raise Exception("Failed to read the card")
+        return simBackup.getValues()
+
+    def backup(self, targets):
+        """Save the image of every card to the directory. Result is the image path."""
+        return self.run(OPERATION_BACKUP, targets, self.backupCard)
+
+    def backupCard(self, target):
+        shell = target.shell
+        iccid = self.getIccid(shell)
+        state = self.getState(OPERATION_BACKUP, target)
+        if self.isDone(OPERATION_BACKUP, target, iccid) and os.path.exists(state["image"]):
+            return STATUS_SKIPPED, state["image"]
+        status, data = shell.readi("EF_IMSI")
+        if not shell.statusOk(status):
+            raise Exception("Failed to read EF_IMSI")
+        imsi = types.getDataValue(data)
+        atr = shell.simCtrl.router.getCtrlCard(shell.simCtrl.srvId).getCachedAtr()
+        simBackup = sim_backup.SimBackup(shell, imsi, hextools.bytes2hex(atr, " "))
+        if not simBackup.run():
+            raise Exception("Failed to read the card")
+        image = os.path.join(self.dir, "sim_backup_%s_%s.xml" %(target.name, iccid))
+        simBackup.saveXml(image)
+        self.setState(OPERATION_BACKUP, target,
+                      {"status": STATUS_DONE, "iccid": iccid, "image": image})
+        return STATUS_DONE, image
+
+    def diff(self, targets, images):
+        """Compare the cards with the images. Result is a list, see diffFiles()."""
+        imageFiles = {}
+        for target in targets:
+            image = self.getImage(images, target)
+            if image not in imageFiles:
+                imageFiles[image] = getImageFiles(image)
+        def diffCard(target):
+            image = self.getImage(images, target)
+            return STATUS_DONE, diffFiles(self.readCard(target.shell), imageFiles[image])
+        return self.run(OPERATION_DIFF, targets, diffCard)
+
+    def restore(self, targets, images):
+        """
+        Write the EFs which differ from the image. The file system itself
+        (missing or extra files) is not changed, these files are reported.
+        Result is a dict with the written, failed and missing paths.
+        """
+        imageFiles = {}
+        for target in targets:
+            image = self.getImage(images, target)
+            if image not in imageFiles:
+                imageFiles[image] = getImageFiles(image)
+        def restoreCard(target):
+            image = self.getImage(images, target)
+            return self.restoreCard(target, image, imageFiles[image])
+        return self.run(OPERATION_RESTORE, targets, restoreCard)
+
+    def restoreCard(self, target, image, imageFiles):
+        shell = target.shell
+        iccid = self.getIccid(shell)
+        result = {"written": [], "failed": [], "missing": []}
+        for path, cardValue, imageValue in diffFiles(self.readCard(shell), imageFiles):
+            if cardValue == None or imageValue == None:
+                result["missing"].append(path)
+                continue
+            value, recordLength = imageFiles[path]
+            if recordLength:
+                size = recordLength * 2
+                value = ";".join([value[i:i + size] for i in range(0, len(value), size)])
+            if shell.writeRaw(path, value):
+                result["written"].append(path)
+            else:
+                result["failed"].append(path)
+        status = STATUS_DONE
+        if result["failed"]:
+            status = STATUS_FAILED
+        self.setState(OPERATION_RESTORE, target,
+                      {"status": status, "iccid": iccid, "image": image,
+                       "written": len(result["written"]), "failed": result["failed"]})
+        return status, result
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="%prog [options] backup|diff|restore")
+    parser.add_option("-s", "--soft", dest="soft", type="int", default=0,
+                      help="Number of soft cards")
+    parser.add_option("-r", "--reader", dest="readers", type="int", action="append",
+                      default=[], help="Index of a live reader")
+    parser.add_option("-t", "--type", dest="type", type="int", default=types.TYPE_USIM,
+                      help="Type of the cards: %d SIM, %d USIM" %(types.TYPE_SIM, types.TYPE_USIM))
+    parser.add_option("-i", "--image", dest="image",
+                      help="Card image to compare with or restore")
+    parser.add_option("-d", "--dir", dest="dir", default=".",
+                      help="Directory of the backups and of the state of the run")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=None,
+                      help="Number of cards handled at once, default all")
+    parser.add_option("-n", "--no-resume", dest="resume", action="store_false", default=True,
+                      help="Don't skip the cards backed up in a previous run")
+    (options, args) = parser.parse_args()
+    if len(args) != 1 or args[0] not in [OPERATION_BACKUP, OPERATION_DIFF, OPERATION_RESTORE]:
+        parser.error("Expecting backup, diff or restore")
+    operation = args[0]
+    if operation != OPERATION_BACKUP and not options.image:
+        parser.error("Expecting image")
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    farm = card_farm.CardFarm()
+    farm.addSoftCards(options.soft, options.type)
+    for index in options.readers:
+        farm.addLiveCard(index, options.type)
+    targets = getFarmTargets(farm, simType=options.type)
+    bulkBackup = BulkBackup(options.dir, options.jobs, resume=options.resume)
+    try:
+        if operation == OPERATION_BACKUP:
+            results = bulkBackup.backup(targets)
+        elif operation == OPERATION_DIFF:
+            results = bulkBackup.diff(targets, options.image)
+        else:
+            results = bulkBackup.restore(targets, options.image)
+        for name, (status, result) in results.items():
+            if operation == OPERATION_DIFF and status == STATUS_DONE:
+                print "\n".join(formatDiff(name, result) or ["%s: no differences" %name])
+            else:
+                print "%s: %s %s" %(name, status, result)
+    finally:
+        for target in targets:
+            target.close()
+        farm.close()
@@ -0,0 +1,431 @@
+#!/usr/bin/python
+# LICENSE: GPL2
+
+# Pool of soft and live cards for running many test sessions. Soft cards
+# work on their own copy of the card image. Between leases a card is reset
+# instead of being created again; a soft card gets a fresh copy of the
+# image, so the EF writes and PIN counters of a session are undone. Idle
+# cards are checked with STATUS like the pyscard poll. The farm can be
+# served over zerorpc, so other processes can lease its cards.
+
+import sys,os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import itertools
+import logging
+import shutil
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+
+import zerorpc
+from sim import sim_card
+from sim import sim_reader
+from sim import pyscard_rpc_ctrl
+from sim_soft import sim_xml
+from util import hextools
+from util import types
+
+CARD_FARM_PORT = 4150
+# Seconds between health checks of an idle card.
+HEALTH_CHECK_INTERVAL = 30
+
+class FarmCard(object):
+    def __init__(self, id, simCard, readerIndex, image=None, pristine=None, savePolicy=None):
+        self.id = id
+        self.simCard = simCard
+        self.readerIndex = readerIndex
+        self.image = image
+        # Image the card is restored from, not written by the card.
+        self.pristine = pristine
+        self.savePolicy = savePolicy
+        self.nbrOfRestores = 0
+        self.lease = None
+        self.healthy = True
+        self.checking = False
+        self.lastCheck = time.time()
+        self.nbrOfLeases = 0
+
+    def isSoft(self):
+        return self.simCard.mode == sim_reader.MODE_SIM_SOFT
+
+    def isIdle(self):
+        return not self.lease and not self.checking
+
+    def connect(self):
+        self.simCard.connect(self.readerIndex)
+
+    def reset(self, restore=False):
+        """
+        Reset the card and forget the state of the previous session. If
+        restore is set, a soft card is loaded from a new copy of the
+        pristine image.
+        """
+        oldImage = None
+        if restore and self.pristine:
+            oldImage = self.image
+            self.nbrOfRestores += 1
+            ext = os.path.splitext(self.pristine)[1]
+            self.image = os.path.join(os.path.dirname(self.pristine),
+                                      "card_%d_%d%s" %(self.id, self.nbrOfRestores, ext))
+            shutil.copy2(self.pristine, self.image)
+            # The pending changes are written to the old copy on disconnect,
+            # the new copy is loaded on connect.
+            self.simCard.simReader.setCardImage(self.readerIndex, self.image, self.savePolicy)
+        self.simCard.reset()
+        self.simCard.setCurrentAidId(None)
+        self.simCard.resetCurrentDir()
+        self.simCard.removeRoutingAttr()
+        if oldImage:
+            os.remove(oldImage)
+
+    def check(self):
+        """Send STATUS, return True if the card responds."""
+        for pattern in pyscard_rpc_ctrl.POLL_STATUS_PATTERN:
+            try:
+                sw1 = types.sw1(self.simCard.apdu(pattern))
+            except Exception as e:
+                logging.warning("Card %d: %s" %(self.id, str(e)))
+                return False
+            # 2G STATUS ends with 9FXX.
+            if sw1 in (0x90, 0x91, 0x9F):
+                return True
+        return False
+
+class CardLease(object):
+    """Card leased to a job, release it when done, e.g. with the with statement."""
+    def __init__(self, farm, card, id):
+        self.farm = farm
+        self.card = card
+        self.id = id
+        self.simCard = card.simCard
+
+    def apdu(self, apdu):
+        return self.simCard.apdu(apdu)
+
+    def apduMany(self, apdus, stopOnError=False):
+        return self.simCard.apduMany(apdus, stopOnError)
+
+    def release(self):
+        self.farm.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.release()
+
+class CardFarm(object):
+    def __init__(self, imageDir=None, healthCheckInterval=HEALTH_CHECK_INTERVAL,
+                 restoreImages=True):
+        """
+        If restoreImages is set, soft cards are restored from the pristine
+        image on release, otherwise only the volatile state is reset.
+        """
+        self.imageDir = imageDir
+        self.tmpDir = None
+        if not imageDir:
+            self.tmpDir = tempfile.mkdtemp(prefix="card_farm_")
+            self.imageDir = self.tmpDir
+        self.healthCheckInterval = healthCheckInterval
+        self.restoreImages = restoreImages
+        self.cards = []
+        self.leases = {}
+        self.leaseIds = itertools.count(1)
+        self.condition = threading.Condition()
+        self.healthThread = None
+
+    def addSoftCards(self, count, simType=types.TYPE_USIM, image=None,
+                     savePolicy=sim_xml.SAVE_EXPLICIT):
+        """
+        Add soft cards, each works on its own copy of the image (xml or
+        binary), by default the image of the soft card.
+        """
+        if not image:
+            image = os.path.join(os.path.dirname(__file__), "../sim_soft/sim_backup.xml")
+            if not os.path.exists(image):
+                image = image + ".bak"
+        name, ext = os.path.splitext(os.path.basename(image))
+        if ext == ".bak":
+            ext = os.path.splitext(name)[1]
+        # Copy of the image shared by the cards, the cards are restored from it.
+        pristine = os.path.join(self.imageDir, "pristine_%d%s" %(len(self.cards), ext))
+        shutil.copy2(image, pristine)
+        cards = []
+        for i in range(count):
+            id = len(self.cards)
+            file = os.path.join(self.imageDir, "card_%d%s" %(id, ext))
+            shutil.copy2(pristine, file)
+            simCard = sim_card.SimCard(mode=sim_reader.MODE_SIM_SOFT, type=simType)
+            # Every card has its own soft controller, reader 0 is enough.
+            simCard.simReader.setCardImage(sim_reader.READER_ID_0, file, savePolicy)
+            card = FarmCard(id, simCard, sim_reader.READER_ID_0, file, pristine, savePolicy)
+            cards.append(self.addFarmCard(card))
+        return cards
+
+    def addLiveCard(self, readerIndex, simType=types.TYPE_USIM):
+        simCard = sim_card.SimCard(mode=sim_reader.MODE_PYSCARD, type=simType)
+        return self.addCard(simCard, readerIndex)
+
+    def addCard(self, simCard, readerIndex, image=None):
+        return self.addFarmCard(FarmCard(len(self.cards), simCard, readerIndex, image))
+
+    def addFarmCard(self, card):
+        card.connect()
+        with self.condition:
+            self.cards.append(card)
+            self.condition.notify_all()
+        return card
+
+    def matches(self, card, simType, mode):
+        if not card.isIdle() or not card.healthy:
+            return False
+        if simType != None and card.simCard.type != simType:
+            return False
+        if mode != None and card.simCard.mode != mode:
+            return False
+        return True
+
+    def lease(self, simType=None, mode=None, timeout=None):
+        """
+        Lease an idle card of the type and reader mode (any if None). Waits
+        for a card up to timeout seconds, forever if None. Returns CardLease
+        or None on timeout.
+        """
+        endTime = None
+        if timeout != None:
+            endTime = time.time() + timeout
+        with self.condition:
+            while True:
+                for card in self.cards:
+                    if self.matches(card, simType, mode):
+                        card.lease = CardLease(self, card, self.leaseIds.next())
+                        card.nbrOfLeases += 1
+                        self.leases[card.lease.id] = card.lease
+                        return card.lease
+                if endTime == None:
+                    self.condition.wait()
+                    continue
+                remaining = endTime - time.time()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+    def getLease(self, id):
+        lease = self.leases.get(id)
+        if not lease:
+            raise Exception("Lease %r not found" %id)
+        return lease
+
+    def release(self, lease):
+        """Reset (or restore) the card and return it to the pool."""
+        card = lease.card
+        with self.condition:
+            if card.lease != lease:
+                raise Exception("Card %d is not leased by %r" %(card.id, lease.id))
+            del self.leases[lease.id]
+            card.lease = None
+            card.checking = True
+        try:
+            card.reset(self.restoreImages)
+            card.healthy = True
+        except Exception as e:
+            logging.error("Card %d reset failed: %s" %(card.id, str(e)))
+            card.healthy = False
+        with self.condition:
+            card.checking = False
+            card.lastCheck = time.time()
+            self.condition.notify_all()
+
+    def checkHealth(self, all=False):
+        """
+        Check idle cards not checked within the interval (all idle cards
+        if all is set). An unhealthy card is reconnected on the next check.
+        """
+        now = time.time()
+        with self.condition:
+            cards = [card for card in self.cards if card.isIdle() and
+                     (all or now - card.lastCheck >= self.healthCheckInterval)]
+            for card in cards:
+                card.checking = True
+        for card in cards:
+            if not card.healthy:
+                try:
+                    card.reset()
+                except Exception as e:
+                    logging.warning("Card %d reconnect failed: %s" %(card.id, str(e)))
+            healthy = card.check()
+            if card.healthy != healthy:
+                logging.warning("Card %d %s" %(card.id, "recovered" if healthy else "not responding"))
+            with self.condition:
+                card.healthy = healthy
+                card.checking = False
+                card.lastCheck = time.time()
+                self.condition.notify_all()
+        return [card.id for card in cards if not card.healthy]
+
+    def startHealthCheck(self):
+        if not self.healthThread:
+            self.healthThread = HealthCheckThread(self)
+            self.healthThread.start()
+
+    def stopHealthCheck(self):
+        if self.healthThread:
+            self.healthThread.stop()
+            self.healthThread = None
+
+    def getStatus(self):
+        status = []
+        with self.condition:
+            for card in self.cards:
+                status.append({"id" : card.id,
+                               "mode" : card.simCard.mode,
+                               "type" : card.simCard.type,
+                               "image" : card.image,
+                               "leased" : card.lease != None,
+                               "healthy" : card.healthy,
+                               "leases" : card.nbrOfLeases})
+        return status
+
+    def close(self):
+        self.stopHealthCheck()
+        for card in self.cards:
+            card.simCard.disconnect()
+            card.simCard.stop()
+        self.cards = []
+        if self.tmpDir:
+            shutil.rmtree(self.tmpDir, ignore_errors=True)
+            self.tmpDir = None
+
+class HealthCheckThread(threading.Thread):
+    def __init__(self, farm):
+        threading.Thread.__init__(self)
+        threading.Thread.setName(self, 'HealthCheckThread')
+        self.setDaemon(True)
+        self.farm = farm
+        self.stopEvent = threading.Event()
+
+    def run(self):
+        interval = max(self.farm.healthCheckInterval / 4.0, 0.1)
+        while not self.stopEvent.wait(interval):
+            try:
+                self.farm.checkHealth()
+            except Exception as e:
+                logging.error("Health check failed: %s" %str(e))
+
+    def stop(self):
+        self.stopEvent.set()
+        self.join()
+
+class CardFarmServer(object):
+    """
+    Exports the farm over zerorpc. APDUs are hex strings, a lease is
+    identified by its id.
+    """
+    def __init__(self, farm):
+        self.farm = farm
+
+    def lease(self, simType=None, mode=None):
+        """Lease an idle card, returns the lease id or None."""
+        lease = self.farm.lease(simType, mode, timeout=0)
+        if not lease:
+            return None
+        return lease.id
+
+    def release(self, id):
+        self.farm.release(self.farm.getLease(id))
+
+    def getATR(self, id):
+        return self.farm.getLease(id).simCard.getCachedAtr()
+
+    def transmit(self, id, apdu):
+        return hextools.bytes2hex(self.farm.getLease(id).apdu(apdu))
+
+    def transmitMany(self, id, apdus, stopOnError=False):
+        rapdus = self.farm.getLease(id).apduMany(apdus, stopOnError)
+        return [hextools.bytes2hex(rapdu) for rapdu in rapdus]
+
+    def status(self):
+        return self.farm.getStatus()
+
+    def runServer(self, endpoint):
+        self.server = zerorpc.Server(self)
+        self.server.bind(endpoint)
+        logging.info("Card farm server %s started" %endpoint)
+        self.server.run()
+
+class CardFarmClient(object):
+    """Leases cards of a farm running in another process."""
+    def __init__(self, endpoint="tcp://127.0.0.1:%d" %CARD_FARM_PORT, pollInterval=0.1):
+        self.client = zerorpc.Client(heartbeat=None, timeout=sim_reader.MESSAGE_TIMEOUT)
+        self.client.connect(endpoint)
+        self.pollInterval = pollInterval
+
+    def lease(self, simType=None, mode=None, timeout=None):
+        endTime = None
+        if timeout != None:
+            endTime = time.time() + timeout
+        while True:
+            id = self.client.lease(simType, mode)
+            if id != None:
+                return RemoteLease(self.client, id)
+            if endTime != None and time.time() >= endTime:
+                return None
+            time.sleep(self.pollInterval)
+
+    def status(self):
+        return self.client.status()
+
+    def close(self):
+        self.client.close()
+
+class RemoteLease(object):
+    def __init__(self, client, id):
+        self.client = client
+        self.id = id
+
+    def getATR(self):
+        return self.client.getATR(self.id)
+
+    def apdu(self, apdu):
+        return hextools.hex2bytes(self.client.transmit(self.id, apdu))
+
+    def apduMany(self, apdus, stopOnError=False):
+        rapdus = self.client.transmitMany(self.id, apdus, stopOnError)
+        return [hextools.hex2bytes(rapdu) for rapdu in rapdus]
+
+    def release(self):
+        self.client.release(self.id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.release()
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("-p", "--port", dest="port", type="int", default=CARD_FARM_PORT,
+                      help="Port number")
+    parser.add_option("-s", "--soft", dest="soft", type="int", default=0,
+                      help="Number of soft cards")
+    parser.add_option("-t", "--type", dest="type", type="int", default=types.TYPE_USIM,
+                      help="Type of the soft cards: %d SIM, %d USIM" %(types.TYPE_SIM, types.TYPE_USIM))
+    parser.add_option("-i", "--image", dest="image", help="Card image of the soft cards")
+    parser.add_option("-d", "--dir", dest="dir", help="Directory for the copies of the image")
+    parser.add_option("-k", "--keep", dest="keep", action="store_true", default=False,
+                      help="Keep the changes of the soft card images between leases")
+    parser.add_option("-r", "--reader", dest="readers", type="int", action="append",
+                      default=[], help="Index of a live reader")
+    (options, args) = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    farm = CardFarm(options.dir, restoreImages=not options.keep)
+    farm.addSoftCards(options.soft, options.type, options.image)
+    for index in options.readers:
+        farm.addLiveCard(index)
+    farm.startHealthCheck()
+    try:
+        CardFarmServer(farm).runServer("tcp://0.0.0.0:%d" %options.port)
+    finally:
+        farm.close()
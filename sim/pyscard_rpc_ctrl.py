@@ -13,9 +13,12 @@ from smartcard.Exceptions import CardConnectionException
 import subprocess
 import threading
 import time
+import gevent
+from gevent.threadpool import ThreadPool
 import zerorpc
 import zmq
 from util import hextools
+from util import types
 
 class PyscardRPC(object):
     ####################
@@ -24,7 +27,8 @@ class PyscardRPC(object):
     def __init__(self, logLevel=logging.WARNING):
         self.setupLogger(logLevel)
         self.readers = []
-        self.pollSim = {}
+        # ReaderWorker by reader index.
+        self.workers = {}
 
     def setupLogger(self, logLevel):
         logger = logging.getLogger()
@@ -35,25 +39,21 @@ class PyscardRPC(object):
         consoleHndl.setLevel(logLevel)
         logger.addHandler(consoleHndl)
 
+    def getWorker(self, index):
+        if index not in self.workers:
+            self.workers[index] = ReaderWorker(self, index)
+        return self.workers[index]
+
     def runPollSim(self, index):
-        if index in self.pollSim.keys():
-            # Poll already started.
-            return
-        pollSim = {index : PollSimThread(self, index)}
-        pollSim[index].setDaemon(True)
-        pollSim[index].update()
-        pollSim[index].start()
-        self.pollSim.update(pollSim)
+        self.getWorker(index).startPoll()
 
     def stopPollSim(self, index):
-        if index not in self.pollSim.keys():
-            # Poll not started.
-            return
-        self.pollSim[index].stop()
+        if index in self.workers:
+            self.workers[index].stopPoll()
 
     def updatePoll(self, index):
-        if index in self.pollSim.keys():
-            self.pollSim[index].update()
+        if index in self.workers:
+            self.workers[index].update()
 
     # TODO: remove, already implemented in PyscardRpcServerThread.
     # Endpoint is e.g. "tcp://0.0.0.0:4242"
@@ -165,10 +165,17 @@ class PyscardRPC(object):
         logReturnVal(newConnection=newConnection)
         return newConnection
 
+    def getATR(self, index):
+        try:
+            return self.getCard(index).getATR()
+        except CardConnectionException:
+            time.sleep(0.1)
+            return self.getCard(index).getATR()
+
     def c_connect(self, index):
         logFunctionAndArgs()
         self.checkCard(index)
-        self.getCard(index).connect()
+        self.getWorker(index).call(self.getCard(index).connect)
         # TODO: get simType from sim_router.
         self.runPollSim(index)
         logReturnVal()
@@ -178,26 +185,21 @@ class PyscardRPC(object):
         logFunctionAndArgs()
         self.checkCard(index)
         self.stopPollSim(index)
-        self.getCard(index).disconnect()
+        self.getWorker(index).call(self.getCard(index).disconnect)
         logReturnVal()
         return None
 
     def c_control(self, controlCode, inBuffer, index):
         #logFunctionAndArgs()
         self.checkCard(index)
-        self.getCard(index).control(controlCode, inBuffer)
+        self.getWorker(index).call(self.getCard(index).control, controlCode, inBuffer)
         #logReturnVal()
         return None
 
     def c_getATR(self, index):
         logFunctionAndArgs()
         self.checkCard(index)
-        self.updatePoll(index)
-        try:
-            atr = self.getCard(index).getATR()
-        except CardConnectionException:
-            time.sleep(0.1)
-            atr = self.getCard(index).getATR()
+        atr = self.getWorker(index).call(self.getATR, index)
         logReturnVal(atr=atr)
         return atr
 
@@ -205,12 +207,20 @@ class PyscardRPC(object):
         if apdu not in POLL_STATUS_PATTERN_BIN:
             logFunctionAndArgs()
         self.checkCard(index)
-        self.updatePoll(index)
-        data, sw1, sw2 = self.getCard(index).transmit(apdu)
+        data, sw1, sw2 = self.getWorker(index).call(self.getCard(index).transmit, apdu)
         if apdu not in POLL_STATUS_PATTERN_BIN:
             logReturnVal(data=data, sw1=sw1, sw2=sw2)
         return data, sw1, sw2
 
+    def c_transmit_many(self, apdus, index, stopOnError=False):
+        """Send APDUs in one RPC call, see types.transmitMany()."""
+        logFunctionAndArgs()
+        self.checkCard(index)
+        responses = self.getWorker(index).call(types.transmitMany, self.getCard(index).transmit,
+                                               apdus, stopOnError)
+        logReturnVal(responses=responses)
+        return responses
+
 class Reader(object):
     def __init__(self):
         self.index = None
@@ -295,47 +305,60 @@ class PyscardRpcServerThread(threading.Thread):
         if self.proc:
             subprocess.Popen.terminate(self.proc)
 
-class PollSimThread(threading.Thread):
+class ReaderWorker(object):
+    """
+    Runs the card commands of one reader in its own thread, in the order
+    they are called. The calling greenlet waits for the result, so a slow
+    card doesn't hold up the other readers. An idle card is polled with
+    STATUS through the same thread.
+    """
     def __init__(self, pyscardRpc, index, pollRate=400):
-        threading.Thread.__init__(self)
         self.pyscardRpc = pyscardRpc
         self.index = index
         self.pollRate = pollRate
-        self.poll = False
-        self.startTime = 0
+        # A single thread keeps the order of the commands.
+        self.pool = ThreadPool(1)
+        self.poll = None
         self.lastUpdate = 0
         self.pattern = 0
-        threading.Thread.setName(self, 'PollSimThread')
-        self.__lock = threading.Lock()
 
-    def run(self):
-        self.__lock.acquire()
-        self.poll = True
-
-        while (self.poll):
-            self.startTime = time.time()
-            if self.startTime - self.lastUpdate > (self.pollRate / 1000.0 - 0.1):
-                try:
-                    sw1 = self.pyscardRpc.c_transmit(hextools.hex2bytes(POLL_STATUS_PATTERN[self.pattern]),
-                                                     self.index)[1]
-                    if sw1 != 0x90 and self.pattern < (len(POLL_STATUS_PATTERN) - 1):
-                        # Use different pattern e.g. 2G status.
-                        self.pattern += 1
-                except:
-                    logging.error("Stop polling")
-                    self.stop()
-            self.lastUpdate = time.time()
-            time.sleep(self.pollRate / 1000.0)
-        self.__lock.release()
+    def call(self, function, *args):
+        self.update()
+        try:
+            return self.pool.apply(function, args)
+        finally:
+            self.update()
 
     def update(self):
-        self.lastUpdate = time.time() - 0.1
+        self.lastUpdate = time.time()
 
-    def stop(self):
-        self.poll = False
-        try:
-            self.join()
-        except: pass
+    def startPoll(self):
+        if self.poll:
+            # Poll already started.
+            return
+        self.update()
+        self.poll = gevent.spawn(self.pollLoop)
+
+    def stopPoll(self):
+        if self.poll:
+            self.poll.kill()
+            self.poll = None
+
+    def pollLoop(self):
+        while True:
+            gevent.sleep(self.pollRate / 1000.0)
+            if time.time() - self.lastUpdate < (self.pollRate / 1000.0 - 0.1):
+                continue
+            try:
+                card = self.pyscardRpc.getCard(self.index)
+                sw1 = self.call(card.transmit, hextools.hex2bytes(POLL_STATUS_PATTERN[self.pattern]))[1]
+                if sw1 != 0x90 and self.pattern < (len(POLL_STATUS_PATTERN) - 1):
+                    # Use different pattern e.g. 2G status.
+                    self.pattern += 1
+            except Exception:
+                logging.error("Stop polling")
+                self.poll = None
+                return
 
 POLL_STATUS_PATTERN = [
     "80F2000C00", #3G SIM
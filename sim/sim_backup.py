@@ -2,19 +2,281 @@
 # LICENSE: GPL2
 # (c) 2016 Kamil Wartanowicz
 
+# Backup of the card file system in passes:
+#  1. enumerate the files of every DF with one batch of SELECTs by path,
+#     which respond with the FCP,
+#  2. read the files planned from their FCP with batched READ BINARY/RECORD,
+#  3. files denied in 2. are grouped by their EF_ARR record, the access
+#     conditions are verified or the record is relaxed once for the group,
+#  4. the image is written file by file, see sim_xml.XmlStreamWriter.
+
 import sys,os.path
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import collections
+import logging
+
+from util import hextools
 from util import types
 from sim_soft import sim_xml
 
+# APDUs sent in one batched transmit.
+BATCH_SIZE = 256
+# Bytes read with one READ BINARY.
+READ_BINARY_SIZE = 0xFF
+
+def getSelectApdu(path):
+    """SELECT by path from MF, responds with FCP."""
+    fids = ""
+    for file in types.getFilesFromPath(path):
+        if file.startswith("ADF"):
+            file = "7FFF" # current ADF
+        if file != "3F00":
+            fids += file
+    return "00A40804%02X%s" %(len(fids)/2, fids)
+
+def getAdfName(path):
+    name = types.getFilesFromPath(path)[0]
+    if not name.startswith("ADF"):
+        return None
+    return name
+
+class BackupFile(object):
+    __slots__ = ('path', 'id', 'fcp', 'data', 'children')
+
+    def __init__(self, path, id, fcp, isDir):
+        self.path = path
+        self.id = id
+        self.fcp = fcp
+        self.data = None
+        self.children = None
+        if isDir:
+            self.children = []
+
+    def isDir(self):
+        return self.children != None
+
 class SimBackup(object):
-    def __init__(self, simCtrl, imsi, atr):
-        self.simCtrl = simCtrl
+    def __init__(self, shell, imsi, atr):
+        self.shell = shell
+        self.simCtrl = shell.simCtrl
         self.imsi = imsi
-        self.root = sim_xml.xmlInit(atr)
+        self.atr = atr
+        self.mf = None
+        # Files by path, for finding EF_ARR files.
+        self.files = {}
+
+    def run(self):
+        sw1, sw2, data = self.simCtrl.selectMf()
+        sw1, sw2, data = self.simCtrl.getResponse(sw2)
+        if not data:
+            logging.error("Failed to select MF")
+            return False
+        self.mf = BackupFile("/", "3F00", data, True)
+        self.files["/"] = self.mf
+        self.enumerate(self.mf)
+        efs = [file for file in self.getFiles(self.mf) if not file.isDir()]
+        deniedFiles = self.readFiles(efs)
+        self.readDeniedFiles(deniedFiles)
+        # Selections done in batches are not tracked by simCtrl.
+        sw1, sw2, data = self.simCtrl.selectFileByPath("/")
+        return True
+
+    def getFiles(self, dir):
+        for file in dir.children:
+            yield file
+            if file.isDir():
+                for child in self.getFiles(file):
+                    yield child
+
+    def getPath(self, dir, id):
+        if dir.path == "/":
+            return "/" + id
+        return dir.path + "/" + id
+
+    def transmit(self, apdus):
+        responses = []
+        for i in range(0, len(apdus), BATCH_SIZE):
+            responses += self.simCtrl.sendApdus(apdus[i:i + BATCH_SIZE])
+        return responses
+
+    def selectAdf(self, name):
+        """Make the ADF of the path current, needed by SELECT of 7FFF."""
+        if not name:
+            return True
+        aidId = int(name.replace("ADF", ""))
+        if aidId == self.simCtrl.getCurrentAidId():
+            return True
+        if not self.simCtrl.selectAid(aidId=aidId):
+            logging.error("Failed to select AID: " + name)
+            return False
+        return True
 
-    def setMf(self, data):
-        return self.addMf(self.root, data)
+    def setCurrentFile(self, file):
+        self.simCtrl.setCurrentFilePath(file.path)
+        self.simCtrl.updateCurrentFileType(file.fcp)
+
+    def enumerate(self, dir):
+        """Select the children of the DF in one batch, then the child DFs."""
+        files = []
+        for file in self.simCtrl.simFiles.findAllChildFiles(dir.path.rstrip("/") + "/"):
+            id = types.fidFromPath(file)
+            isDir = file[-1] == "/"
+            if types.getFileNameFormat(file) == types.FILE_FORMAT_ADF_NAME:
+                id = self.simCtrl.simFiles.getAdfId(id)
+                if not id:
+                    continue
+            files.append(BackupFile(self.getPath(dir, id), id, None, isDir))
+
+        selectFiles = [file for file in files if not file.id.startswith("ADF")]
+        if selectFiles and self.selectAdf(getAdfName(dir.path)):
+            responses = self.transmit([getSelectApdu(file.path) for file in selectFiles])
+            for file, (sw1, sw2, data) in zip(selectFiles, responses):
+                if types.assertSw(sw1, sw2, checkSw='NO_ERROR', log=False) or not data:
+                    logging.info("Failed to select: " + file.path)
+                    continue
+                file.fcp = data
+                self.setCurrentFile(file)
+
+        for file in files:
+            if file.id.startswith("ADF"):
+                aidId = int(file.id.replace("ADF", ""))
+                sw2 = self.simCtrl.selectAid(aidId=aidId)
+                if not sw2:
+                    logging.info("Failed to select AID: " + file.id)
+                    continue
+                sw1, sw2, file.fcp = self.simCtrl.getResponse(sw2)
+            if not file.fcp:
+                continue
+            dir.children.append(file)
+            self.files[file.path] = file
+        for file in dir.children:
+            if file.isDir():
+                self.enumerate(file)
+
+    def getReadApdus(self, file):
+        structure = self.simCtrl.getFileStructure(file.fcp)
+        if structure in [types.FILE_STRUCTURE_LINEAR_FIXED, types.FILE_STRUCTURE_CYCLIC]:
+            recordLength, nbrOfRecords = self.simCtrl.getRecordInfo(file.fcp)
+            return ["00B2%02X04%02X" %(record, recordLength)
+                    for record in range(1, nbrOfRecords + 1)]
+        length = types.getFileLength(file.fcp)
+        if not length:
+            return []
+        return ["00B0%04X%02X" %(offset, min(READ_BINARY_SIZE, length - offset))
+                for offset in range(0, length, READ_BINARY_SIZE)]
+
+    def readFiles(self, files):
+        """
+        Select and read the files in batches, one per ADF. Returns the
+        files which couldn't be read.
+        """
+        filesByAdf = collections.OrderedDict()
+        for file in files:
+            filesByAdf.setdefault(getAdfName(file.path), []).append(file)
+        deniedFiles = []
+        for adfName, files in filesByAdf.items():
+            if not self.selectAdf(adfName):
+                deniedFiles += files
+                continue
+            apdus = []
+            plan = []
+            for file in files:
+                readApdus = self.getReadApdus(file)
+                plan.append((file, len(readApdus)))
+                apdus += [getSelectApdu(file.path)] + readApdus
+            responses = self.transmit(apdus)
+            index = 0
+            for file, nbrOfReads in plan:
+                sw1, sw2, data = responses[index]
+                reads = responses[index + 1:index + 1 + nbrOfReads]
+                index += 1 + nbrOfReads
+                if types.assertSw(sw1, sw2, checkSw='NO_ERROR', log=False):
+                    # The reads were done on the previous file.
+                    logging.warning("Failed to select: " + file.path)
+                    continue
+                self.setCurrentFile(file)
+                value = []
+                for sw1, sw2, data in reads:
+                    if types.assertSw(sw1, sw2, checkSw='NO_ERROR', log=False):
+                        value = None
+                        break
+                    value += data
+                if value == None:
+                    deniedFiles.append(file)
+                else:
+                    file.data = value
+        return deniedFiles
+
+    def getArrFile(self, file):
+        """Path and record of the EF_ARR with the access rule of the file."""
+        arrFileId, arrRecord = types.getArrFileFromData(file.fcp)
+        if not arrFileId:
+            return None, None
+        if arrRecord == 0:
+            arrRecord = 1
+        # Searched in the DF of the file and its parents.
+        path = types.parentDirFromPath(file.path)
+        while True:
+            arrPath = self.getPath(self.files[path], arrFileId)
+            if arrPath in self.files and not self.files[arrPath].isDir():
+                return arrPath, arrRecord
+            if path == "/":
+                return None, None
+            path = types.parentDirFromPath(path)
+
+    def getArrRecord(self, arrPath, arrRecord):
+        arrFile = self.files[arrPath]
+        recordLength, nbrOfRecords = self.simCtrl.getRecordInfo(arrFile.fcp)
+        if not recordLength or arrRecord > nbrOfRecords:
+            return None
+        if arrFile.data:
+            offset = (arrRecord - 1) * recordLength
+            return arrFile.data[offset:offset + recordLength]
+        sw1, sw2, data = self.simCtrl.selectFileByPath(arrPath)
+        if not data:
+            return None
+        sw1, sw2, data = self.simCtrl.readCurrentFileRecord(data, arrRecord)
+        if types.assertSw(sw1, sw2, checkSw='NO_ERROR', log=False):
+            return None
+        return data[0]
+
+    def readDeniedFiles(self, files):
+        """Read the files with one condition check/ARR relaxation per EF_ARR record."""
+        filesByArr = collections.OrderedDict()
+        for file in files:
+            arrPath, arrRecord = self.getArrFile(file)
+            if not arrPath:
+                logging.warning("Failed to read: %s, EF_ARR not found" %file.path)
+                continue
+            filesByArr.setdefault((arrPath, arrRecord), []).append(file)
+
+        for (arrPath, arrRecord), files in filesByArr.items():
+            arrValue = self.getArrRecord(arrPath, arrRecord)
+            if not arrValue:
+                logging.warning("Failed to read record %d of %s" %(arrRecord, arrPath))
+                continue
+            conditions, condMode = types.getAccessConditions(arrValue, types.AM_EF_READ)
+            if (types.AC_UNKNOWN not in conditions and
+                    self.shell.verifyConditions(conditions, condMode)):
+                files = self.readFiles(files)
+                if not files:
+                    continue
+            if not self.shell.modifyArrConditions(arrPath, arrRecord, arrValue[:], types.AM_EF_READ):
+                for file in files:
+                    logging.warning("Failed to read: " + file.path)
+                continue
+            try:
+                files = self.readFiles(files)
+            finally:
+                self.shell.restoreArrConditions(arrPath, arrRecord, arrValue)
+            arrFile = self.files[arrPath]
+            if arrFile.data:
+                # EF_ARR read with the relaxed record.
+                recordLength, nbrOfRecords = self.simCtrl.getRecordInfo(arrFile.fcp)
+                offset = (arrRecord - 1) * recordLength
+                arrFile.data[offset:offset + recordLength] = arrValue
+            for file in files:
+                logging.warning("Failed to read: " + file.path)
 
     def addMf(self, node, data):
         arrFile, arrRecord = types.getArrFileFromData(data)
@@ -59,19 +321,45 @@ class SimBackup(object):
         #TODO: get from data
         invalidated = 0
         rwInvalidated = 0
-        sim_xml.addEfNode(node,
-                          id,
-                          sfi,
-                          str(struct),
-                          str(size),
-                          str(recordLength),
-                          value,
-                          arrFile,
-                          str(arrRecord),
-                          str(invalidated),
-                          str(rwInvalidated))
-
-    def saveXml(self):
-        xmlPath = os.path.dirname(__file__) + "/../sim_soft/sim_backup_" + self.imsi + ".xml"
-        sim_xml.writeXml(xmlPath, self.root)
-        return xmlPath
\ No newline at end of file
+        return sim_xml.addEfNode(node,
+                                 id,
+                                 sfi,
+                                 str(struct),
+                                 str(size),
+                                 str(recordLength),
+                                 value,
+                                 arrFile,
+                                 str(arrRecord),
+                                 str(invalidated),
+                                 str(rwInvalidated))
+
+    def writeDir(self, writer, dir):
+        for file in dir.children:
+            if file.isDir():
+                if file.id.startswith("ADF"):
+                    aid = hextools.bytes2hex(types.getAidFromData(file.fcp), separator="")
+                    node = self.addAdf(writer.root, file.id, aid, file.fcp)
+                else:
+                    node = self.addDf(writer.root, file.id, file.fcp)
+                writer.startDir(node)
+                self.writeDir(writer, file)
+                writer.endDir()
+            elif file.data:
+                writer.write(self.addEf(writer.root, file.id, hextools.bytes2hex(file.data), file.fcp))
+
+    def getValues(self):
+        """Values of the read EFs by path, e.g. /ADF0/6F07."""
+        values = collections.OrderedDict()
+        for file in self.getFiles(self.mf):
+            if not file.isDir() and file.data != None:
+                values[file.path] = hextools.bytes2hex(file.data)
+        return values
+
+    def saveXml(self, xmlPath=None):
+        if not xmlPath:
+            xmlPath = os.path.dirname(__file__) + "/../sim_soft/sim_backup_" + self.imsi + ".xml"
+        writer = sim_xml.XmlStreamWriter(xmlPath, self.atr)
+        writer.startDir(self.addMf(writer.root, self.mf.fcp))
+        self.writeDir(writer, self.mf)
+        writer.close()
+        return xmlPath
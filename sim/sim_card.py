@@ -17,6 +17,7 @@ class SimCard(object):
         self.currentAidId = None # TODO: consider logical channels
         self.currentFile = CurrentFile() # TODO: consider logical channels
         self.routingAttr = RoutingAttr()
+        self.fcpCache = FcpCache()
         self.swNoError = 0x9000
         self.type = type
         self.activeChannel = 0
@@ -40,6 +41,7 @@ class SimCard(object):
         self.simReader.addReader(index)
         self.simReader.r_createConnection(index)
         self.simReader.c_connect(index)
+        self.fcpCache.clear()
         self.clearLogicalChannels()
         self.getATR()
 
@@ -66,8 +68,19 @@ class SimCard(object):
 
     def reset(self):
         #TODO: implement different solution, takes too much time on  live SIM
-        self.disconnect()
-        self.connect(self.index)
+        try:
+            # Keep the reader and its card, e.g. the loaded soft card image.
+            self.simReader.c_disconnect(self.index)
+            self.simReader.c_connect(self.index)
+        except Exception as e:
+            logging.debug("Reconnect failed: %s" %str(e))
+            self.disconnect()
+            self.connect(self.index)
+            return
+        self.atr = None
+        self.fcpCache.clear()
+        self.clearLogicalChannels()
+        self.getATR()
 
     def getATR(self):
         self.atr = self.simReader.c_getATR(self.index)
@@ -99,6 +112,21 @@ class SimCard(object):
         self.updateSwNoError(sw1, sw2)
         return pack(data,sw1,sw2)
 
+    # Perform APDU requests on card in one reader call, see types.transmitMany()
+    def apduMany(self, c_apdus, stopOnError=False):
+        c_apdus = [list(hextools.bytes(c_apdu)) for c_apdu in c_apdus]
+        try:
+            responses = self.simReader.c_transmit_many(c_apdus, self.index, stopOnError)
+        except Exception as e:
+            logging.error(str(e) + "\n\n")
+            raise Exception("Failed to transmit C_APDUs: %s\n%s"
+                            %(", ".join([hextools.bytes2hex(c_apdu) for c_apdu in c_apdus]), str(e)))
+        rapdus = []
+        for data, sw1, sw2 in responses:
+            self.updateSwNoError(sw1, sw2)
+            rapdus.append(pack(data,sw1,sw2))
+        return rapdus
+
     def updateSwNoError(self, sw1, sw2):
         "cache last success"
         sw = types.packSw(sw1, sw2)
@@ -174,6 +202,19 @@ FILE_INS = [
     'UPDATE_RECORD'
     ]
 
+# Commands changing the FCP or the existence of the files
+FCP_INS = [
+    # PIN status template of the DF/ADF FCPs
+    'ENABLE_PIN',
+    'DISABLE_PIN',
+    'CREATE_FILE',
+    'DELETE_FILE',
+    'RESIZE_FILE',
+    'ACTIVATE_FILE',
+    'DEACTIVATE_FILE',
+    'APPEND_RECORD',
+    ]
+
 SAT_INS = [
     'TERMINAL_PROFILE',
     'TERMINAL_RESPONSE',
@@ -236,8 +277,32 @@ def pack(reply,sw1,sw2):
     p.append(sw2)
     return p
 
+# Routing rules compiled by SimRouter into its routing table
+ROUTING_RULES = ['insCommon', 'filesCommon', 'filesReplaced', 'insReplaced']
+
+class RoutingList(list):
+    """List of routing rules which notifies RoutingAttr about changes."""
+    def __init__(self, routingAttr, items):
+        list.__init__(self, items)
+        self.routingAttr = routingAttr
+
+def _notifyChange(name):
+    method = getattr(list, name)
+    def modify(self, *args):
+        result = method(self, *args)
+        self.routingAttr.version += 1
+        return result
+    return modify
+
+for _name in ['append', 'extend', 'insert', 'remove', 'pop', 'sort', 'reverse',
+              '__setitem__', '__delitem__', '__setslice__', '__delslice__',
+              '__iadd__', '__imul__']:
+    setattr(RoutingList, _name, _notifyChange(_name))
+
 class RoutingAttr(object):
     def __init__(self):
+        # Incremented on every change of the routing rules.
+        self.version = 0
         self.insCommon = list(INS_COMMON)
         self.filesCommon = list(FILES_AID)
         self.filesReplaced = list(FILES_REPLACED)
@@ -248,6 +313,12 @@ class RoutingAttr(object):
         self.aidToSelect = None
         self.recordEfDirLength = None
 
+    def __setattr__(self, name, value):
+        if name in ROUTING_RULES:
+            value = RoutingList(self, value)
+            self.version += 1
+        object.__setattr__(self, name, value)
+
     def getFileSelected(self, channel):
         for file in self.fileSelected:
             if not channel or file[1] == channel:
@@ -265,3 +336,27 @@ class CurrentFile(object):
     def __init__(self):
         self.path = "/"
         self.type = types_g.fileDescriptor.DF_OR_ADF
+
+class FcpCache(object):
+    """
+    FCPs of the files selected on the card, keyed by absolute path,
+    e.g. '/ADF0/6F07'. Files not found are kept with an empty FCP.
+    """
+    def __init__(self):
+        self.fcps = {}
+
+    def getKey(self, path):
+        path = path.rstrip("/")
+        if path.startswith("/3F00"):
+            path = path[len("/3F00"):]
+        return path or "/"
+
+    def getFcp(self, path):
+        """FCP of the file, [] if not found, None if not cached."""
+        return self.fcps.get(self.getKey(path))
+
+    def setFcp(self, path, fcp):
+        self.fcps[self.getKey(path)] = list(fcp)
+
+    def clear(self):
+        self.fcps.clear()
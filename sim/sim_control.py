@@ -0,0 +1,384 @@
+#!/usr/bin/python
+# LICENSE: GPL2
+
+# JSON-lines control protocol of the shell, for scripts sending many
+# commands. Every line is a request, responses are sent in order, so
+# requests can be pipelined without waiting for their responses.
+#
+# request:  {"id": 1, "method": "read", "params": {"path": "EF_IMSI"}}
+#           params can also be a list, as the shell arguments
+# response: {"id": 1, "ok": true, "status": "OK", "data": "08091010..."}
+#           {"id": 1, "ok": false, "status": "ERROR", "error": "..."}
+#
+# batch:    {"id": 2, "batch": [{"method": "read", "params": ["EF_IMSI"]}, ...]}
+#           response has the responses of the calls in "results". With
+#           "stream": true every response is sent when ready, with its
+#           "index" in the batch, followed by {"id": 2, "done": true}.
+#           With "stopOnError": true the batch stops at the first failed call.
+
+import sys,os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import errno
+import inspect
+import itertools
+import json
+import logging
+import select
+import socket
+import SocketServer
+import threading
+import time
+
+from sim import sim_shell
+
+CONTROL_PORT = 4160
+RECEIVE_SIZE = 65536
+# Bytes of responses buffered for a session before its requests are held back.
+OUTPUT_BACKLOG = 262144
+
+STATUS_OK = "OK"
+STATUS_NOK = "NOK"
+STATUS_ERROR = "ERROR"
+
+def getArgNames(method):
+    """Names of the shell command arguments and number of required ones."""
+    args, varargs, keywords, defaults = inspect.getargspec(method)
+    args = args[1:] # self
+    nbrOfDefaults = len(defaults or [])
+    return args, len(args) - nbrOfDefaults
+
+def toArg(value):
+    if value == None:
+        return None
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    # The shell parses its arguments from text.
+    return str(value)
+
+class ShellRpc(object):
+    """Calls the shell commands on the router main loop, serialized by a lock."""
+    def __init__(self, shell, lock=None):
+        self.shell = shell
+        self.lock = lock or threading.Lock()
+        self.methods = {}
+        for command in sim_shell.SimShell.commands:
+            self.methods[command] = getArgNames(getattr(sim_shell.SimShell, command))
+
+    def getArgs(self, method, params):
+        names, required = self.methods[method]
+        if params == None:
+            params = []
+        if isinstance(params, dict):
+            unknown = set(params.keys()) - set(names)
+            if unknown:
+                raise Exception("Unknown parameters: %s" %", ".join(sorted(unknown)))
+            args = [params.get(name) for name in names]
+            while args and args[-1] == None:
+                args.pop()
+        elif isinstance(params, list):
+            args = list(params)
+        else:
+            raise Exception("params must be a list or an object")
+        if len(args) > len(names):
+            raise Exception("%s takes at most %d parameters" %(method, len(names)))
+        missing = [names[i] for i in range(required) if i >= len(args) or args[i] == None]
+        if missing:
+            raise Exception("Missing parameters: %s" %", ".join(missing))
+        return [toArg(arg) for arg in args]
+
+    def call(self, request):
+        response = {}
+        if "id" in request:
+            response["id"] = request["id"]
+        startTime = time.time()
+        try:
+            method = request.get("method")
+            if method not in self.methods:
+                raise Exception("Unknown method: %s" %method)
+            args = self.getArgs(method, request.get("params"))
+            with self.lock:
+                status, out = self.shell.simCtrl.router.call(getattr(self.shell, method), *args)
+        except Exception as e:
+            response.update({"ok": False, "status": STATUS_ERROR, "error": str(e)})
+        else:
+            if status == "status OK":
+                response.update({"ok": True, "status": STATUS_OK})
+                if out:
+                    response["data"] = out[len("data "):] if out.startswith("data ") else out
+            else:
+                response.update({"ok": False, "status": STATUS_NOK})
+                if out:
+                    response["error"] = out
+        response["time"] = round(time.time() - startTime, 6)
+        return response
+
+    def handle(self, request, send):
+        """Send the response(s) of the request."""
+        if not isinstance(request, dict):
+            send({"ok": False, "status": STATUS_ERROR, "error": "Request must be an object"})
+            return
+        if "batch" not in request:
+            send(self.call(request))
+            return
+        stream = request.get("stream", False)
+        stopOnError = request.get("stopOnError", False)
+        results = []
+        ok = True
+        for index, call in enumerate(request["batch"]):
+            if not isinstance(call, dict):
+                result = {"ok": False, "status": STATUS_ERROR, "error": "Call must be an object"}
+            else:
+                result = self.call(call)
+            if stream:
+                result["index"] = index
+                if "id" in request:
+                    result["id"] = request["id"]
+                send(result)
+            else:
+                results.append(result)
+            ok = ok and result["ok"]
+            if stopOnError and not result["ok"]:
+                break
+        response = {"ok": ok}
+        if "id" in request:
+            response["id"] = request["id"]
+        if stream:
+            response["done"] = True
+        else:
+            response["results"] = results
+        send(response)
+
+class ControlSession(object):
+    """
+    Connection of a client, requests are handled when a line is complete.
+    The socket is non-blocking, responses are buffered until the client
+    reads them. While more than OUTPUT_BACKLOG bytes are buffered, no more
+    requests are handled or received, so a client not reading its
+    responses doesn't hold up the other sessions.
+    """
+    def __init__(self, server, connection):
+        self.server = server
+        self.connection = connection
+        self.buffer = ""
+        self.output = ""
+        # Set when the client has closed its side.
+        self.eof = False
+        connection.setblocking(False)
+        if server.address_family == socket.AF_INET:
+            # Responses are written unbuffered, don't delay them.
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def fileno(self):
+        return self.connection.fileno()
+
+    def readable(self):
+        return not self.eof and len(self.output) < OUTPUT_BACKLOG
+
+    def writable(self):
+        return bool(self.output)
+
+    def finished(self):
+        """All the requests are handled and responded after the client closed."""
+        return self.eof and not self.output and "\n" not in self.buffer
+
+    def send(self, response):
+        self.output += json.dumps(response) + "\n"
+        self.flush()
+
+    def flush(self):
+        """Send as much of the buffered output as the socket takes."""
+        while self.output:
+            try:
+                sent = self.connection.send(self.output)
+            except socket.error as e:
+                if e.args[0] in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                    return
+                raise
+            self.output = self.output[sent:]
+
+    def receive(self):
+        """Receive and handle the requests."""
+        try:
+            data = self.connection.recv(RECEIVE_SIZE)
+        except socket.error as e:
+            if e.args[0] in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                return
+            raise
+        if not data:
+            self.eof = True
+            return
+        self.buffer += data
+        self.handleRequests()
+
+    def handleRequests(self):
+        """Handle the complete lines until the output backlog is full."""
+        start = 0
+        while len(self.output) < OUTPUT_BACKLOG:
+            end = self.buffer.find("\n", start)
+            if end < 0:
+                break
+            line = self.buffer[start:end]
+            start = end + 1
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                self.send({"ok": False, "status": STATUS_ERROR, "error": "Invalid JSON: %s" %str(e)})
+            else:
+                self.server.rpc.handle(request, self.send)
+        self.buffer = self.buffer[start:]
+
+    def close(self):
+        self.server.shutdown_request(self.connection)
+
+class ControlServer(SocketServer.TCPServer):
+    """
+    Serves the shell on a TCP address (host, port) or a Unix socket path.
+    All connections are served by the thread calling serve_forever(),
+    commands are executed one at a time.
+    """
+    allow_reuse_address = True
+
+    def __init__(self, shell, address=("127.0.0.1", CONTROL_PORT)):
+        self.rpc = ShellRpc(shell)
+        if isinstance(address, basestring):
+            self.address_family = socket.AF_UNIX
+            if os.path.exists(address):
+                os.remove(address)
+        SocketServer.TCPServer.__init__(self, address, None)
+        self.sessions = []
+        self.closing = False
+        self.stopped = threading.Event()
+        self.stopped.set()
+        logging.info("Control server %s started" %str(self.server_address))
+
+    def process_request(self, request, client_address):
+        # Keep the connection open, it's served by serve_forever().
+        self.sessions.append(ControlSession(self, request))
+
+    def serve_forever(self, poll_interval=0.5):
+        self.stopped.clear()
+        try:
+            while not self.closing:
+                readers = [self] + [session for session in self.sessions if session.readable()]
+                writers = [session for session in self.sessions if session.writable()]
+                try:
+                    readable, writable = select.select(readers, writers, [], poll_interval)[:2]
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if self in readable:
+                    readable.remove(self)
+                    self._handle_request_noblock()
+                for session in set(readable + writable):
+                    try:
+                        if session in writable:
+                            session.flush()
+                            # Continue with the requests held back by the backlog.
+                            session.handleRequests()
+                        if session in readable:
+                            session.receive()
+                        connected = not session.finished()
+                    except socket.error as e:
+                        logging.warning("Control session closed: %s" %str(e))
+                        connected = False
+                    if not connected:
+                        self.sessions.remove(session)
+                        session.close()
+        finally:
+            for session in self.sessions:
+                session.close()
+            self.sessions = []
+            self.stopped.set()
+
+    def close(self):
+        self.closing = True
+        self.stopped.wait()
+        self.server_close()
+        if self.address_family == socket.AF_UNIX and os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+class ControlClient(object):
+    def __init__(self, address=("127.0.0.1", CONTROL_PORT), timeout=None):
+        if isinstance(address, basestring):
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.settimeout(timeout)
+        self.socket.connect(address)
+        self.file = self.socket.makefile("rb")
+        self.ids = itertools.count(1)
+
+    def send(self, requests):
+        self.socket.sendall("".join([json.dumps(request) + "\n" for request in requests]))
+
+    def receive(self):
+        line = self.file.readline()
+        if not line:
+            raise Exception("Connection closed")
+        return json.loads(line)
+
+    def request(self, method, params=None):
+        request = {"id": next(self.ids), "method": method}
+        if params != None:
+            request["params"] = params
+        return request
+
+    def call(self, method, *args, **kwargs):
+        """Returns the response of a shell command."""
+        self.send([self.request(method, kwargs or list(args))])
+        return self.receive()
+
+    def pipeline(self, calls):
+        """
+        Send all (method, params) calls without waiting for the responses,
+        returns the responses in order. The calls are sent by another
+        thread while the responses are read, so neither side blocks on
+        full socket buffers.
+        """
+        requests = [self.request(method, params) for method, params in calls]
+        errors = []
+        def sendRequests():
+            try:
+                self.send(requests)
+            except Exception as e:
+                errors.append(e)
+        sender = threading.Thread(target=sendRequests, name="ControlClientSender")
+        sender.setDaemon(True)
+        sender.start()
+        try:
+            responses = [self.receive() for request in requests]
+        except:
+            # Don't leave the sender blocked on the broken connection.
+            self.socket.shutdown(socket.SHUT_RDWR)
+            raise
+        finally:
+            sender.join()
+        if errors:
+            raise errors[0]
+        return responses
+
+    def batch(self, calls, stopOnError=False):
+        """Calls executed in one request, returns their responses."""
+        request = {"id": next(self.ids), "stopOnError": stopOnError,
+                   "batch": [self.request(method, params) for method, params in calls]}
+        self.send([request])
+        return self.receive()["results"]
+
+    def stream(self, calls, stopOnError=False):
+        """Same as batch(), yields every response when received."""
+        request = {"id": next(self.ids), "stream": True, "stopOnError": stopOnError,
+                   "batch": [self.request(method, params) for method, params in calls]}
+        self.send([request])
+        while True:
+            response = self.receive()
+            if response.get("done"):
+                return
+            yield response
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
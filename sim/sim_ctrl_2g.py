@@ -104,6 +104,23 @@ class SimCtrl(object):
         return self.router.getCardDictFromId(self.srvId)[sim_router.CTRL_INTERFACE]
 
     def sendApdu(self, apdu, channel=None, mode=1): #TODO: why can't be used sim_router.INJECT_WITH_FORWARD
+        apdu = self.setApduChannel(apdu, channel)
+        rapdu = self.router.injectApdu(apdu, self.getSrvCtr(), mode=mode)
+        return types.sw1(rapdu), types.sw2(rapdu), types.responseData(rapdu)
+
+    def sendApdus(self, apdus, stopOnError=False, channel=None):
+        """
+        Send APDUs to the card in one request. GET RESPONSE on 61XX/9FXX
+        and repeating with Le from 6CXX is done by the reader. Returns
+        (sw1, sw2, data) for each APDU, up to the first error if
+        stopOnError is set.
+        """
+        apdus = [self.setApduChannel(apdu, channel) for apdu in apdus]
+        rapdus = self.router.injectApdus(apdus, self.getSrvCtr(), stopOnError)
+        return [(types.sw1(rapdu), types.sw2(rapdu), types.responseData(rapdu))
+                for rapdu in rapdus]
+
+    def setApduChannel(self, apdu, channel=None):
         cla = int(apdu[0:2], 16)
         if cla & 0xF0:
             cla = cla & 0xF0
@@ -121,8 +138,7 @@ class SimCtrl(object):
         if logicalChannel and not cla & 0x0F:
             cla = cla | (self.logicalChannel & 0x0F)
             apdu = "%02X%s" %(int(cla), apdu[2:])
-        rapdu = self.router.injectApdu(apdu, self.getSrvCtr(), mode=mode)
-        return types.sw1(rapdu), types.sw2(rapdu), types.responseData(rapdu)
+        return apdu
 
     def getDfGsmResponse(self):
         #SELECT_FILE MF
@@ -365,6 +381,9 @@ class SimCtrl(object):
     def getCurrentFile(self):
         return self.getSrvCtr().getCurrentFile()
 
+    def getFcpCache(self):
+        return self.getSrvCtr().fcpCache
+
     def getCurrentFilePath(self):
         return self.getSrvCtr().getCurrentFilePath()
 
@@ -446,12 +465,17 @@ class SimCtrl(object):
             return sw1, sw2, []
         length = tagData[1]
         '''
-        dataRecord = []
+        apdus = []
         for id in range(startRecord, endRecord+1):
-            sw1, sw2, data = self.sendApdu("A0B2%02X04%02X" %(id, recordLength))
+            apdus.append("A0B2%02X04%02X" %(id, recordLength))
+        if not apdus:
+            # No records to read.
+            sw = types_g.sw.GSM_INVALID_DATA_ADDRESS
+            return sw >> 8, sw & 0xFF, []
+        dataRecord = []
+        for sw1, sw2, data in self.sendApdus(apdus, stopOnError=True):
             dataRecord.extend([data])
-            if types.assertSw(sw1, sw2, checkSw='NO_ERROR'):
-                break
+        types.assertSw(sw1, sw2, checkSw='NO_ERROR')
         return sw1, sw2, dataRecord
 
     def readFileRecord(self, fid, recordId=0xFF):
@@ -670,16 +694,21 @@ class SimCtrl(object):
             startRecord = recordId
             endRecord = recordId
 
+        apdus = []
         i = 0
         for id in range(startRecord, endRecord+1):
             if len(records) < i+1:
                 record = types.addTrailingBytes('', 0xFF, recordLength)
             else:
                 record = types.addTrailingBytes(records[i], 0xFF, recordLength)
-            sw1, sw2, data = self.sendApdu("A0DC%02X04%02X%s" %(id, recordLength, record))
-            if types.assertSw(sw1, sw2, checkSw='NO_ERROR'):
-                break
+            apdus.append("A0DC%02X04%02X%s" %(id, recordLength, record))
             i += 1
+        if not apdus:
+            # No records to write.
+            sw = types_g.sw.GSM_INVALID_DATA_ADDRESS
+            return sw >> 8, sw & 0xFF, []
+        sw1, sw2, data = self.sendApdus(apdus, stopOnError=True)[-1]
+        types.assertSw(sw1, sw2, checkSw='NO_ERROR')
         return sw1, sw2, data
 
     def writeFileRecord(self, fid, value, recordId=0xFF):
@@ -103,6 +103,23 @@ class SimCtrl(object):
 
     def sendApdu(self, apdu, channel=None, mode=1): # 1-sim_router.INJECT_NO_FORWARD
         #TODO: add 'check=False, sw=0x9000' arguments
+        apdu = self.setApduChannel(apdu, channel)
+        rapdu = self.router.injectApdu(apdu, self.getSrvCtr(), mode=mode)
+        return types.sw1(rapdu), types.sw2(rapdu), types.responseData(rapdu)
+
+    def sendApdus(self, apdus, stopOnError=False, channel=None):
+        """
+        Send APDUs to the card in one request. GET RESPONSE on 61XX/9FXX
+        and repeating with Le from 6CXX is done by the reader. Returns
+        (sw1, sw2, data) for each APDU, up to the first error if
+        stopOnError is set.
+        """
+        apdus = [self.setApduChannel(apdu, channel) for apdu in apdus]
+        rapdus = self.router.injectApdus(apdus, self.getSrvCtr(), stopOnError)
+        return [(types.sw1(rapdu), types.sw2(rapdu), types.responseData(rapdu))
+                for rapdu in rapdus]
+
+    def setApduChannel(self, apdu, channel=None):
         cla = int(apdu[0:2], 16)
         ctrlSrv = self.getSrvCtr()
         mainSrv = self.router.getRelatedMainCard(ctrlSrv)
@@ -118,8 +135,7 @@ class SimCtrl(object):
         if logicalChannel and not cla & 0x0F:
             cla = cla | (logicalChannel & 0x0F)
             apdu = "%02X%s" %(int(cla), apdu[2:])
-        rapdu = self.router.injectApdu(apdu, self.getSrvCtr(), mode=mode)
-        return types.sw1(rapdu), types.sw2(rapdu), types.responseData(rapdu)
+        return apdu
 
     def getDfGsmResponse(self):
         #SELECT_FILE DF_GSM
@@ -206,11 +222,14 @@ class SimCtrl(object):
         #GET_RESPONSE
         sw1, sw2, data = self.sendApdu("00C00000%02X" %length)
         if not types.assertSw(sw1, sw2, checkSw='NO_ERROR'):
-            fileDescriptor = types.parseFcpTlv(data, types_g.selectTag.FILE_DESCRIPTOR)
-            fileType = fileDescriptor[0]
-            self.setCurrentFileType(fileType)
+            self.updateCurrentFileType(data)
         return sw1, sw2, data
 
+    def updateCurrentFileType(self, data):
+        fileDescriptor = types.parseFcpTlv(data, types_g.selectTag.FILE_DESCRIPTOR)
+        fileType = fileDescriptor[0]
+        self.setCurrentFileType(fileType)
+
     def selectFile(self, fid):
         #SELECT_FILE
         sw1, sw2, data = self.sendApdu("00A4000402%s" %fid)
@@ -322,6 +341,9 @@ class SimCtrl(object):
     def getCurrentFile(self):
         return self.getSrvCtr().getCurrentFile()
 
+    def getFcpCache(self):
+        return self.getSrvCtr().fcpCache
+
     def getCurrentFilePath(self):
         return self.getSrvCtr().getCurrentFilePath()
 
@@ -417,12 +439,17 @@ class SimCtrl(object):
             return sw1, sw2, []
         length = tagData[1]
         '''
-        dataRecord = []
+        apdus = []
         for id in range(startRecord, endRecord+1):
-            sw1, sw2, data = self.sendApdu("00B2%02X04%02X" %(id, recordLength))
+            apdus.append("00B2%02X04%02X" %(id, recordLength))
+        if not apdus:
+            # No records to read.
+            sw = types_g.sw.INVALID_DATA_ADDRESS
+            return sw >> 8, sw & 0xFF, []
+        dataRecord = []
+        for sw1, sw2, data in self.sendApdus(apdus, stopOnError=True):
             dataRecord.extend([data])
-            if types.assertSw(sw1, sw2, checkSw='NO_ERROR'):
-                break
+        types.assertSw(sw1, sw2, checkSw='NO_ERROR')
         return sw1, sw2, dataRecord
 
     def readFileRecord(self, fid, recordId=0xFF):
@@ -464,16 +491,21 @@ class SimCtrl(object):
         else:
             startRecord = recordId
             endRecord = recordId
+        apdus = []
         i = 0
         for id in range(startRecord, endRecord+1):
             if len(records) < i+1:
                 record = types.addTrailingBytes('', 0xFF, recordLength)
             else:
                 record = types.addTrailingBytes(records[i], 0xFF, recordLength)
-            sw1, sw2, data = self.sendApdu("00DC%02X04%02X%s" %(id, recordLength, record))
-            if types.assertSw(sw1, sw2, checkSw='NO_ERROR'):
-                break
+            apdus.append("00DC%02X04%02X%s" %(id, recordLength, record))
             i += 1
+        if not apdus:
+            # No records to write.
+            sw = types_g.sw.INVALID_DATA_ADDRESS
+            return sw >> 8, sw & 0xFF, []
+        sw1, sw2, data = self.sendApdus(apdus, stopOnError=True)[-1]
+        types.assertSw(sw1, sw2, checkSw='NO_ERROR')
         return sw1, sw2, data
 
     def writeFileRecord(self, path, value, recordId=0xFF):
@@ -522,27 +554,41 @@ class SimCtrl(object):
                             return None, None, []
                     path = path.replace(_file, "7FFF")
                     break # handle only the first occurence of ADF
-            # Select file using its absolute path (starting from MF).
+            # Select file using its absolute path (starting from MF) and
+            # get its FCP in one request.
             path = path.replace("/", "")
             path = path.replace("3F00", "")
-            sw1, sw2, data = self.selectFileFromMf(path)
-            if types.assertSw(sw1, sw2, checkSw1='RESPONSE_DATA_AVAILABLE_3G'):
+            if self.getFcpCache().getFcp(self.getPathFromFids(path)) == []:
+                # Known not to exist, the current file is not changed.
+                sw = types_g.sw.FILE_NOT_FOUND
+                return sw >> 8, sw & 0xFF, []
+            sw1, sw2, data = self.sendApdus(["00A40804%02X%s" %(len(path)/2, path)])[0]
+            if types.assertSw(sw1, sw2, checkSw='NO_ERROR'):
                 return sw1, sw2, []
+            self.setCurrentFilePath(self.getPathFromFids(path))
+            # Update current dir type based on response.
+            self.updateCurrentFileType(data)
+            return sw1, sw2, data
         # Update current dir type based on response.
         sw1, sw2, data = self.getResponse(sw2)
         return sw1, sw2, data
 
     def listFiles(self):
-        path = self.getCurrentDirPath()
+        dirPath = self.getCurrentDirPath()
+        path = dirPath
         if path == "/":
             path = "3F00"
         path += "/"
-        fidCurrentDir =  types.fidFromPath(path)
-        formatCurrentDir = types.getFileNameFormat(fidCurrentDir)
-        if formatCurrentDir == types.FILE_FORMAT_ADF_ID:
-            fidCurrentDir = "7FFF" #current aid
+        fidsCurrentDir = ""
+        for fid in types.getFilesFromPath(dirPath):
+            if fid in ["", "3F00"]:
+                continue
+            if types.getFileNameFormat(fid) == types.FILE_FORMAT_ADF_ID:
+                fid = "7FFF" #current aid
+            fidsCurrentDir += fid
         filesToCheck = self.simFiles.findAllChildFiles(path)
         files = []
+        filesToSelect = []
         for file in filesToCheck:
             fid =  types.fidFromPath(file)
             format = types.getFileNameFormat(file)
@@ -552,13 +598,30 @@ class SimCtrl(object):
                     files.append(file)
                 #no update of current dir is needed. Just continue
                 continue
-            sw1, sw2, data = self.selectFile(fid)
-            if sw1 != types_g.sw1.RESPONSE_DATA_AVAILABLE_3G:
-                continue
-            files.append(file)
-            sw1, sw2, data = self.selectFile(fidCurrentDir)
-            if types.assertSw(sw1, sw2, checkSw1='RESPONSE_DATA_AVAILABLE_3G'):
-                raise Exception("Failed to select current dir")
+            # Files selected before are listed without selecting them again.
+            fcp = self.getFcpCache().getFcp(dirPath.rstrip("/") + "/" + fid)
+            if fcp == None:
+                filesToSelect.append(file)
+            if fcp != []:
+                files.append(file)
+        if not filesToSelect:
+            return files
+        # Select the files by path and then the current dir in one request.
+        apdus = []
+        for file in filesToSelect:
+            fids = fidsCurrentDir + types.fidFromPath(file)
+            apdus.append("00A40804%02X%s" %(len(fids)/2, fids))
+        if fidsCurrentDir:
+            apdus.append("00A40804%02X%s" %(len(fidsCurrentDir)/2, fidsCurrentDir))
+        else:
+            apdus.append("00A40004023F00")
+        responses = self.sendApdus(apdus)
+        for file, (sw1, sw2, data) in zip(filesToSelect, responses):
+            if types.assertSw(sw1, sw2, checkSw='NO_ERROR', log=False):
+                files.remove(file)
+        sw1, sw2, data = responses[-1]
+        if types.assertSw(sw1, sw2, checkSw='NO_ERROR'):
+            raise Exception("Failed to select current dir")
         return files
 
     def readFile(self, file):
@@ -606,15 +669,22 @@ class SimCtrl(object):
             return False
         return True
 
+    def getFileFcp(self, path):
+        # The file is selected only if its FCP is not cached.
+        data = self.getFcpCache().getFcp(path)
+        if data == None:
+            sw1, sw2, data = self.selectFileByPath(path)
+        return data
+
     def getLinkedArrFile(self, path):
-        sw1, sw2, data = self.selectFileByPath(path)
+        data = self.getFileFcp(path)
         if not data:
             logging.error("Failed to select: %s" %path)
             return None, None
         return types.getArrFileFromData(data)
 
     def getSecurityAttrib(self, path):
-        sw1, sw2, data = self.selectFileByPath(path)
+        data = self.getFileFcp(path)
         if not data:
             logging.error("Failed to select: %s" %path)
             return None
@@ -751,30 +821,20 @@ class SimCtrl(object):
             logging.warning("Arr record number is 0 for file: " + path +
                             ". Use first record (1) instead.")
             arrRecord = 1
-        if types.cmpBitwise(self.getCurrentFileType(), types_g.fileDescriptor.DF_OR_ADF):
-            sw1, sw2, data = self.selectParentDir()
-            if types.assertSw(sw1, sw2, checkSw1='RESPONSE_DATA_AVAILABLE_3G', log=False) and \
-                types.assertSw(sw1, sw2, checkSw='NO_ERROR'):
-                logging.error("Failed to select parent dir")
-                return None, None
-
-        sw1, sw2, data = self.readFileRecord(arrFileId, arrRecord)
-        sw1Name, swReceived = types.swName(sw1, sw2)
-        if swReceived == 'FILE_NOT_FOUND':
-            # Searching for EF_ARR in parent dir.
-            # FIXME: it may never enter here as the Arr file is selected
-            #        by FID and it will be searched in parent DF as well.
-            sw1, sw2, data = self.selectParentDir()
-            if types.assertSw(sw1, sw2, checkSw1='RESPONSE_DATA_AVAILABLE_3G', log=False) and \
-                types.assertSw(sw1, sw2, checkSw='NO_ERROR'):
-                logging.error("Failed to select parent dir")
-                return None, None
+        # EF_ARR is searched in the DF of the file (the parent DF for a DF)
+        # and then in its parent dirs.
+        dirPath = types.parentDirFromPath(path)
+        while True:
+            sw1, sw2, data = self.selectFileByPath(dirPath.rstrip("/") + "/" + arrFileId)
+            if (data or dirPath == "/" or sw1 == None or
+                    types.packSw(sw1, sw2) != types_g.sw.FILE_NOT_FOUND):
+                break
+            dirPath = types.parentDirFromPath(dirPath)
+        if not data:
+            logging.warning("EF_ARR not found for file: " + path)
+            return None, None
 
-            sw1, sw2, data = self.readFileRecord(arrFileId, arrRecord)
-            sw1Name, swReceived = types.swName(sw1, sw2)
-            if swReceived == 'FILE_NOT_FOUND':
-                logging.warning("EF_ARR not found in parent dir")
-                return None, None
+        sw1, sw2, data = self.readCurrentFileRecord(data, arrRecord)
         if types.assertSw(sw1, sw2, checkSw='NO_ERROR'):
             return None, None
         arrValue = data[0]
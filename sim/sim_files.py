@@ -13,12 +13,86 @@ from util import types
 from util import types_g
 
 
+class SimFileEntry(object):
+    __slots__ = ("node", "id", "name", "xmlPath", "path", "parent")
+
 class SimFiles(object):
     def __init__(self, type):
         self.simType = type
         self.simXml = SimFilesXml(self.simType)
         self.adfs = None
         self.currentDirPath = "/"
+        # Resolved paths, cleared when the ADFs change.
+        self.pathCache = {}
+        self.buildIndex()
+
+    def buildIndex(self):
+        """
+        Index the files of the xml, so lookups by name or FID do not walk
+        the tree: entry of every file by node, entries by name and FID in
+        every directory (see getDirIndex()) and in the directories of
+        getDirsToSearch(), in that order.
+        """
+        self.entries = {}
+        self.dirIndex = {}
+        for node in self.simXml.root.iter("*"):
+            nodeId = node.attrib.get('id')
+            if not nodeId:
+                #not every node has id, e.g. <name>ADF_ISIM</name>
+                continue
+            entry = SimFileEntry()
+            entry.node = node
+            entry.id = nodeId
+            entry.name = self.getNameFromNode(node)
+            entry.xmlPath = self.simXml.getPathFromNode(node)
+            entry.path = self.simXml.getPathFromXml(entry.xmlPath)
+            # Parents are iterated first.
+            entry.parent = self.entries.get(node.getparent())
+            self.entries[node] = entry
+        self.namesInDirs = {}
+        self.idsInDirs = {}
+        for dir in self.getDirsToSearch():
+            root, _xmlPath = self.findFileOrDirectory(dir)
+            if root == None:
+                continue
+            names, ids = self.getDirIndex(root)
+            for name, entry in names.iteritems():
+                self.namesInDirs.setdefault(name, entry)
+            for id, entry in ids.iteritems():
+                self.idsInDirs.setdefault(id, entry)
+
+    def getDirIndex(self, root):
+        """First entry by name and by FID in root.iter() order."""
+        if root in self.dirIndex:
+            return self.dirIndex[root]
+        names = {}
+        ids = {}
+        for node in root.iter("*"):
+            entry = self.entries.get(node)
+            if not entry:
+                continue
+            if entry.name:
+                names.setdefault(entry.name, entry)
+            ids.setdefault(entry.id, entry)
+        self.dirIndex[root] = names, ids
+        return names, ids
+
+    def getCacheKey(self, path):
+        if path and path.startswith("."):
+            # Relative to the current directory.
+            return path, self.currentDirPath
+        return path
+
+    def getCachedPath(self, key):
+        return self.pathCache.get(key)
+
+    def cachePath(self, key, path):
+        """Cache a resolved path, e.g. of the shell, until the ADFs change."""
+        if path:
+            self.pathCache[key] = path
+
+    def clearCache(self):
+        self.pathCache = {}
 
     def resolveAdfs(self, efDirData):
         adfs = {}
@@ -34,6 +108,8 @@ class SimFiles(object):
         isimAdfId = self.getAdfIdFromRecords(types_g.adfName.ADF_ISIM, efDirRecords)
         if isimAdfId:
             adfs.update({isimAdfId : types_g.adfName[types_g.adfName.ADF_ISIM]})
+        if adfs != self.adfs:
+            self.clearCache()
         self.adfs = adfs
 
     def getCurrentDirPath(self):
@@ -88,6 +164,14 @@ class SimFiles(object):
         return dirs
 
     def getPathFromRawPath(self, rawPath):
+        key = ("raw", self.getCacheKey(rawPath))
+        path = self.getCachedPath(key)
+        if not path:
+            path = self.resolveRawPath(rawPath)
+            self.cachePath(key, path)
+        return path
+
+    def resolveRawPath(self, rawPath):
         dir = types.parentDirFromPath(rawPath)
         name = types.fidFromPath(rawPath)
         format = types.getFileNameFormat(name)
@@ -111,26 +195,18 @@ class SimFiles(object):
              return path
 
     def findFileByNameInDirs(self, name):
-        dirs = self.getDirsToSearch()
-        for dir in dirs:
-            node, xmlPath = self.findFileByName(dir, name)
-            if node != None:
-                break
-        if node == None:
+        entry = self.namesInDirs.get(name)
+        if not entry:
             logging.warning("Name: %s not resolved" %name)
             return None
-        return self.simXml.getPathFromXml(xmlPath)
+        return entry.path
 
     def findFileByIdInDirs(self, id):
-        dirs = self.getDirsToSearch()
-        for dir in dirs:
-            node, xmlPath = self.findFileById(dir, id)
-            if node != None:
-                break
-        if node == None:
+        entry = self.idsInDirs.get(id)
+        if not entry:
             logging.warning("Name: %s not resolved" %id)
             return None
-        return self.simXml.getPathFromXml(xmlPath)
+        return entry.path
 
     def parsePath(self, path):
         path = path.upper()
@@ -211,29 +287,31 @@ class SimFiles(object):
         if root == None:
             logging.debug("Failed to select: %s/%s" %(path, name))
             return None, None
-        for node in root.iter("*"):
-            if self.getNameFromNode(node) == name:
-                xmlPath = self.simXml.getPathFromNode(node)
-                return node, xmlPath
-        return None, None
+        entry = self.getDirIndex(root)[0].get(name)
+        if not entry:
+            return None, None
+        return entry.node, entry.xmlPath
 
     def findFileById(self, path, id):
         root, _xmlPath = self.findFileOrDirectory(path)
         if root == None:
             logging.error("Failed to select: %s/%s" %(path, id))
             return None, None
-        for node in root.iter("*"):
-            try:
-                nodeId = node.attrib['id']
-            except:
-                #not every node has id, e.g. <name>ADF_ISIM</name>
-                continue
-            if nodeId == id:
-                xmlPath = self.simXml.getPathFromNode(node)
-                return node, xmlPath
-        return None, None
+        entry = self.getDirIndex(root)[1].get(id)
+        if not entry:
+            return None, None
+        return entry.node, entry.xmlPath
 
     def findFileOrDirectory(self, path):
+        key = ("node", self.getCacheKey(path))
+        found = self.getCachedPath(key)
+        if not found:
+            found = self.resolveFileOrDirectory(path)
+            if found[0] != None:
+                self.cachePath(key, found)
+        return found
+
+    def resolveFileOrDirectory(self, path):
         path = self.getFilePath(path)
         if not path:
             return None, None
@@ -261,9 +339,24 @@ class SimFiles(object):
             return None
         return self.simXml.get(node, "name")
 
+    def getFidNames(self):
+        """Name by FID, searched in the order of getDirsToSearch()."""
+        return dict([(id, entry.name) for id, entry in self.idsInDirs.iteritems()
+                     if entry.name])
+
     def getNameFromFid(self, fid):
-        path = self.findFileByIdInDirs(fid)
-        return self.getNameFromPath(path)
+        entry = self.idsInDirs.get(fid)
+        if not entry or not entry.name:
+            raise Exception("Name of %s not found" %fid)
+        return entry.name
+
+    def getParentPath(self, path):
+        """Path of the directory containing the file."""
+        node, _xmlPath = self.findFileOrDirectory(path)
+        entry = self.entries.get(node)
+        if not entry or not entry.parent:
+            return None
+        return entry.parent.path
 
     def getNameFromNode(self, node):
         try:
@@ -5,9 +5,13 @@
 
 import logging
 import os
+import Queue
 import threading
 import time
 
+import gevent
+import gevent.event
+import gevent.pool
 import usb
 import plac
 
@@ -16,6 +20,7 @@ import sim_ctrl_2g
 import sim_ctrl_3g
 import sim_reader
 import sim_card
+import apdu_trace
 
 from util import types_g
 from util import types
@@ -25,6 +30,8 @@ ROUTER_MODE_DISABLED = 0
 ROUTER_MODE_INTERACTIVE = 1
 ROUTER_MODE_TELNET = 2
 ROUTER_MODE_DBUS = 3
+# JSON-lines control server, see sim_control.py
+ROUTER_MODE_CONTROL = 4
 
 _version_ = 1.1
 
@@ -50,10 +57,21 @@ INJECT_READY = 0
 INJECT_NO_FORWARD = 1
 INJECT_WITH_FORWARD = 2
 INJECT_RESET = 3
+# Seconds to wait for the R-APDU of an injected C-APDU, queueing included.
+INJECT_TIMEOUT = 30
+INJECT_CHECK_INTERVAL = 1 #sec
 
 TRY_ANOTHER_CARD_ON_AUTH_FAILURE = True
 
+# Adaptive polling of SIMtrace. After an APDU the poll interval starts
+# from POLL_INTERVAL_MIN and doubles on every idle poll up to POLL_INTERVAL_MAX.
+POLL_INTERVAL_MIN = 0.001 #sec
+POLL_INTERVAL_MAX = 0.02 #sec
+USB_RETRIES = 3
+USB_RETRY_DELAY = 0.01 #sec
+
 LOG_NONE_APDU_IN_FILE = True
+APDU_LOG_FILE = os.path.join(os.path.dirname(__file__), "../apdu.log")
 
 
 class SimRouter(object):
@@ -63,6 +81,10 @@ class SimRouter(object):
                  type=types.TYPE_USIM,
                  mode=SIMTRACE_ONLINE):
         self.loggingApdu = self.setupLogger()
+        # APDUs are logged by the trace writer thread.
+        self.trace = apdu_trace.ApduTrace()
+        self.trace.addSink(apdu_trace.TextSink(self.loggingApdu, self.fileName))
+        self.capture = None
         if LOG_NONE_APDU_IN_FILE:
             self.logging = self.loggingApdu
         else:
@@ -75,8 +97,8 @@ class SimRouter(object):
         self.lastUpdate = 0
 
         self.apduInjectedCard = None
-        self.apduInjectedData = None
         self.interpreter = None
+        self.controlServer = None
         self.routerMode = ROUTER_MODE_DISABLED
 
         if self.mode != SIMTRACE_OFFLINE:
@@ -86,10 +108,34 @@ class SimRouter(object):
                 self.mode = SIMTRACE_OFFLINE
         self.simCtrl = None
         self.loop = None
+        # Set by close() to stop the main loop.
+        self.stopped = False
+        # Set while the main loop takes injected APDUs and calls, under injectLock.
+        self.loopRunning = False
+        self.injectLock = threading.Lock()
+        # Thread and greenlet polling SIMtrace, see mainloop().
+        self.loopThread = None
+        self.pollGreenlet = None
+        # Greenlets running on the main loop, see call() and spawnCall().
+        self.tasks = None
+        # LoopCall requests of other threads, spawned by the main loop.
+        self.callQueue = Queue.Queue()
+        # Hub watcher waking up the main loop from other threads.
+        self.wakeupWatcher = None
+        # (deadline, timeout, InjectedApdu) of the waiting threads.
+        self.timedInjected = []
+        self.timeoutThread = None
         self.shell = None
         self.lock = threading.Lock()
-        self.rapduInject = None
-        self.inject = INJECT_READY
+        # Pending InjectedApdu requests, handled by the main loop in order.
+        self.injectQueue = Queue.Queue()
+        self.routingTable = None
+        # Set to wake up the main loop before the poll interval elapses.
+        self.wakeup = None
+        self.pollInterval = POLL_INTERVAL_MIN
+        self.latency = ApduLatency()
+        # Source of recorded C-APDUs in SIMTRACE_OFFLINE mode, see apdu_replay.
+        self.replay = None
 
     def addControlCard(self, cards):
         cardDicts = []
@@ -105,6 +151,8 @@ class SimRouter(object):
             #cardCtrl.swNoError = cardMain.swNoError
             cardCtrl.type = cardMain.type
             cardCtrl.logicalChannelClosed = cardMain.logicalChannelClosed
+            # Both interfaces access the same files.
+            cardCtrl.fcpCache = cardMain.fcpCache
 
             # Do not apply ins and file forwarding rules on control interface.
             cardCtrl.removeRoutingAttr()
@@ -129,26 +177,30 @@ class SimRouter(object):
     def receiveData(self, cmd):
         if self.mode == SIMTRACE_OFFLINE:
             return []
-        try:
-            return self.usbCtrlIn(cmd)
-        except:
-            time.sleep(0.2)
-            return self.usbCtrlIn(cmd)
+        for retry in range(USB_RETRIES):
+            try:
+                return self.usbCtrlIn(cmd)
+            except:
+                if retry == USB_RETRIES - 1:
+                    raise
+                time.sleep(USB_RETRY_DELAY * (retry + 1))
 
     def sendData(self, msg):
         return self.usbCtrlOut(CMD_R_APDU, msg)
 
     def resetCards(self, soft=True):
+        for cardDict in self.cardsDict:
+            cardDict[MAIN_INTERFACE].fcpCache.clear()
         if soft:
-            resetThread = ResetThread(self)
-            resetThread.setDaemon(True)
-            # Start handling C-APDUs.
-            resetThread.start()
+            # Runs on the main loop between the C-APDUs of the phone.
+            self.spawn(self.softResetTask())
         else:
             for cardDict in self.cardsDict:
                 cardDict[MAIN_INTERFACE].reset()
 
     def receiveCommandApdu(self):
+        if self.replay:
+            return self.replay.receiveCommandApdu()
         msg = []
         # FIXME: This is the main event loop.  Move it to top level.
         msg = list(self.receiveData(CMD_POLL))
@@ -163,20 +215,33 @@ class SimRouter(object):
         elif evt == EVT_UNKNOWN:
             return None, None
         else:
-            self.loggingApdu.info("unknown event: %s\n" % hextools.bytes2hex(msg))
+            self.logEvent(logging.INFO, "unknown event: %s\n" % hextools.bytes2hex(msg))
         return (evt, data)
 
     def sendResponseApdu(self, msg):
+        if self.replay:
+            self.replay.sendResponseApdu(msg)
+            return
         self.sendData(msg)
 
+    def setReplay(self, replay):
+        with self.lock:
+            self.replay = replay
+
     def command(self, tag, payload=[]):  # dummy byte
         self.loggingApdu.debug("CMD %d %s" % (tag, hextools.bytes2hex(payload)))
         self.usbCtrlOut(tag, payload)
 
     def aidCommon(self, card):
-        if not card.routingAttr:
-            return False
-        return set(sim_card.FILES_AID).issubset(set(card.routingAttr.filesCommon))
+        return self.getRoutingTable().isAidCommon(card)
+
+    def getRoutingTable(self):
+        # Recompile routing rules only when they have changed.
+        cards = [cardDict[MAIN_INTERFACE] for cardDict in self.cardsDict]
+        key = routingKey(cards)
+        if not self.routingTable or self.routingTable.key != key:
+            self.routingTable = RoutingTable(cards, key)
+        return self.routingTable
 
     def getSoftCardDict(self):
         for cardDict in self.cardsDict:
@@ -185,40 +250,24 @@ class SimRouter(object):
         return None
 
     def getFileHandler(self, file):
-        #by default execute apdu in card 0
-        cards = [self.cardsDict[0][MAIN_INTERFACE]]
-
-        for cardDict in self.cardsDict:
-            if cardDict == self.cardsDict[0]:
-                #cardDict already in cards
-                continue
-            card = cardDict[MAIN_INTERFACE]
-            if file in card.routingAttr.filesCommon:
-                cards.append(card)
-            elif file in card.routingAttr.filesReplaced:
-                return [card]
-        return cards
+        return list(self.getRoutingTable().getFileCards(file))
 
     def getInsHandler(self, ins, apdu):
+        routingTable = self.getRoutingTable()
         #by default execute apdu in card 0
-        cards = [self.cardsDict[0][MAIN_INTERFACE]]
+        cards = [routingTable.mainCard]
 
-        for cardDict in self.cardsDict:
-            if cardDict == self.cardsDict[0]:
-                #cardDict already in cards
-                continue
-            card = cardDict[MAIN_INTERFACE]
-            if (ins == 'GET_RESPONSE' and
-                card.routingAttr.getFileSelected(apdu[0]) == 'AUTH' and
-                'INTERNAL_AUTHENTICATE' in card.routingAttr.insReplaced):
+        for card, rule, authReplaced, filesReplaced in routingTable.getInsRules(ins):
+            if (authReplaced and
+                card.routingAttr.getFileSelected(apdu[0]) == 'AUTH'):
                 return [card]
-            elif ins in card.routingAttr.insCommon:
+            elif rule == RULE_COMMON:
                 if (ins in ['GET_RESPONSE','SELECT_FILE'] and
-                      card.routingAttr.getFileSelected(apdu[0]) in card.routingAttr.filesReplaced):
+                      card.routingAttr.getFileSelected(apdu[0]) in filesReplaced):
                     cards.insert(0, card)
                 else:
                     cards.append(card)
-            elif ins in card.routingAttr.insReplaced:
+            elif rule == RULE_REPLACED:
                 if ins == 'INTERNAL_AUTHENTICATE':
                     card.routingAttr.setFileSelected('AUTH', apdu[0])
                 return [card]
@@ -249,7 +298,7 @@ class SimRouter(object):
                 card = cardDict[MAIN_INTERFACE]
                 #TODO: handle read/write/update command with SFI in P1
                 card.routingAttr.setFileSelected(self.fileName(apdu), apdu[0])
-        if ins in sim_card.FILE_INS:
+        if ins in FILE_INS:
             cards = self.getFileHandler(self.cardsDict[0][MAIN_INTERFACE].routingAttr.getFileSelected(apdu[0]))
         else:
             cards = self.getInsHandler(ins, apdu)
@@ -286,9 +335,8 @@ class SimRouter(object):
                    card.routingAttr.recordEfDirLength):
                 apdu[4] = card.routingAttr.recordEfDirLength
 
-            if origApdu != apdu:
-                self.loggingApdu.info("")
-                self.loggingApdu.info("*C-APDU%d: %s" %(self.getSimId(card), hextools.bytes2hex(apdu)))
+            if origApdu != apdu and self.trace.enabled:
+                self.trace.cApdu(self.getSimId(card), apdu, prefix="*", separator=True)
 
         if self.simType == types.TYPE_SIM and (apdu[0] & 0xF0) != 0xA0:
             #force 2G on USIM cards
@@ -315,8 +363,8 @@ class SimRouter(object):
                 card.routingAttr.getFileSelected(apdu[0]) == 'AUTH' and
                 types.sw(responseApdu) == types_g.sw.AUTHENTICATION_ERROR_APPLICATION_SPECIFIC):
             sw1Name, swName = types.swName(types.sw(responseApdu) >> 8, types.sw(responseApdu) & 0x00FF)
-            self.logging.warning("Response not expected. SW1: %s, SW: %s" %(sw1Name, swName))
-            self.logging.warning("Change card to process AUTHENTICATION")
+            self.logEvent(logging.WARNING, "Response not expected. SW1: %s, SW: %s" %(sw1Name, swName))
+            self.logEvent(logging.WARNING, "Change card to process AUTHENTICATION")
             if card == self.getMainCard(0):
                 cardTmp = self.getMainCard(1)
             else:
@@ -331,7 +379,8 @@ class SimRouter(object):
                 getResponseLength = types.sw2(responseApdu)
                 cla = apdu[0]
                 apduTmp = "%02XC00000%02X" %(cla, getResponseLength)
-                self.loggingApdu.info("**C-APDU%d: %s" %(self.getSimId(cardTmp), apduTmp))
+                if self.trace.enabled:
+                    self.trace.cApdu(self.getSimId(cardTmp), hextools.hex2bytes(apduTmp), prefix="**")
                 cardTmp.routingAttr.getResponse = cardTmp.apdu(apduTmp)
 
         if card.routingAttr.getFileSelected(apdu[0]) == 'EF_IMSI' and types.swNoError(responseApdu):
@@ -364,23 +413,22 @@ class SimRouter(object):
                  types.sw1(responseApdu) == types_g.sw1.NO_ERROR_PROACTIVE_DATA) and
                  self.getNbrOfCards() > 1):
                 # Check for pending SAT command
-                for cardDict in self.cardsDict:
-                    cardTmp = cardDict[MAIN_INTERFACE]
+                for cardTmp in self.getRoutingTable().satCards:
                     if card == cardTmp:
                         continue
-                    if set(sim_card.SAT_INS) <= set(cardTmp.routingAttr.insReplaced):
-                        swNoError = cardTmp.swNoError
-                        if types.unpackSw(swNoError)[0] == types_g.sw1.NO_ERROR_PROACTIVE_DATA:
-                            #update r-apdu with proactive data information
-                            responseApdu[-2] = swNoError >> 8
-                            responseApdu[-1] = swNoError & 0x00FF
-                        break
+                    swNoError = cardTmp.swNoError
+                    if types.unpackSw(swNoError)[0] == types_g.sw1.NO_ERROR_PROACTIVE_DATA:
+                        #update r-apdu with proactive data information
+                        responseApdu[-2] = swNoError >> 8
+                        responseApdu[-1] = swNoError & 0x00FF
+                    break
             self.sendResponseApdu(responseApdu)
-        if card == self.getMainCard(0) or sendData:
-            self.pretty_apdu(apdu)
-        responseApduHex = hextools.bytes2hex(responseApdu)
-        self.loggingApdu.info("R-APDU%d: %s" %(self.getSimId(card), responseApduHex))
-        # gsmtap.log(apdu,responseApdu) # Uncomment for wireshark
+        if self.trace.enabled:
+            simId = self.getSimId(card)
+            if card == self.getMainCard(0) or sendData:
+                self.trace.ins(simId, apdu)
+            # Add apdu_trace.GsmtapSink() to the trace for wireshark.
+            self.trace.rApdu(simId, responseApdu)
         return responseApdu
 
     def updateHandler(self, cardData, apdu, rapdu):
@@ -397,53 +445,240 @@ class SimRouter(object):
             # cache 'GET_RESPONSE'
             getResponseLength = types.sw2(rapdu)
             cla = apdu[0]
-            apdu = "%02XC00000%02X" %(cla, getResponseLength)
-            cardData[0].routingAttr.getResponse = cardData[0].apdu(apdu)
+            getResponseApdu = "%02XC00000%02X" %(cla, getResponseLength)
+            cardData[0].routingAttr.getResponse = cardData[0].apdu(getResponseApdu)
+        self.updateFcpCache(cardData[0], apdu, rapdu)
+
+    def getSelectedPath(self, card, apdu):
+        """Absolute path of the file selected by the C-APDU, None if unknown."""
+        fids = hextools.bytes2hex(types.dataLc(apdu) or [])
+        if types.p1(apdu) == types.SELECT_DF_EF_MF and fids == "3F00":
+            return "/"
+        if types.p1(apdu) != types.SELECT_BY_PATH_FROM_MF or not fids:
+            return None
+        files = [fids[i:i+4] for i in range(0, len(fids), 4)]
+        if "7FFF" in files:
+            if card.getCurrentAidId() == None:
+                return None
+            files = [file.replace("7FFF", "ADF%d" %card.getCurrentAidId()) for file in files]
+        return "/" + "/".join(files)
+
+    def updateFcpCache(self, card, apdu, rapdu):
+        ins = types.insName(apdu)
+        if ins in sim_card.FCP_INS:
+            card.fcpCache.clear()
+            return
+        if ins != 'SELECT_FILE' or not rapdu:
+            return
+        path = self.getSelectedPath(card, apdu)
+        if not path:
+            return
+        if types.sw(rapdu) == types_g.sw.FILE_NOT_FOUND:
+            card.fcpCache.setFcp(path, [])
+            return
+        if types.sw1(rapdu) in [types_g.sw1.RESPONSE_DATA_AVAILABLE_2G, types_g.sw1.RESPONSE_DATA_AVAILABLE_3G]:
+            rapdu = card.routingAttr.getResponse
+            if not rapdu:
+                return
+        if types.swNoError(rapdu) and len(rapdu) > 2:
+            card.fcpCache.setFcp(path, types.responseData(rapdu))
 
     def tick(self):
+        """Handle one C-APDU. Returns True if there was anything to handle."""
         with self.lock:
             inject = INJECT_READY
+            injected = None
             evt, apdu = self.receiveCommandApdu()
             if evt == EVT_RESET:
                 self.resetCards()
-                return
+                return True
             if not apdu:
-                if (not self.inject or
-                        self.rapduInject):  # Wait until rapduInject is consumed
-                    return
-                else:
-                    inject = self.inject
-                    apdu = self.apduInjectedData
-                    self.apduInjectedData = None
+                injected = self.getInjectedApdu()
+                if not injected:
+                    return False
+                inject = injected.mode
+                apdu = injected.apdu
+                self.apduInjectedCard = injected.card
             if not apdu:
                 raise Exception("APDU is empty")
             self.lastUpdate = time.time()
-            cardsData = self.getHandlers(apdu, inject)
-            responseApdu = None
-            for cardData in cardsData:
-                if cardData == cardsData[0]:
-                    apduHex = hextools.bytes2hex(apdu)
-                    self.loggingApdu.info("")
-                    self.loggingApdu.info("C-APDU%d: %s" %(self.getSimId(cardData[0]), apduHex))
-                responseApduTemp = self.handleApdu(cardData, apdu)
-                if cardData[1]:
-                    if cardData[0] != self.getMainCard(0):
-                        self.loggingApdu.info("*R-APDU%d" %self.getSimId(cardData[0]))
-                    responseApdu = responseApduTemp
-                self.updateHandler(cardData, apdu, responseApduTemp)
-            if not responseApdu and not inject:
-                raise Exception("No response received")
-            if inject:
-                self.rapduInject = responseApduTemp
+            if injected:
+                try:
+                    if isinstance(injected, InjectedApduBatch):
+                        rapdu = self.handleInjectedApdus(apdu, injected.card,
+                                                         injected.stopOnError)
+                    else:
+                        rapdu = self.handleCommandApdu(apdu, inject)
+                except Exception as e:
+                    injected.complete(None, e)
+                    raise
+                injected.complete(rapdu)
+                return True
+            self.handleCommandApdu(apdu, inject)
+            latency = time.time() - self.lastUpdate
+            self.latency.update(latency, self.pollInterval)
+            if self.trace.enabled and self.loggingApdu.isEnabledFor(logging.DEBUG):
+                self.trace.text("Latency: %.1fms (poll interval: %.1fms)"
+                                %(latency * 1000, self.pollInterval * 1000), logging.DEBUG)
+            return True
+
+    def handleCommandApdu(self, apdu, inject=INJECT_READY):
+        """Route C-APDU to the cards. Returns R-APDU of the last card."""
+        cardsData = self.getHandlers(apdu, inject)
+        responseApdu = None
+        responseApduTemp = None
+        for cardData in cardsData:
+            if cardData == cardsData[0] and self.trace.enabled:
+                self.trace.cApdu(self.getSimId(cardData[0]), apdu, separator=True)
+            responseApduTemp = self.handleApdu(cardData, apdu)
+            if cardData[1]:
+                if cardData[0] != self.getMainCard(0) and self.trace.enabled:
+                    self.trace.rApdu(self.getSimId(cardData[0]), None, prefix="*")
+                responseApdu = responseApduTemp
+            self.updateHandler(cardData, apdu, responseApduTemp)
+        if not responseApdu and not inject:
+            raise Exception("No response received")
+        return responseApduTemp
+
+    def handleInjectedApdus(self, apdus, card, stopOnError=False):
+        """Send injected C-APDUs to the card in one request. Returns R-APDUs."""
+        rapdus = card.apduMany(apdus, stopOnError)
+        for apdu, rapdu in zip(apdus, rapdus):
+            self.updateFcpCache(card, apdu, rapdu)
+        if self.trace.enabled:
+            simId = self.getSimId(card)
+            for apdu, rapdu in zip(apdus, rapdus):
+                self.trace.cApdu(simId, apdu, separator=True)
+                self.trace.rApdu(simId, rapdu)
+        return rapdus
+
+    def getInjectedApdu(self):
+        """Get next pending injected APDU, skip the ones already timed out."""
+        while True:
+            try:
+                injected = self.injectQueue.get_nowait()
+            except Queue.Empty:
+                return None
+            if not injected.cancelled:
+                return injected
+
+    def cancelInjectedApdus(self, error):
+        while True:
+            injected = self.getInjectedApdu()
+            if not injected:
+                return
+            injected.complete(None, error)
+
+    def queueInjectedApdu(self, injected, timeout=None):
+        with self.injectLock:
+            if not self.loopRunning:
+                raise Exception("Router main loop is not running")
+            if timeout != None:
+                self.timedInjected.append((time.time() + timeout, timeout, injected))
+            self.injectQueue.put(injected)
+            self.wakeupLoop()
+
+    def wakeupLoop(self):
+        """Wake up the main loop waiting for the next poll, call with injectLock."""
+        if self.onLoop():
+            self.wakeup.set()
+        elif self.loopRunning and self.wakeupWatcher:
+            # Thread safe. The watcher is stopped once loopRunning is cleared.
+            self.wakeupWatcher.send()
+
+    def handleWakeup(self):
+        """Called by the hub of the main loop when woken up by another thread."""
+        self.wakeup.set()
+        while True:
+            try:
+                call = self.callQueue.get_nowait()
+            except Queue.Empty:
+                return
+            self.tasks.spawn(call.run)
+
+    def onLoop(self):
+        return threading.current_thread() is self.loopThread
+
+    def checkInjectTimeouts(self):
+        """
+        Complete the injected APDUs of the threads waiting longer than their
+        timeout. Greenlets of the main loop time out on their own.
+        """
+        now = time.time()
+        expired = []
+        with self.injectLock:
+            pending = []
+            for item in self.timedInjected:
+                if item[2].done.isSet():
+                    continue
+                if item[0] <= now:
+                    expired.append(item)
+                else:
+                    pending.append(item)
+            self.timedInjected = pending
+        for deadline, timeout, injected in expired:
+            # Skipped by the main loop if it's still queued.
+            injected.cancelled = True
+            injected.complete(None, injectTimeoutError(timeout))
 
     def mainloop(self):
-        while 1:
-            if self.mode == ROUTER_MODE_DBUS:
-                import gevent
-                gevent.sleep(0.001)
-            self.tick()
-            if time.time() - self.lastUpdate > 0.1:
-                time.sleep(0.1)
+        """
+        Run the router core on the gevent hub of the calling thread. SIMtrace
+        is polled by the calling greenlet. Shell calls, SAT post-action
+        handlers and other tasks run in greenlets of the same hub and wait
+        for their injected APDUs without blocking the poll.
+        """
+        error = Exception("Router main loop stopped")
+        hub = gevent.get_hub()
+        self.wakeup = gevent.event.Event()
+        self.tasks = gevent.pool.Group()
+        self.pollGreenlet = gevent.getcurrent()
+        self.loopThread = threading.current_thread()
+        with self.injectLock:
+            self.wakeupWatcher = asyncWatcher(hub.loop)
+            self.wakeupWatcher.start(self.handleWakeup)
+        # Calls queued before the watcher was started.
+        self.handleWakeup()
+        try:
+            while True:
+                # Clear before tick() so an APDU injected meanwhile is not missed.
+                self.wakeup.clear()
+                if self.stopped:
+                    break
+                try:
+                    handled = self.tick()
+                except Exception as e:
+                    error = e
+                    raise
+                if handled:
+                    self.pollInterval = POLL_INTERVAL_MIN
+                    # Let the greenlets waiting for the R-APDU run.
+                    gevent.sleep(0)
+                    continue
+                # Nothing to handle, back off. Injected APDUs wake up the loop.
+                if self.mode == SIMTRACE_OFFLINE:
+                    # Nothing to poll, wait for injected APDUs only.
+                    self.wakeup.wait(POLL_INTERVAL_MAX)
+                    continue
+                self.wakeup.wait(self.pollInterval)
+                self.pollInterval = min(self.pollInterval * 2, POLL_INTERVAL_MAX)
+        finally:
+            with self.injectLock:
+                self.loopRunning = False
+                self.wakeupWatcher.stop()
+                self.wakeupWatcher = None
+            # Don't leave injecting threads and greenlets waiting for a stopped loop.
+            self.cancelInjectedApdus(error)
+            while True:
+                try:
+                    self.callQueue.get_nowait().fail(error)
+                except Queue.Empty:
+                    break
+            self.tasks.join(timeout=INJECT_CHECK_INTERVAL)
+            self.tasks.kill()
+
+    def getLatency(self):
+        return self.latency
 
     def getNbrOfCards(self):
         return len(self.cardsDict)
@@ -493,6 +728,7 @@ class SimRouter(object):
         #with self.lock:
         self.cardsDict[simId1] = cardDict2
         self.cardsDict[simId2] = cardDict1
+        self.routingTable = None
 
     def copyFiles(self, cardMainFrom, cardMainTo, files):
         simIdFrom = self.getSimId(self.getRelatedCtrlCard(cardMainFrom))
@@ -515,45 +751,157 @@ class SimRouter(object):
         else:
             return self.getMainCard(0).getATR()
 
-    def waitInjectReady(self, timeout=15):
-        startTime = time.time()
-        while True:
-            with self.lock:
-                if self.inject == INJECT_READY and not self.rapduInject:
-                    break
-                currentTime = time.time()
-                if currentTime - startTime > timeout: #sec
-                    if self.rapduInject:
-                        logging.error("RAPDU injected response not consumed")
-                    self.logging.error("Timeout. Previous apdu injected has not finished within %ds" %timeout)
-                    self.rapduInject = None
-                    self.inject = INJECT_READY
-                    break
-            time.sleep(0.001)
-
-    def waitRapduInject(self, timeout=30):
-        startTime = time.time()
-        while True:
-            with self.lock:
-                rapduInject = self.rapduInject
-                if rapduInject:
-                    self.rapduInject = None
-                    self.inject = INJECT_READY
-                    return rapduInject
-                currentTime = time.time()
-                if currentTime - startTime > timeout:
-                    self.inject = INJECT_READY
-                    raise Exception("Timeout. No rapdu for injected data received within %ds" %timeout)
-            time.sleep(0.001)
-
-    def injectApdu(self, apdu, card, mode=INJECT_NO_FORWARD):
+    def injectApdu(self, apdu, card, mode=INJECT_NO_FORWARD, timeout=INJECT_TIMEOUT):
         # TODO: add inject tag to logs
-        self.waitInjectReady()
-        with self.lock:
-            self.apduInjectedCard = card
-            self.apduInjectedData = hextools.hex2bytes(apdu)
-            self.inject = mode
-        return self.waitRapduInject()
+        injected = InjectedApdu(hextools.hex2bytes(apdu), card, mode)
+        return self.waitInjected(injected, timeout)
+
+    def injectApdus(self, apdus, card, stopOnError=False, timeout=None):
+        """
+        Send APDUs to the card in one reader call, GET RESPONSE and repeating
+        with the right Le are done by the reader. Returns the R-APDUs.
+        The timeout is INJECT_TIMEOUT plus one second per APDU by default.
+        """
+        if not apdus:
+            return []
+        if timeout == None:
+            timeout = INJECT_TIMEOUT + len(apdus)
+        apdus = [hextools.hex2bytes(apdu) for apdu in apdus]
+        injected = InjectedApduBatch(apdus, card, stopOnError)
+        return self.waitInjected(injected, timeout)
+
+    def waitInjected(self, injected, timeout):
+        """
+        Queue the injected APDU and wait for its completion. A greenlet of
+        the main loop waits without blocking the loop, other threads block.
+        """
+        if not self.onLoop():
+            self.queueInjectedApdu(injected, timeout)
+            return injected.wait()
+        if gevent.getcurrent() is self.pollGreenlet:
+            raise Exception("APDU injected by the router main loop poll")
+        done = gevent.event.Event()
+        injected.callback = lambda injected: done.set()
+        self.queueInjectedApdu(injected)
+        if not done.wait(timeout):
+            # Skipped by the main loop if it's still queued.
+            injected.cancelled = True
+            injected.complete(None, injectTimeoutError(timeout))
+        return injected.wait()
+
+    def call(self, function, *args):
+        """
+        Run function(*args) in a greenlet on the main loop and return its
+        result. The calling thread waits for it. Runs on the calling thread
+        if the loop is not running.
+        """
+        if self.onLoop():
+            return function(*args)
+        call = LoopCall(function, args)
+        with self.injectLock:
+            running = self.loopRunning
+            if running:
+                self.callQueue.put(call)
+                self.wakeupLoop()
+        if not running:
+            return function(*args)
+        return call.wait()
+
+    def spawnCall(self, function, *args):
+        """Run function(*args) in a greenlet on the main loop, don't wait for it."""
+        if self.onLoop():
+            self.tasks.spawn(self.runCall, function, *args)
+            return
+        with self.injectLock:
+            if not self.loopRunning:
+                raise Exception("Router main loop is not running")
+            self.callQueue.put(LoopCall(self.runCall, (function,) + args))
+            self.wakeupLoop()
+
+    def runCall(self, function, *args):
+        try:
+            function(*args)
+        except Exception as e:
+            self.logging.error("Task failed: %s" %str(e))
+
+    def runBlocking(self, function, *args):
+        """
+        Run a blocking function, e.g. reading the console, in a thread of the
+        hub pool when called on the main loop, so the loop keeps running.
+        """
+        if not self.onLoop():
+            return function(*args)
+        return gevent.get_hub().threadpool.apply(function, args)
+
+    def inject(self, apdu, card, mode=INJECT_NO_FORWARD):
+        """Injected APDU request to be yielded by a task, see spawn()."""
+        return InjectedApdu(hextools.hex2bytes(apdu), card, mode)
+
+    def spawn(self, task):
+        """
+        Run the task on the main loop without a thread. The task is a
+        generator which yields injected APDU requests and gets back
+        the R-APDU, e.g. rapdu = yield self.inject(apdu, card).
+        """
+        self.resumeTask(task, None)
+
+    def resumeTask(self, task, injected):
+        try:
+            if injected and injected.error:
+                injected = task.throw(injected.error)
+            elif injected:
+                injected = task.send(injected.rapdu)
+            else:
+                injected = task.next()
+        except StopIteration:
+            return
+        except Exception as e:
+            self.logging.error("Task failed: %s" %str(e))
+            return
+        injected.callback = lambda injected: self.resumeTask(task, injected)
+        try:
+            self.queueInjectedApdu(injected)
+        except Exception as e:
+            self.logging.error("Task failed: %s" %str(e))
+            task.close()
+
+    def softResetTask(self):
+        self.logEvent(logging.INFO, "\n")
+        self.logEvent(logging.INFO, "<- Soft reset")
+        for cardDict in self.cardsDict:
+            if (not cardDict[MAIN_INTERFACE].routingAttr or
+                    #skip SIM with no common instruction
+                    cardDict[MAIN_INTERFACE].routingAttr.insCommon == [] or
+                    not self.simCtrl):
+                continue
+            #select MF
+            if self.simType == types.TYPE_USIM:
+                apdu = "00A40004023F00"
+            else:
+                apdu = "A0A40000023F00"
+            rapdu = yield self.inject(apdu, cardDict[MAIN_INTERFACE])
+            if not rapdu:
+                #Skip resetting if there is USB apdu to handle
+                self.logEvent(logging.INFO, "Soft reset not completed, USB apdu ongoing")
+                return
+            # Close opened logical channel so the are not exhousted when UE
+            # assign new channels after SIM reset.
+            ctrlLogicalChannel = self.simCtrl.logicalChannel
+            for channel in range(1,4):
+                if channel != ctrlLogicalChannel: #skip control logical channel
+                    originChannel = 0
+                    if self.simType == types.TYPE_SIM:
+                        cla = 0xA0
+                    else:
+                        cla = 0x00
+                    cla = cla | (originChannel & 0x0F)
+                    apdu = "%02X7080%02X00" %(cla, channel)
+                    rapdu = yield self.inject(apdu, cardDict[MAIN_INTERFACE])
+                    if not rapdu:
+                        #Skip resetting if there is USB apdu to handle
+                        self.logEvent(logging.INFO, "Soft reset not completed, USB apdu ongoing")
+                        break
+        self.logEvent(logging.INFO, "-> reset end")
 
     def setPowerSkip(self, skip):
         self.command(CMD_SET_SKIP, hextools.u32(skip))
@@ -577,19 +925,44 @@ class SimRouter(object):
         self.powerHalt()
         self.loop = MainLoopThread(self)
         self.loop.setDaemon(True)
+        # APDUs can be injected as soon as the thread is started.
+        self.loopRunning = True
         # Start handling incoming phone C-APDUs.
         self.loop.start()
+        # Times out the injected APDUs of threads waiting outside the loop,
+        # even while the loop is busy.
+        self.timeoutThread = InjectTimeoutThread(self)
+        self.timeoutThread.start()
         # Default card control interface.
-        if self.simType == types.TYPE_SIM:
-            self.simCtrl = sim_ctrl_2g.SimCtrl(self)
-        else:
-            self.simCtrl = sim_ctrl_3g.SimCtrl(self)
+        self.simCtrl = self.createSimCtrl()
         self.simCtrl.init()
         interactive = self.getInteractiveFromMode(mode)
         # Plac telnet server works without interactive mode
         self.shell = sim_shell.SimShell(self.simCtrl, interactive)
         self.startPlacServer(mode)
 
+    def close(self):
+        """Stop the control server, the main loop and the trace of the router."""
+        if self.controlServer:
+            self.controlServer.close()
+            self.controlServer = None
+        self.stopped = True
+        with self.injectLock:
+            self.wakeupLoop()
+        if self.loop and self.loop != threading.current_thread():
+            self.loop.stop()
+        if self.timeoutThread:
+            self.timeoutThread.stop()
+            self.timeoutThread = None
+        self.stopCapture()
+        self.trace.close()
+
+    def createSimCtrl(self):
+        if self.simType == types.TYPE_SIM:
+            return sim_ctrl_2g.SimCtrl(self)
+        else:
+            return sim_ctrl_3g.SimCtrl(self)
+
     def getInteractiveFromMode(self, mode):
         if mode in [ROUTER_MODE_INTERACTIVE, ROUTER_MODE_DBUS]:
             return True
@@ -598,12 +971,16 @@ class SimRouter(object):
     def startPlacServer(self, mode):
         if mode  == ROUTER_MODE_DISABLED:
             return
-        self.interpreter = plac.Interpreter(self.shell)
+        self.interpreter = LoopInterpreter(self.shell, self)
         if mode == ROUTER_MODE_TELNET:
             self.interpreter.start_server() # Loop
         elif mode == ROUTER_MODE_DBUS:
             from util import dbus_ctrl
             dbus_ctrl.startDbusProcess(self) # Loop
+        elif mode == ROUTER_MODE_CONTROL:
+            from sim import sim_control
+            self.controlServer = sim_control.ControlServer(self.shell)
+            self.controlServer.serve_forever() # Loop
         elif mode == ROUTER_MODE_INTERACTIVE:
             path = self.simCtrl.getCurrentFile().path
             self.interpreter.interact(prompt="\n%s>"%path)
@@ -624,9 +1001,7 @@ class SimRouter(object):
         consoleHandler.setLevel(logging.DEBUG)
 
         # create file handler which logs even debug messages
-        dir = os.path.dirname(__file__)
-        resultFile = dir + "/../apdu.log"
-        fileHandler = logging.FileHandler(resultFile, mode='w')
+        fileHandler = logging.FileHandler(APDU_LOG_FILE, mode='w')
         fileHandler.setLevel(logging.INFO)
 
         # create formatter and add it to the handlers
@@ -661,11 +1036,21 @@ class SimRouter(object):
             fileName = hextools.bytes2hex(types.aid(apdu)) #'A000'
         return fileName
 
-    def pretty_apdu(self, apdu):
-        str = types.insName(apdu)
-        if str == 'SELECT_FILE':
-            str += " " + self.fileName(apdu)
-        self.loggingApdu.info(str)
+    def startCapture(self, file, maxSize=None, maxDuration=None):
+        """Capture the APDUs in pcapng file(s), see apdu_trace.PcapngSink."""
+        self.stopCapture()
+        self.capture = apdu_trace.PcapngSink(file, maxSize, maxDuration)
+        self.trace.addSink(self.capture)
+
+    def stopCapture(self):
+        if self.capture:
+            self.trace.removeSink(self.capture)
+            self.capture = None
+
+    def logEvent(self, level, msg):
+        """Log directly, in order with the traced APDUs."""
+        self.trace.flush()
+        self.logging.log(level, msg)
 
     def usb_find(self, idVendor, idProduct):
         LIBUSB_PATH = "/usr/lib/libusb-1.0.so"
@@ -679,82 +1064,274 @@ class SimRouter(object):
             dev = usb.core.find(idVendor=idVendor, idProduct=idProduct, backend=backend)
         return dev
 
+class InjectedApdu(object):
+    """
+    C-APDU injected by SimCtrl. The main loop completes it with the R-APDU
+    and wakes up the waiting thread or greenlet, or the timeout completes it
+    with an error. The first completion wins.
+    """
+    def __init__(self, apdu, card, mode):
+        self.apdu = apdu
+        self.card = card
+        self.mode = mode
+        self.rapdu = None
+        self.error = None
+        self.cancelled = False
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        # Called on completion on the main loop instead of waking up a thread,
+        # see spawn() and waitInjected().
+        self.callback = None
+
+    def complete(self, rapdu, error=None):
+        with self.lock:
+            if self.done.isSet():
+                return
+            self.rapdu = rapdu
+            self.error = error
+            self.done.set()
+        if self.callback:
+            self.callback(self)
+
+    def wait(self):
+        # Waiting with a timeout polls in Python 2, the timeout is
+        # checked by InjectTimeoutThread instead.
+        self.done.wait()
+        if self.error:
+            raise self.error
+        return self.rapdu
+
+class InjectedApduBatch(InjectedApdu):
+    """C-APDUs injected by SimCtrl.sendApdus(), completed with a list of R-APDUs."""
+    def __init__(self, apdus, card, stopOnError):
+        InjectedApdu.__init__(self, apdus, card, INJECT_NO_FORWARD)
+        self.stopOnError = stopOnError
+
+class LoopCall(object):
+    """Call handed over to the main loop by another thread, see SimRouter.call()."""
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.function(*self.args)
+        except BaseException as e:
+            # GreenletExit included, the loop is stopping.
+            self.error = e
+        self.done.set()
+
+    def fail(self, error):
+        self.error = error
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.error:
+            raise self.error
+        return self.result
+
+class LoopInterpreter(plac.Interpreter):
+    """
+    Plac interpreter of the telnet, D-Bus and interactive modes. The shell
+    commands run on the router main loop.
+    """
+    def __init__(self, obj, simRouter):
+        plac.Interpreter.__init__(self, obj)
+        self.simRouter = simRouter
+
+    def submit(self, line):
+        return self.simRouter.call(self.runTask, line)
+
+    def runTask(self, line):
+        task = plac.Interpreter.submit(self, line)
+        # Run by the caller again, a finished task does nothing.
+        task.run()
+        return task
+
+class ApduLatency(object):
+    """
+    Time from receiving a C-APDU from SIMtrace to sending the R-APDU.
+    The C-APDU might wait up to the poll interval before it is received.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.last = 0
+        self.min = None
+        self.max = 0
+        self.total = 0
+        self.maxPollInterval = 0
+
+    def update(self, latency, pollInterval):
+        self.count += 1
+        self.last = latency
+        self.total += latency
+        if self.min == None or latency < self.min:
+            self.min = latency
+        if latency > self.max:
+            self.max = latency
+        if pollInterval > self.maxPollInterval:
+            self.maxPollInterval = pollInterval
+
+    def average(self):
+        if not self.count:
+            return 0
+        return self.total / self.count
+
+    def __str__(self):
+        if not self.count:
+            return "no APDUs"
+        return ("apdus=%d, last=%.1fms, avg=%.1fms, min=%.1fms, max=%.1fms, "
+                "max poll interval=%.1fms"
+                %(self.count, self.last * 1000, self.average() * 1000,
+                  self.min * 1000, self.max * 1000, self.maxPollInterval * 1000))
+
+FILE_INS = frozenset(sim_card.FILE_INS)
+
+RULE_COMMON = 1
+RULE_REPLACED = 2
+
+def routingKey(cards):
+    key = []
+    for card in cards:
+        routingAttr = card.routingAttr
+        if routingAttr:
+            key.append((id(card), id(routingAttr), routingAttr.version))
+        else:
+            key.append((id(card), None, None))
+    return tuple(key)
+
+class RoutingTable(object):
+    """
+    Routing rules of all main cards compiled into lookup tables.
+    Recompiled by SimRouter when the routing attributes are changed.
+    """
+    def __init__(self, cards, key):
+        self.key = key
+        self.cards = cards
+        self.mainCard = cards[0]
+        self.insRules = {}
+        self.fileCards = {}
+        self.aidCommon = {}
+        # Cards handling SAT instructions.
+        self.satCards = []
+        satIns = set(sim_card.SAT_INS)
+        for card in cards:
+            routingAttr = card.routingAttr
+            self.aidCommon[card] = self.checkAidCommon(card)
+            if routingAttr and satIns <= set(routingAttr.insReplaced):
+                self.satCards.append(card)
+
+    def checkAidCommon(self, card):
+        if not card.routingAttr:
+            return False
+        return set(sim_card.FILES_AID).issubset(set(card.routingAttr.filesCommon))
+
+    def isAidCommon(self, card):
+        try:
+            return self.aidCommon[card]
+        except KeyError:
+            # e.g. control card
+            return self.checkAidCommon(card)
+
+    def getFileCards(self, file):
+        try:
+            return self.fileCards[file]
+        except KeyError:
+            pass
+        #by default execute apdu in card 0
+        cards = [self.mainCard]
+        for card in self.cards[1:]:
+            if file in card.routingAttr.filesCommon:
+                cards.append(card)
+            elif file in card.routingAttr.filesReplaced:
+                cards = [card]
+                break
+        cards = tuple(cards)
+        self.fileCards[file] = cards
+        return cards
+
+    def getInsRules(self, ins):
+        try:
+            return self.insRules[ins]
+        except KeyError:
+            pass
+        rules = []
+        for card in self.cards[1:]:
+            routingAttr = card.routingAttr
+            authReplaced = (ins == 'GET_RESPONSE' and
+                            'INTERNAL_AUTHENTICATE' in routingAttr.insReplaced)
+            if ins in routingAttr.insCommon:
+                rule = RULE_COMMON
+            elif ins in routingAttr.insReplaced:
+                rule = RULE_REPLACED
+            else:
+                rule = None
+            if rule or authReplaced:
+                rules.append((card, rule, authReplaced,
+                              frozenset(routingAttr.filesReplaced)))
+        self.insRules[ins] = rules
+        return rules
+
+def injectTimeoutError(timeout):
+    return Exception("Timeout. No rapdu for injected data received within %ds" %timeout)
+
+def asyncWatcher(loop):
+    """Watcher of the hub loop which can be sent from other threads."""
+    # Renamed to async_ in gevent 1.3, async is a keyword in Python 3.7.
+    watcher = getattr(loop, "async_", None) or getattr(loop, "async")
+    return watcher()
+
 extHandler = None
 def setLoggerExtHandler(handler):
     global extHandler
     extHandler = handler
 
 
-class MainLoopThread(threading.Thread):
+class InjectTimeoutThread(threading.Thread):
     def __init__(self, simRouter):
         threading.Thread.__init__(self)
+        threading.Thread.setName(self, 'InjectTimeoutThread')
+        self.setDaemon(True)
         self.simRouter = simRouter
-        threading.Thread.setName(self, 'MainLoopThread')
-        self.__lock = threading.Lock()
+        self.stopEvent = threading.Event()
 
     def run(self):
-        self.__lock.acquire()
-        for cardDict in self.simRouter.cardsDict:
-            if cardDict[MAIN_INTERFACE].mode == sim_reader.MODE_SIM_SOFT:
-                # Set SimRouter class in SatCtrl.
-                card = cardDict[CTRL_INTERFACE].simReader.getHandler().getCard(cardDict[CTRL_INTERFACE].index)
-                card.satCtrl.setSimRouter(self.simRouter)
-        self.simRouter.mainloop()
-        self.__lock.release()
+        while not self.stopEvent.wait(INJECT_CHECK_INTERVAL):
+            self.simRouter.checkInjectTimeouts()
 
     def stop(self):
+        self.stopEvent.set()
         self.join()
 
-class ResetThread(threading.Thread):
+class MainLoopThread(threading.Thread):
     def __init__(self, simRouter):
         threading.Thread.__init__(self)
         self.simRouter = simRouter
-        threading.Thread.setName(self, 'ResetThread')
+        threading.Thread.setName(self, 'MainLoopThread')
         self.__lock = threading.Lock()
 
     def run(self):
         self.__lock.acquire()
-        self.softReset()
-        self.__lock.release()
-
-
-    def softReset(self):
-        self.simRouter.logging.info("\n")
-        self.simRouter.logging.info("<- Soft reset")
         for cardDict in self.simRouter.cardsDict:
-            if (not cardDict[MAIN_INTERFACE].routingAttr or
-                    #skip SIM with no common instruction
-                    cardDict[MAIN_INTERFACE].routingAttr.insCommon == [] or
-                    not self.simRouter.simCtrl):
-                continue
-            #select MF
-            if self.simRouter.simType == types.TYPE_USIM:
-                apdu = "00A40004023F00"
-            else:
-                apdu = "A0A40000023F00"
-            rapdu = self.simRouter.injectApdu(apdu, cardDict[MAIN_INTERFACE], mode=INJECT_NO_FORWARD)
-            if not rapdu:
-                #Skip resetting if there is USB apdu to handle
-                self.simRouter.logging.info("Soft reset not completed, USB apdu ongoing")
-                return
-            # Close opened logical channel so the are not exhousted when UE
-            # assign new channels after SIM reset.
-            ctrlLogicalChannel = self.simRouter.simCtrl.logicalChannel
-            for channel in range(1,4):
-                if channel != ctrlLogicalChannel: #skip control logical channel
-                    originChannel = 0
-                    if self.simRouter.simType == types.TYPE_SIM:
-                        cla = 0xA0
-                    else:
-                        cla = 0x00
-                    cla = cla | (originChannel & 0x0F)
-                    apdu = "%02X7080%02X00" %(cla, channel)
-                    rapdu = self.simRouter.injectApdu(apdu, cardDict[MAIN_INTERFACE], mode=INJECT_NO_FORWARD)
-                    if not rapdu:
-                        #Skip resetting if there is USB apdu to handle
-                        self.simRouter.logging.info("Soft reset not completed, USB apdu ongoing")
-                        break
-        self.simRouter.logging.info("-> reset end")
+            if cardDict[MAIN_INTERFACE].mode == sim_reader.MODE_SIM_SOFT:
+                # Set SimRouter class in SatCtrl.
+                card = cardDict[CTRL_INTERFACE].simReader.getHandler().getCard(cardDict[CTRL_INTERFACE].index)
+                # Not available for a card in a worker process.
+                if card.satCtrl:
+                    card.satCtrl.setSimRouter(self.simRouter)
+        try:
+            self.simRouter.mainloop()
+        finally:
+            # The hub of this thread is not used once the loop stops.
+            gevent.get_hub().destroy(destroy_loop=True)
+            self.__lock.release()
 
     def stop(self):
         self.join()
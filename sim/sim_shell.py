@@ -47,6 +47,7 @@ class SimShell(object):
         'get_plmn',
         'set_plmn',
         'log_level',
+        'latency',
         'open_channel',
         'close_channel',
         'get_ust',
@@ -449,7 +450,10 @@ class SimShell(object):
         path = self.getAbsolutePath(path)
         if not path:
             return self.responseNok()
-        sw1, sw2, data = self.simCtrl.selectFileByPath(path)
+        fcpCache = self.simCtrl.getFcpCache()
+        data = fcpCache.getFcp(path)
+        if not data or fcpCache.getKey(path) != fcpCache.getKey(self.simCtrl.getCurrentFilePath()):
+            sw1, sw2, data = self.simCtrl.selectFileByPath(path)
         if not data:
             return self.responseNok()
         return self.responseOk("%s" %hextools.bytes2hex(data))
@@ -897,8 +901,36 @@ class SimShell(object):
 
         logger = logging.getLogger()
         logger.setLevel(level)
+        # APDUs are not traced at all when not logged.
+        self.simCtrl.router.trace.update()
         return self.responseOk("logging.%s" %levelStr)
 
+    def latency(self, reset=None):
+        """Show time between receiving C-APDU from SIMtrace and
+        sending R-APDU back. Injected APDUs are not counted.
+
+        Usage:
+            latency [reset]
+
+        Args:
+            reset: clear collected statistics.
+
+        Returns:
+            |  status: OK
+            |  data: latency statistics
+
+        Example::
+
+            />latency
+            status OK
+            data apdus=120, last=2.1ms, avg=3.4ms, min=1.2ms, max=18.0ms, max poll interval=20.0ms
+        """
+        latency = self.simCtrl.router.getLatency()
+        if reset:
+            latency.reset()
+            return self.responseOk()
+        return self.responseOk(str(latency))
+
     def backup(self):
         """Backup SIM file system. Output file is saved as
         ../sim_soft/sim_backup_<imsi>.xml. To use the backup file in
@@ -923,11 +955,10 @@ class SimShell(object):
         imsi = types.getDataValue(data)
         atr = self.simCtrl.router.getCtrlCard(self.simCtrl.srvId).getCachedAtr()
         atr = hextools.bytes2hex(atr, " ")
-        self.simBackup = sim_backup.SimBackup(self.simCtrl, imsi, atr)
-        sw1, sw2, data = self.simCtrl.selectMf()
-        sw1, sw2, data = self.simCtrl.getResponse(sw2)
-        node = self.simBackup.setMf(data)
-        status = self._backup("/", node)
+        self.simBackup = sim_backup.SimBackup(self, imsi, atr)
+        status = self.simBackup.run()
+        if not status:
+            return self.responseNok()
         xmlPath = self.simBackup.saveXml()
         xmlPath = os.path.abspath(xmlPath).replace("\\", "/")
         if status:
@@ -957,6 +988,8 @@ class SimShell(object):
         if not softCardDict:
             return self.responseNok("Soft card not connected")
         card = softCardDict[sim_router.MAIN_INTERFACE].simReader.getHandler().getCard(softCardDict[sim_router.MAIN_INTERFACE].index)
+        if not card.satCtrl:
+            return self.responseNok("Soft card runs in a worker process")
         card.satCtrl.satShell(param, value)
         return self.responseOk()
 
@@ -976,7 +1009,8 @@ class SimShell(object):
         else:
             choice = '[yes/no]: '
 
-        choice = raw_input('\n' + question + '? ' + choice).lower()
+        # Read on a thread of its own, the main loop keeps routing APDUs.
+        choice = self.simCtrl.router.runBlocking(raw_input, '\n' + question + '? ' + choice).lower()
         if choice in yes:
             if default:
                 return default
@@ -984,7 +1018,7 @@ class SimShell(object):
         elif choice in change:
             if not default:
                 return False
-            return raw_input('Provide new value: ')
+            return self.simCtrl.router.runBlocking(raw_input, 'Provide new value: ')
         else:
             return False
 
@@ -1164,6 +1198,19 @@ class SimShell(object):
         return True
 
     def getAbsolutePath(self, pathName):
+        currDirPath = self.simCtrl.getCurrentDirPath()
+        currAidId = None
+        if self.simCtrl.router.simType == types.TYPE_USIM:
+            currAidId = self.simCtrl.getCurrentAidId()
+        # The path depends on the current directory and ADF.
+        key = ("abs", pathName, currDirPath, currAidId)
+        absPath = self.simCtrl.simFiles.getCachedPath(key)
+        if not absPath:
+            absPath = self.resolveAbsolutePath(pathName, currDirPath, currAidId)
+            self.simCtrl.simFiles.cachePath(key, absPath)
+        return absPath
+
+    def resolveAbsolutePath(self, pathName, currDirPath, currAidId):
         path = self.simCtrl.simFiles.parsePath(pathName)
         if not path:
             logging.error("path: %s not resolved" %pathName)
@@ -1173,10 +1220,6 @@ class SimShell(object):
 
         absPath = ""
         tmpPath = ""
-        currPath = self.simCtrl.getCurrentFilePath()
-        currDirPath = self.simCtrl.getCurrentDirPath()
-        if self.simCtrl.router.simType == types.TYPE_USIM:
-            currAidId = self.simCtrl.getCurrentAidId()
         files = types.getFilesFromPath(path)
         for _file in files:
             pathFormat = types.getFileNameFormat(_file)
@@ -1526,47 +1569,6 @@ class SimShell(object):
                                                     se01ValueTag=types.EFARR_ACCESS_RULE_SE01_TAG)
         return status
 
-    def _backup(self, path, node):
-        if path[-1] != "/":
-            path += "/"
-        filesToCheck = self.simCtrl.simFiles.findAllChildFiles(path)
-        for file in filesToCheck:
-            fid =  types.fidFromPath(file)
-            format = types.getFileNameFormat(file)
-            if format == types.FILE_FORMAT_ADF_NAME:
-                fid = self.simCtrl.simFiles.getAdfId(fid)
-                if not fid:
-                    continue
-                aidId = int(fid.replace("ADF",""))
-                sw2 = self.simCtrl.selectAid(aidId=aidId)
-                if not sw2:
-                    logging.info("Failed to select AID: " + fid)
-                    continue
-            else:
-                sw1, sw2, data = self.simCtrl.selectFile(fid)
-                if sw1 != types_g.sw1.RESPONSE_DATA_AVAILABLE_3G:
-                    logging.info("Failed to select: " + fid)
-                    continue
-            sw1, sw2, data = self.simCtrl.getResponse(sw2)
-            pathTmp = self.simCtrl.getCurrentFilePath()
-            if file[-1] != "/":
-                fileValue = self.readRaw(pathTmp, forceAccess=True)
-                if not fileValue:
-                    continue
-                self.simBackup.addEf(node, file, fileValue.replace(";",""), data)
-            else:
-                if format == types.FILE_FORMAT_ADF_NAME:
-                    aid = hextools.bytes2hex(types.getAidFromData(data), separator="")
-                    nodeTmp = self.simBackup.addAdf(node, fid, aid, data)
-                else:
-                    nodeTmp = self.simBackup.addDf(node, fid, data)
-                self._backup(pathTmp, nodeTmp)
-                #restore previous path
-                sw1, sw2, data = self.simCtrl.selectFileByPath(path)
-                if types.assertSw(sw1, sw2, checkSw='NO_ERROR'):
-                    raise Exception("Failed to select current dir")
-        return True
-
 class FileAccessCondition(object):
     def __init__(self, ss, path, accessMode, forceAccess=True):
         self.ss = ss
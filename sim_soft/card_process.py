@@ -0,0 +1,189 @@
+#!/usr/bin/python
+# LICENSE: GPL2
+
+# Soft card running in its own worker process, so the xml work of several
+# soft cards doesn't share one core with the router. C-APDUs and R-APDUs
+# cross a ring buffer in shared memory. The card state (current files,
+# channels, CHV status) lives in the worker.
+
+import mmap
+import multiprocessing
+import os
+import pickle
+import struct
+import threading
+
+from util import types
+
+RING_SLOTS = 8
+RING_SLOT_SIZE = 1024
+# Seconds between checks that the worker is still alive.
+PROCESS_CHECK_INTERVAL = 1.0
+
+LENGTH = struct.Struct(">H")
+SW = struct.Struct(">H")
+
+OP_STOP = 0
+OP_CONNECT = 1
+OP_INIT = 2
+OP_RESET = 3
+OP_DISCONNECT = 4
+OP_FLUSH = 5
+OP_GET_ATR = 6
+OP_TRANSMIT = 7
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+class ApduRing(object):
+    """
+    Ring of fixed size slots in shared memory, for one writing and one
+    reading process. Create it before the worker process is started.
+    """
+    def __init__(self, nbrOfSlots=RING_SLOTS, slotSize=RING_SLOT_SIZE):
+        self.nbrOfSlots = nbrOfSlots
+        self.slotSize = slotSize
+        self.map = mmap.mmap(-1, nbrOfSlots * slotSize)
+        self.free = multiprocessing.Semaphore(nbrOfSlots)
+        self.used = multiprocessing.Semaphore(0)
+        # Each index is used by one side only.
+        self.writeIndex = 0
+        self.readIndex = 0
+
+    def getMaxMessageLength(self):
+        return self.slotSize - LENGTH.size
+
+    def put(self, message):
+        if len(message) > self.getMaxMessageLength():
+            raise Exception("Message too long: %d bytes" %len(message))
+        self.free.acquire()
+        offset = self.writeIndex * self.slotSize
+        LENGTH.pack_into(self.map, offset, len(message))
+        offset += LENGTH.size
+        self.map[offset:offset + len(message)] = message
+        self.writeIndex = (self.writeIndex + 1) % self.nbrOfSlots
+        self.used.release()
+
+    def get(self, timeout=None):
+        """Returns the next message or None on timeout."""
+        if not self.used.acquire(True, timeout):
+            return None
+        offset = self.readIndex * self.slotSize
+        length = LENGTH.unpack_from(self.map, offset)[0]
+        offset += LENGTH.size
+        message = self.map[offset:offset + length]
+        self.readIndex = (self.readIndex + 1) % self.nbrOfSlots
+        self.free.release()
+        return message
+
+def packImage(file, savePolicy):
+    return pickle.dumps((file, savePolicy), pickle.HIGHEST_PROTOCOL)
+
+def handleRequest(card, op, payload):
+    if op == OP_CONNECT or op == OP_INIT:
+        card.file, card.savePolicy = pickle.loads(payload)
+        if op == OP_CONNECT:
+            card.connect()
+        else:
+            card.init()
+        return str(bytearray(card.getATR()))
+    elif op == OP_RESET:
+        card.reset()
+    elif op == OP_DISCONNECT:
+        card.disconnect()
+    elif op == OP_FLUSH:
+        card.flush()
+    elif op == OP_GET_ATR:
+        return str(bytearray(card.getATR()))
+    elif op == OP_TRANSMIT:
+        data, sw = card.transmit(list(bytearray(payload)))
+        return SW.pack(sw) + str(bytearray(data))
+    else:
+        raise Exception("Unknown request: %d" %op)
+    return ""
+
+def runWorker(cardClass, simType, requests, responses):
+    card = cardClass(simType)
+    maxErrorLength = responses.getMaxMessageLength() - 1
+    while True:
+        message = requests.get()
+        op = ord(message[0])
+        if op == OP_STOP:
+            card.close()
+            responses.put(chr(STATUS_OK))
+            return
+        try:
+            response = chr(STATUS_OK) + handleRequest(card, op, message[1:])
+        except Exception as e:
+            response = chr(STATUS_ERROR) + str(e)[-maxErrorLength:]
+        responses.put(response)
+
+class SoftCardProcess(object):
+    """
+    Works like SoftCard, the card of cardClass runs in a worker process.
+    SAT commands which need the router (e.g. swapping cards) are not
+    available, the router is in the parent process.
+    """
+    def __init__(self, cardClass, simType=types.TYPE_USIM, file=None, savePolicy=None):
+        self.simType = simType
+        if not file:
+            file = os.path.dirname(__file__) + "/sim_backup.xml"
+        self.file = file
+        self.savePolicy = savePolicy
+        self.simXml = None
+        self.satCtrl = None
+        self.atr = None
+        # One request at a time.
+        self.lock = threading.Lock()
+        self.requests = ApduRing()
+        self.responses = ApduRing()
+        self.process = multiprocessing.Process(target=runWorker,
+            args=(cardClass, simType, self.requests, self.responses))
+        self.process.daemon = True
+        self.process.start()
+
+    def request(self, op, payload=""):
+        with self.lock:
+            if not self.process.is_alive():
+                raise Exception("Soft card process exited with code %r" %self.process.exitcode)
+            self.requests.put(chr(op) + payload)
+            while True:
+                response = self.responses.get(PROCESS_CHECK_INTERVAL)
+                if response != None:
+                    break
+                if not self.process.is_alive():
+                    raise Exception("Soft card process exited with code %r" %self.process.exitcode)
+        if ord(response[0]) == STATUS_ERROR:
+            raise Exception(response[1:])
+        return response[1:]
+
+    def connect(self):
+        self.atr = list(bytearray(self.request(OP_CONNECT, packImage(self.file, self.savePolicy))))
+
+    def init(self):
+        self.atr = list(bytearray(self.request(OP_INIT, packImage(self.file, self.savePolicy))))
+
+    def reset(self):
+        self.request(OP_RESET)
+
+    def disconnect(self):
+        self.request(OP_DISCONNECT)
+
+    def flush(self):
+        self.request(OP_FLUSH)
+
+    def getATR(self):
+        if self.atr == None:
+            self.atr = list(bytearray(self.request(OP_GET_ATR)))
+        return self.atr
+
+    def transmit(self, apdu):
+        response = self.request(OP_TRANSMIT, str(bytearray(apdu)))
+        return list(bytearray(response[SW.size:])), SW.unpack_from(response)[0]
+
+    def close(self):
+        """Stop the worker, the card image is saved."""
+        if not self.process.is_alive():
+            return
+        self.request(OP_STOP)
+        self.process.join()
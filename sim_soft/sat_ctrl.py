@@ -3,7 +3,6 @@
 # (c) 2014 Kamil Wartanowicz
 # (c) 2014 Szymon Mielczarek
 import logging
-import threading
 # TODO: check why the above import fails
 from sat_types import *
 from util import types_g
@@ -17,6 +16,9 @@ class SatCtrl(object):
         self.simType = simType
         self.simRouter = None
         self.simXml = simXml
+        self.reset()
+
+    def reset(self):
         self.commandNumber = 0x01
         self.proactiveMessage = []
         self.isMessagePending = False
@@ -24,6 +26,13 @@ class SatCtrl(object):
         self.responseHandler = []
         self.postActionHandler = []
 
+    def registerInsHandlers(self, register):
+        ins = types_g.iso7816
+        register(ins.TERMINAL_PROFILE, self.terminalProfile)
+        register(ins.TERMINAL_RESPONSE, self.terminalResponse)
+        register(ins.FETCH, self.fetch)
+        register(ins.ENVELOPE, self.envelope)
+
     def setSimRouter(self, simRouter):
         self.simRouter = simRouter
 
@@ -129,8 +138,7 @@ class SatCtrl(object):
         handlerDict = self.postActionHandler.pop(0)
         handler = handlerDict['handler']
         data = handlerDict['data']
-        self.postHandler = PostHandlerThread(self, handler, status, respData, data)
-        self.postHandler.setDaemon(True)
+        self.postHandler = PostHandler(self, handler, status, respData, data)
         self.postHandler.start()
 
     def stopPostActionHandler(self):
@@ -609,7 +617,7 @@ class SatCtrl(object):
             return
         self.displayText("Updating HPLMN, please wait...", duration=2)
         # TODO: add waiting dialog until postAction is finished.
-        self.assignPostActionHandler(PostHandlerThread.postPlmnSet, [simId, plmn])
+        self.assignPostActionHandler(PostHandler.postPlmnSet, [simId, plmn])
 
     def onPlmnSimIdGet(self, data):
         if self.simRouter and len(self.simRouter.cardsDict) > 1:
@@ -726,7 +734,7 @@ class SatCtrl(object):
     def onCardsListCallback(self, status, lan, handlerData):
         # TODO: try to omit displayText to trigger postActionHandler.
         self.displayText("Reading cards, please wait...", duration=4)
-        self.assignPostActionHandler(PostHandlerThread.postCardsList)
+        self.assignPostActionHandler(PostHandler.postCardsList)
 
     def satShell(self, param, value):
         param = param.lower()
@@ -769,27 +777,26 @@ class SatCtrl(object):
         '81':{'text': "Don't swap SIM cards"},
         }
 
-class PostHandlerThread(threading.Thread):
+class PostHandler(object):
+    """
+    Post-action handler, runs in a greenlet on the router main loop so the
+    shell calls of the handler don't block the loop.
+    """
     def __init__(self, satCtrl, handler, status, respData, data):
-        threading.Thread.__init__(self)
         self.satCtrl = satCtrl
         self.handler = handler
         self.status = status
         self.respData = respData
         self.data = data
         self.currentSimId = self.satCtrl.simRouter.simCtrl.srvId
-        threading.Thread.setName(self, 'PostHandlerThread')
-        self.__lock = threading.Lock()
+        self.shell = None
 
-    def startThread(self):
-        threading.Thread.start(self)
+    def start(self):
+        self.satCtrl.simRouter.spawnCall(self.run)
 
     def run(self):
-        self.__lock.acquire()
-        from sim import sim_shell
         self.shell = self.satCtrl.simRouter.shell
         self.handler(self, self.status, self.respData, self.data)
-        self.__lock.release()
 
     def stop(self):
         # Restore simId.
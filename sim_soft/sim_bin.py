@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# LICENSE: GPL2
+
+# Compact binary card image. It holds the same tree as sim_backup.xml,
+# but EF values are stored as raw bytes and read only when accessed.
+#
+#   header:   magic, version, flags, number of EFs, offsets of the sections
+#   skeleton: the xml tree without EF values and without indentation
+#   files:    offset and length of the value of each EF in document order
+#   bodies:   raw EF values
+
+import sys,os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import copy
+import mmap
+import re
+import struct
+from lxml import etree
+
+MAGIC = "SIMB"
+VERSION = 1
+
+# magic, version, flags, number of EFs, files offset, bodies offset
+HEADER = struct.Struct(">4sHHIII")
+# offset from the bodies offset, length
+FILE_ENTRY = struct.Struct(">II")
+# Offset of an EF without <value>.
+NO_VALUE = 0xFFFFFFFF
+
+WHITESPACE_RE = re.compile(r"\s+")
+
+def isBinaryImage(file):
+    with open(file, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def packImage(root, getBody=None):
+    """
+    Serialize the xml tree. getBody(ef) might return the raw value of the
+    EF, otherwise it's decoded from the <value> text.
+    """
+    skeleton = copy.deepcopy(root)
+    files = []
+    bodies = []
+    bodiesLength = 0
+    for ef, efSkeleton in zip(root.iter("ef"), skeleton.iter("ef")):
+        value = efSkeleton.find("value")
+        body = None
+        if getBody:
+            body = getBody(ef)
+        if body == None and value != None and value.text != None:
+            body = WHITESPACE_RE.sub("", value.text).decode("hex")
+        if value == None or body == None:
+            files.append(FILE_ENTRY.pack(NO_VALUE, 0))
+            continue
+        value.text = None
+        body = str(body)
+        files.append(FILE_ENTRY.pack(bodiesLength, len(body)))
+        bodies.append(body)
+        bodiesLength += len(body)
+    skeleton = etree.tostring(skeleton, encoding="utf-8")
+    filesOffset = HEADER.size + len(skeleton)
+    bodiesOffset = filesOffset + FILE_ENTRY.size * len(files)
+    header = HEADER.pack(MAGIC, VERSION, 0, len(files), filesOffset, bodiesOffset)
+    return header + skeleton + "".join(files) + "".join(bodies)
+
+class BinaryImage(object):
+    """Memory mapped binary card image."""
+    def __init__(self, file):
+        self.file = file
+        with open(file, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, flags, self.nbrOfFiles, self.filesOffset, self.bodiesOffset = \
+            HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise Exception("%s is not a binary card image" %file)
+        if version != VERSION:
+            raise Exception("Unsupported binary card image version: %d" %version)
+
+    def read(self):
+        """
+        Build the xml tree. Returns the root and the EF bodies, a dict of
+        EF element: (offset, length). The <value> of these EFs is empty.
+        """
+        root = etree.fromstring(self.map[HEADER.size:self.filesOffset])
+        return root, self.getBodies(root)
+
+    def getBodies(self, root):
+        """EF bodies of root, a tree with the same EFs as the image."""
+        bodies = {}
+        offset = self.filesOffset
+        for ef in root.iter("ef"):
+            bodyOffset, length = FILE_ENTRY.unpack_from(self.map, offset)
+            offset += FILE_ENTRY.size
+            if bodyOffset != NO_VALUE:
+                bodies[ef] = (bodyOffset, length)
+        return bodies
+
+    def getBody(self, offset, length):
+        start = self.bodiesOffset + offset
+        return bytearray(self.map[start:start + length])
+
+    def close(self):
+        self.map.close()
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    from sim_soft import sim_xml
+    parser = OptionParser(usage="%prog input output\n\n"
+                          "Convert a card image between xml and binary format. "
+                          "The output format is the opposite of the input.")
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.error("Expecting input and output file")
+    if isBinaryImage(args[0]):
+        sim_xml.convertImage(args[0], args[1], sim_xml.FORMAT_XML)
+    else:
+        sim_xml.convertImage(args[0], args[1], sim_xml.FORMAT_BIN)
@@ -22,9 +22,14 @@ class LogicalChannel:
 
 class SimHandler(object):
     def __init__(self, simXml, satCtrl, simType):
+        self.simType = simType
+        self.simXml = simXml
+        self.satCtrl = satCtrl
+        self.reset()
+
+    def reset(self):
         # Create available channels
         self.logicalChannel = []
-        self.simType = simType
         for i in range(types.MAX_LOGICAL_CHANNELS):
             channel = LogicalChannel()
             self.logicalChannel.append(channel)
@@ -32,11 +37,31 @@ class SimHandler(object):
         # Logical channel 0 (basic) is always open
         self.currentChannel = self.logicalChannel[0]
         self.currentChannel.isOpen = True
-
-        self.simXml = simXml
-        self.satCtrl = satCtrl
         self.responseData = []
 
+    def registerInsHandlers(self, register):
+        ins = types_g.iso7816
+        register(ins.SELECT_FILE, self.select)
+        register(ins.GET_RESPONSE, self.getResponse)
+        register(ins.READ_BINARY, self.readBinary)
+        register(ins.VERIFY_PIN, self.verifyPin)
+        register(ins.UNBLOCK_PIN, self.unblockPin)
+        register(ins.CHANGE_PIN, self.changePin)
+        register(ins.ENABLE_PIN, self.enablePin)
+        register(ins.DISABLE_PIN, self.disablePin)
+        register(ins.STATUS, self.status)
+        register(ins.SEARCH_RECORD, self.searchRecord)
+        register(ins.READ_RECORD, self.readRecord)
+        register(ins.UPDATE_BINARY, self.updateBinary)
+        register(ins.UPDATE_RECORD, self.updateRecord)
+        register(ins.DEACTIVATE_FILE, self.deactivateFile)
+        register(ins.ACTIVATE_FILE, self.activateFile)
+        register(ins.MANAGE_CHANNEL, self.manageChannel)
+        register(ins.INTERNAL_AUTHENTICATE, self.authenticate)
+        register(ins.CREATE_FILE, self.createFile)
+        register(ins.DELETE_FILE, self.deleteFile)
+        register(ins.RESIZE_FILE, self.resizeFile)
+
     def isChannelOpen(self, chId):
         return self.logicalChannel[chId].isOpen
 
@@ -705,8 +730,7 @@ class SimHandler(object):
             if length > 256:
                 length = 256
 
-        data = self.simXml.getBinaryValue(file)
-        data = data[offset:length]
+        data = self.simXml.getBinaryValueSlice(file, offset, length)
 
         return data, sw
 
@@ -739,9 +763,7 @@ class SimHandler(object):
             sw = types_g.sw.WRONG_LENGTH
             return data, sw
 
-        data = self.simXml.getBinaryValue(file)
-        data[offset : length] = value
-        self.simXml.setBinaryValue(file, data)
+        self.simXml.updateBinaryValue(file, offset, length, value)
         data = []
         return data, sw
 
@@ -8,6 +8,7 @@ import os
 import sys
 import traceback
 
+import card_process
 import sim_xml
 import sim_soft
 import sat_ctrl
@@ -15,114 +16,116 @@ import sat_ctrl
 from util import types_g
 from util import types
 
+# Logical channel number in the CLA byte
+CHANNEL_MASK = 0b00000011
+SW_CLASS_NOT_SUPPORTED = types_g.sw.CLASS_NOT_SUPPORTED
+SW_LOGICAL_CHANNEL_NOT_SUPPORTED = types_g.sw.LOGICAL_CHANNEL_NOT_SUPPORTED
+# Run each soft card in its own worker process.
+CARD_PROCESS = False
+
 class SoftCard(object):
-    def __init__(self, simType=types.TYPE_USIM, file=None):
+    def __init__(self, simType=types.TYPE_USIM, file=None, savePolicy=None):
         self.simType = simType
         if not file:
             file = os.path.dirname(__file__) + "/sim_backup.xml"
         self.file = file
+        self.savePolicy = savePolicy
+        self.simXml = None
+        self.satCtrl = None
 
     def connect(self):
-        self.init()
+        if self.simXml and self.simXml.file == self.file:
+            # The image is loaded only once, connect works like a reset.
+            self.reset()
+        else:
+            self.init()
+
+    def disconnect(self):
+        if self.simXml:
+            self.simXml.flush()
+
+    def flush(self):
+        self.simXml.flush()
+
+    def close(self):
+        """Write the pending changes and release the image."""
+        if self.simXml:
+            self.simXml.close()
+            self.simXml = None
 
     def init(self):
-        #TODO: check if already opened, then close might be needed
-        self.simXml = sim_xml.SimXml(self.file)
+        """(Re)load the card image and create the handlers."""
+        if self.simXml:
+            # Write pending changes before the image is read again.
+            self.simXml.close()
+        self.simXml = sim_xml.SimXml(self.file, self.savePolicy)
+        self.atr = self.simXml.getAtr()
+        simRouter = None
+        if self.satCtrl:
+            simRouter = self.satCtrl.simRouter
         self.satCtrl = sat_ctrl.SatCtrl(types.TYPE_SIM, self.simXml)
+        self.satCtrl.setSimRouter(simRouter)
         self.simHandler = sim_soft.SimHandler(self.simXml, self.satCtrl, self.simType)
+        # Instruction handlers by INS byte.
+        self.insHandlers = {}
+        self.simHandler.registerInsHandlers(self.registerInsHandler)
+        self.satCtrl.registerInsHandlers(self.registerInsHandler)
+
+    def reset(self):
+        """Clear the volatile card state, the image is not read again."""
+        with self.simXml.lock:
+            self.simXml.reset()
+            self.satCtrl.reset()
+            self.simHandler.reset()
 
     def getATR(self):
-        self.init()
-        return self.simXml.getAtr()
+        if not self.simXml:
+            self.init()
+        return self.atr
 
     def transmit(self, apdu):
         try:
-            return self._transmit(apdu)
+            with self.simXml.lock:
+                return self._transmit(apdu)
         except:
             exc_type, exc_value, exc_traceback = sys.exc_info()
             stackTrace = "".join(traceback.format_tb(exc_traceback))
             error = exc_value
             raise Exception("%s\nError: %s" %(stackTrace, error))
 
-    def _transmit(self, apdu):
-        sw = 0x9000
-        data = []
+    def registerInsHandler(self, ins, handler):
+        """
+        Register handler(apdu) for the INS byte. The handler
+        returns (data, sw) tuple.
+        """
+        self.insHandlers[ins] = handler
 
-        channel = types.channel(apdu)
-        if channel > types.MAX_LOGICAL_CHANNELS - 1:
-            sw = types_g.sw.CLASS_NOT_SUPPORTED
-            return data, sw
+    def _transmit(self, apdu):
+        channel = apdu[0] & CHANNEL_MASK
+        if channel >= types.MAX_LOGICAL_CHANNELS:
+            return [], SW_CLASS_NOT_SUPPORTED
 
         # Check if the channel is open
-        if self.simHandler.isChannelOpen(channel) == False:
-            sw = types_g.sw.LOGICAL_CHANNEL_NOT_SUPPORTED
-            return data, sw
+        if not self.simHandler.isChannelOpen(channel):
+            return [], SW_LOGICAL_CHANNEL_NOT_SUPPORTED
         # TODO: open channel through SELECT command
         self.simHandler.setChannel(channel)
 
-        ins = types.insName(apdu)
-        if ins == "SELECT_FILE":
-            data, sw = self.simHandler.select(apdu)
-        elif ins == "GET_RESPONSE":
-            data, sw = self.simHandler.getResponse(apdu)
-        elif ins == "READ_BINARY":
-            data, sw = self.simHandler.readBinary(apdu)
-        elif ins == "VERIFY_PIN":
-            data, sw = self.simHandler.verifyPin(apdu)
-        elif ins == "UNBLOCK_PIN":
-            data, sw = self.simHandler.unblockPin(apdu)
-        elif ins == "CHANGE_PIN":
-            data, sw = self.simHandler.changePin(apdu)
-        elif ins == "ENABLE_PIN":
-            data, sw = self.simHandler.enablePin(apdu)
-        elif ins == "DISABLE_PIN":
-            data, sw = self.simHandler.disablePin(apdu)
-        elif ins == "STATUS":
-            data, sw = self.simHandler.status(apdu)
-        elif ins == "SEARCH_RECORD":
-            data, sw = self.simHandler.searchRecord(apdu)
-        elif ins == "READ_RECORD":
-            data, sw = self.simHandler.readRecord(apdu)
-        elif ins == "UPDATE_BINARY":
-            data, sw = self.simHandler.updateBinary(apdu)
-        elif ins == "UPDATE_RECORD":
-            data, sw = self.simHandler.updateRecord(apdu)
-        elif ins == "DEACTIVATE_FILE":
-            data, sw = self.simHandler.deactivateFile(apdu)
-        elif ins == "ACTIVATE_FILE":
-            data, sw = self.simHandler.activateFile(apdu)
-        elif ins == "TERMINAL_PROFILE":
-            data, sw = self.satCtrl.terminalProfile(apdu)
-        elif ins == "TERMINAL_RESPONSE":
-            data, sw = self.satCtrl.terminalResponse(apdu)
-        elif ins == "FETCH":
-            data, sw = self.satCtrl.fetch(apdu)
-        elif ins == "ENVELOPE":
-            data, sw = self.satCtrl.envelope(apdu)
-        elif ins == "MANAGE_CHANNEL":
-            data, sw = self.simHandler.manageChannel(apdu)
-        elif ins == 'INTERNAL_AUTHENTICATE':
-            data, sw = self.simHandler.authenticate(apdu)
-        elif ins == "CREATE_FILE":
-            data, sw = self.simHandler.createFile(apdu)
-        elif ins == "DELETE_FILE":
-            data, sw = self.simHandler.deleteFile(apdu)
-        elif ins == "RESIZE_FILE":
-            data, sw = self.simHandler.resizeFile(apdu)
-        elif ins == 'DE':
-            data, sw = self.simHandler.unknownInstruction()
-        else:
-            raise Exception("Invalid instruction: %s" %ins)
-
-        return data, sw
+        handler = self.insHandlers.get(apdu[1])
+        if handler == None:
+            return self.simHandler.unknownInstruction()
+        return handler(apdu)
 
 class SoftReader(object):
     def __init__(self, name):
         self.name = name
         self.card = None
 
-    def createConnection(self, type=types.TYPE_SIM):
-        self.card = SoftCard(simType=type)
+    def createConnection(self, type=types.TYPE_SIM, process=False):
+        if process:
+            self.card = card_process.SoftCardProcess(SoftCard, simType=type)
+        else:
+            self.card = SoftCard(simType=type)
         return self.card
 
 reader1 = SoftReader('Soft SIM reader 0')
@@ -152,10 +155,28 @@ class SimSoftCtrl(object):
         logger.addHandler(fileHndl)
         self.logging = logger
         self.readers = []
+        # Soft cards by reader index, kept between connections (e.g. on
+        # reset) so the card image is loaded only once. Dropped with the
+        # reader.
+        self.cards = {}
+        # Card image and save policy by reader index.
+        self.images = {}
+        self.cardProcess = CARD_PROCESS
         self.simType = type
 
     def close(self):
-        pass
+        for index in self.cards.keys():
+            self.dropCard(index)
+
+    def dropCard(self, index):
+        """Forget the soft card of the reader, its pending changes are written."""
+        card = self.cards.pop(index, None)
+        if card:
+            card.close()
+
+    def setCardProcess(self, enable):
+        """Run soft cards created from now on in worker processes."""
+        self.cardProcess = enable
 
     def getReader(self, index):
         for reader in self.readers:
@@ -208,23 +229,40 @@ class SimSoftCtrl(object):
     def removeReader(self, index):
         self.logFunctionAndArgs()
         self.checkReader(index)
-        for reader in self.readers:
-            if reader.index == index:
-                del reader
+        self.readers = [reader for reader in self.readers if reader.index != index]
+        self.dropCard(index)
         self.logReturnVal()
         return None
 
     def removeAllReaders(self):
         self.logFunctionAndArgs()
-        for reader in self.readers:
-            del reader
+        self.readers = []
+        for index in self.cards.keys():
+            self.dropCard(index)
         self.logReturnVal()
         return None
 
+    def setCardImage(self, index, file, savePolicy=None):
+        """
+        Use the card image file for the soft card of the reader. It's
+        loaded on the next connect.
+        """
+        self.images[index] = (file, savePolicy)
+        card = self.cards.get(index)
+        if card:
+            card.file, card.savePolicy = self.images[index]
+
     def r_createConnection(self, index):
         self.logFunctionAndArgs()
         self.checkReader(index)
-        self.getReader(index).card = self.getReader(index).reader.createConnection(type=self.simType)
+        card = self.cards.get(index)
+        if not card:
+            card = self.getReader(index).reader.createConnection(type=self.simType,
+                                                                 process=self.cardProcess)
+            if index in self.images:
+                card.file, card.savePolicy = self.images[index]
+            self.cards[index] = card
+        self.getReader(index).card = card
         return None
 
     def c_connect(self, index):
@@ -257,11 +295,24 @@ class SimSoftCtrl(object):
         self.logReturnVal(data=data, sw1=sw1, sw2=sw2)
         return data, sw1, sw2
 
+    def c_transmit_many(self, apdus, index, stopOnError=False):
+        self.logFunctionAndArgs()
+        self.checkCard(index)
+        card = self.getCard(index)
+        def transmit(apdu):
+            data, sw = card.transmit(apdu)
+            return data, sw >> 8, sw & 0x00FF
+        responses = types.transmitMany(transmit, apdus, stopOnError)
+        self.logReturnVal(responses=responses)
+        return responses
+
     def logFunctionAndArgs(self):
-        frame = inspect.getouterframes(inspect.currentframe())[1][0]
+        if not self.logging.isEnabledFor(logging.INFO):
+            return
+        # Caller's frame, inspect.getouterframes() would read source files.
+        frame = sys._getframe(1)
         args, _, _, values = inspect.getargvalues(frame)
-        frameinfo = inspect.getframeinfo(frame)
-        functionName=inspect.getframeinfo(frame)[2]
+        functionName = frame.f_code.co_name
         output = ""
         for arg in args[1:]: #[1:] skip the first argument 'self'
             value = values[arg]
@@ -287,6 +338,8 @@ class SimSoftCtrl(object):
         self.logging.info("--> "+functionName+'('+output+')')
 
     def logReturnVal(self, **kwargs):
+        if not self.logging.isEnabledFor(logging.INFO):
+            return
         output = ""
         for key, value in kwargs.iteritems():
             if isinstance(value, str):
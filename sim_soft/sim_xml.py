@@ -4,10 +4,15 @@
 
 import sys,os.path
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import atexit
 import logging
+import re
+import threading
+import weakref
 from lxml import etree
 import shutil
 
+import sim_bin
 from util import types
 from util import hextools
 
@@ -28,6 +33,20 @@ CODE_ENABLED = "1"
 CODE_VERIFIED = "1"
 CODE_NOT_VERIFIED = "0"
 
+# Policies of writing the card image back to the xml file.
+SAVE_IMMEDIATE = 0 # write on every change
+SAVE_BATCHED = 1 # write after SAVE_BATCH_INTERVAL ms or SAVE_BATCH_WRITES changes
+SAVE_ON_RESET = 2 # write on card reset/disconnect
+SAVE_EXPLICIT = 3 # write only when flush() is called
+
+SAVE_POLICY = SAVE_IMMEDIATE
+SAVE_BATCH_INTERVAL = 500 #ms
+SAVE_BATCH_WRITES = 20
+
+# Card image formats, see sim_bin for the binary one.
+FORMAT_XML = 0
+FORMAT_BIN = 1
+
 __version__ = "1.0"
 
 def getParamValue(paramStr, paramName):
@@ -174,10 +193,82 @@ def writeXml(simXmlFile, root):
                                   pretty_print=True,
                                   xml_declaration=True,
                                   encoding='utf-8')
-
-    file = open(simXmlFile, mode="w")
-    file.write(xml_document)
+    writeFile(simXmlFile, xml_document)
+
+def writeFile(fileName, data):
+    # Write to a temporary file and rename it, so a crash never leaves
+    # a truncated card image.
+    tmpFile = fileName + ".tmp"
+    file = open(tmpFile, mode="wb")
+    file.write(data)
+    file.flush()
+    os.fsync(file.fileno())
     file.close()
+    replaceFile(tmpFile, fileName)
+
+def replaceFile(tmpFile, fileName):
+    try:
+        os.rename(tmpFile, fileName)
+    except OSError:
+        # Windows doesn't allow to rename onto an existing file.
+        os.remove(fileName)
+        os.rename(tmpFile, fileName)
+
+class XmlStreamWriter(object):
+    """
+    Writes a card image node by node, without building the whole tree.
+    Nodes are created with the add*Node() functions on self.root and
+    written with write() or startDir()/endDir(). Output is the same
+    as of writeXml().
+    """
+    def __init__(self, fileName, atr):
+        self.fileName = fileName
+        self.tmpFile = fileName + ".tmp"
+        self.file = open(self.tmpFile, mode="wb")
+        self.root = xmlInit(atr)
+        self.dirs = []
+        head = etree.tostring(etree.ElementTree(self.root),
+                              pretty_print=True,
+                              xml_declaration=True,
+                              encoding='utf-8')
+        # Without the closing tag of the root.
+        self.file.write(head[:head.rindex("</")])
+        for node in list(self.root):
+            self.root.remove(node)
+
+    def writeLines(self, lines):
+        indent = "  " * (len(self.dirs) + 1)
+        self.file.write("".join([indent + line + "\n" for line in lines]))
+
+    def serialize(self, node):
+        self.root.remove(node)
+        return etree.tostring(node, pretty_print=True, encoding='utf-8').splitlines()
+
+    def write(self, node):
+        self.writeLines(self.serialize(node))
+
+    def startDir(self, node):
+        """Write the node without its closing tag, nodes are added to it until endDir()."""
+        self.writeLines(self.serialize(node)[:-1])
+        self.dirs.append(node.tag)
+
+    def endDir(self):
+        tag = self.dirs.pop()
+        self.writeLines(["</%s>" %tag])
+
+    def close(self):
+        while self.dirs:
+            self.endDir()
+        self.file.write("</%s>\n" %self.root.tag)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        replaceFile(self.tmpFile, self.fileName)
+
+def convertImage(inFile, outFile, format):
+    simXml = SimXml(inFile, SAVE_EXPLICIT)
+    simXml.writeImage(outFile, format)
+    simXml.close()
 
 def readXml(file):
     tree = etree.ElementTree()
@@ -185,9 +276,177 @@ def readXml(file):
     root = etree.parse(file, parser).getroot()
     return root
 
+# SimXml instances with changes which might not be written yet.
+simXmlInstances = weakref.WeakSet()
+
+def flushAll():
+    for simXml in list(simXmlInstances):
+        simXml.flush()
+
+atexit.register(flushAll)
+
+class SimXmlWriter(object):
+    """Writes the card image according to the selected save policy."""
+    def __init__(self, simXml, policy=None,
+                 batchInterval=None, batchWrites=None):
+        self.simXml = weakref.proxy(simXml)
+        if policy == None:
+            policy = SAVE_POLICY
+        if batchInterval == None:
+            batchInterval = SAVE_BATCH_INTERVAL
+        if batchWrites == None:
+            batchWrites = SAVE_BATCH_WRITES
+        self.policy = policy
+        self.batchInterval = batchInterval
+        self.batchWrites = batchWrites
+        self.pendingWrites = 0
+        self.timer = None
+        self.lock = simXml.lock
+
+    def modified(self):
+        with self.lock:
+            self.pendingWrites += 1
+            if self.policy == SAVE_IMMEDIATE:
+                self._write()
+            elif self.policy == SAVE_BATCHED:
+                if self.pendingWrites >= self.batchWrites:
+                    self._write()
+                elif not self.timer:
+                    self.timer = threading.Timer(self.batchInterval / 1000.0,
+                                                 self.flush)
+                    self.timer.setDaemon(True)
+                    self.timer.start()
+
+    def reset(self):
+        if self.policy != SAVE_EXPLICIT:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.pendingWrites:
+                self._write()
+
+    def _write(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        self.pendingWrites = 0
+        self.simXml.syncValues()
+        self.simXml.writeImage(self.simXml.file)
+
+MF_PATH = "./mf[@id='3F00']"
+PATH_COMPONENT_RE = re.compile(r"^(\*|mf|df|ef)(?:\[@id='([^']+)'\])?$")
+
+def pathToKey(path):
+    """
+    Convert a path used by SimHandler (e.g. "./mf/df[@id='7F20']/ef[@id='6F07']")
+    into a tuple of (tag, file id) pairs,
+    e.g. (('mf', '3F00'), ('df', '7F20'), ('ef', '6F07')).
+    Returns None if the path cannot be converted.
+    """
+    if not path or not path.startswith("./mf"):
+        return None
+    key = []
+    for component in path[2:].split("/"):
+        match = PATH_COMPONENT_RE.match(component)
+        if not match:
+            return None
+        tag, id = match.groups()
+        if tag == "mf":
+            if key or id not in (None, "3F00"):
+                return None
+            id = "3F00"
+        elif not key or not id:
+            return None
+        key.append((tag, id))
+    return tuple(key)
+
+class FileNode(object):
+    """Decoded attributes of a file node in the card image."""
+    type = types.FILE_TYPE_RFU
+    attributes = ("sfi", "arr_id", "arr_rule")
+
+    def __init__(self, element, path, key):
+        self.element = element
+        self.path = path
+        self.key = key
+        self.id = element.attrib['id']
+        for name in self.attributes:
+            self.decode(name)
+
+    def decode(self, name):
+        subNode = self.element.find(name)
+        text = None
+        if subNode != None:
+            text = subNode.text
+        if name == "sfi":
+            self.sfi = text
+        elif name == "arr_id":
+            self.arrId = text
+        elif name == "arr_rule":
+            self.arrRule = toInt(text)
+
+class DfNode(FileNode):
+    type = types.FILE_TYPE_DF
+
+class MfNode(DfNode):
+    type = types.FILE_TYPE_MF
+
+class AdfNode(DfNode):
+    attributes = DfNode.attributes + ("aid",)
+
+    def decode(self, name):
+        if name == "aid":
+            self.aid = self.element.find(name).text
+        else:
+            DfNode.decode(self, name)
+
+class EfNode(FileNode):
+    type = types.FILE_TYPE_EF
+    attributes = FileNode.attributes + ("struct", "size", "record_len",
+                                        "invalidated", "value")
+
+    def decode(self, name):
+        if name == "value":
+            # Decoded lazily, see getBuffer().
+            self.buffer = None
+            self.dirty = False
+        elif name == "struct":
+            self.struct = toInt(self.element.findtext(name))
+        elif name == "size":
+            self.size = toInt(self.element.findtext(name))
+        elif name == "record_len":
+            self.recordLen = toInt(self.element.findtext(name))
+        elif name == "invalidated":
+            self.invalidated = toInt(self.element.findtext(name))
+        else:
+            FileNode.decode(self, name)
+
+def toInt(text):
+    try:
+        return int(text)
+    except:
+        return None
+
+def createNode(element, path, key):
+    tag = element.tag
+    if tag == "mf":
+        return MfNode(element, path, key)
+    elif tag == "df":
+        if element.find("aid") != None:
+            return AdfNode(element, path, key)
+        return DfNode(element, path, key)
+    elif tag == "ef":
+        return EfNode(element, path, key)
+    return None
+
 class SimXml(object):
-    def __init__(self, file):
+    def __init__(self, file, savePolicy=None):
         self.file = file
+        # Protects the xml tree when it's written from the batch timer.
+        self.lock = threading.RLock()
+        self.writer = SimXmlWriter(self, savePolicy)
+        simXmlInstances.add(self)
         createXml = not os.path.exists(self.file)
         if createXml:
             origFile = self.file + ".bak"
@@ -195,11 +454,107 @@ class SimXml(object):
                 raise Exception("Default xml file: %s not found" %origFile)
             shutil.copy2(origFile, file)
             logging.info("Default xml file restored")
-        self.root = readXml(file)
+        # EF values not read yet from the binary image, by EF element.
+        self.bodies = {}
+        if sim_bin.isBinaryImage(file):
+            self.format = FORMAT_BIN
+            self.image = sim_bin.BinaryImage(file)
+            self.root, self.bodies = self.image.read()
+        else:
+            self.format = FORMAT_XML
+            self.image = None
+            self.root = readXml(file)
+        self.buildIndex()
         self.reset()
 
+    def buildIndex(self):
+        # Index of file nodes by ids path, e.g. ('3F00', '7F20', '6F07').
+        self.files = {}
+        # Typed file node for every lxml file element.
+        self.nodes = {}
+        # ADFs by AID value.
+        self.aids = {}
+        # EFs with the decoded value not written back to the <value> text.
+        self.dirtyFiles = set()
+        self.chvs = {}
+        chvRoot = self.root.find("./chv")
+        if chvRoot != None:
+            for child in chvRoot:
+                self.chvs[child.tag] = child
+        mf = self.root.find("./mf")
+        if mf != None:
+            self.indexFile(mf, None)
+
+    def indexFile(self, element, parent):
+        id = element.attrib['id']
+        if parent == None:
+            path = MF_PATH
+            key = (("mf", id),)
+        else:
+            path = "%s/%s[@id='%s']" %(parent.path, element.tag, id)
+            key = parent.key + ((element.tag, id),)
+        node = createNode(element, path, key)
+        if node == None:
+            return
+        self.nodes[element] = node
+        ids = tuple([fid for _, fid in key])
+        # The first file with the given id wins (the same as for XPath).
+        if ids not in self.files:
+            self.files[ids] = node
+        if isinstance(node, AdfNode) and isinstance(parent, MfNode):
+            if node.aid not in self.aids:
+                self.aids[node.aid] = element
+        for child in element:
+            if child.tag in ("df", "ef"):
+                self.indexFile(child, node)
+
+    def unindexFile(self, element):
+        node = self.nodes.pop(element, None)
+        if node == None:
+            return
+        ids = tuple([fid for _, fid in node.key])
+        if self.files.get(ids) is node:
+            del self.files[ids]
+        self.dirtyFiles.discard(node)
+        self.bodies.pop(element, None)
+        if isinstance(node, AdfNode) and self.aids.get(node.aid) is element:
+            del self.aids[node.aid]
+        for child in element:
+            self.unindexFile(child)
+
+    def getNode(self, file):
+        return self.nodes.get(file)
+
+    def lookup(self, path):
+        key = pathToKey(path)
+        if key == None:
+            # Not a path created by SimHandler, use XPath.
+            return self.root.find(path)
+        return self.lookupKey(key)
+
+    def lookupKey(self, key):
+        node = self.files.get(tuple([fid for _, fid in key]))
+        if node == None:
+            return None
+        for (tag, _), (nodeTag, _) in zip(key, node.key):
+            if tag != "*" and tag != nodeTag:
+                return None
+        return node.element
+
     def reset(self):
         self.SetChvNotVerified()
+        self.writer.reset()
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        """Write the pending changes and unmap the binary image."""
+        self.flush()
+        simXmlInstances.discard(self)
+        if self.image:
+            self.image.close()
+            self.image = None
 
     def getApplications(self):
         # Read all AIDs from EF_DIR
@@ -219,7 +574,53 @@ class SimXml(object):
     def getParentDir(self, dir):
         return dir.replace("/%s" %dir.split("/")[-1], "")
 
+    def save(self):
+        self.writer.modified()
+
+    def syncValues(self):
+        # Regenerate the hex text of modified EFs.
+        for node in self.dirtyFiles:
+            node.element.find("value").text = hextools.bytes2hex(node.buffer)
+            node.dirty = False
+        self.dirtyFiles.clear()
+
+    def loadValue(self, file):
+        # Fill the <value> text of an EF from the binary image.
+        file.find("value").text = hextools.bytes2hex(self.getRawValue(file))
+        del self.bodies[file]
+
+    def getRawValue(self, file):
+        node = self.nodes.get(file)
+        if node != None and node.buffer != None:
+            return node.buffer
+        if file in self.bodies:
+            return self.image.getBody(*self.bodies[file])
+        return None
+
+    def writeImage(self, file, format=None):
+        if format == None:
+            format = self.format
+        if format == FORMAT_BIN:
+            writeFile(file, sim_bin.packImage(self.root, self.getRawValue))
+            if self.image and file == self.file:
+                # The old map holds the replaced file, read the rest from the new one.
+                image = sim_bin.BinaryImage(file)
+                bodies = image.getBodies(self.root)
+                self.bodies = dict([(ef, bodies[ef]) for ef in self.bodies])
+                self.image.close()
+                self.image = image
+        else:
+            for ef in self.bodies.keys():
+                self.loadValue(ef)
+            writeXml(file, self.root)
+
     def get(self, node, name):
+        if name == "value":
+            fileNode = self.nodes.get(node)
+            if node in self.bodies:
+                self.loadValue(node)
+            elif fileNode != None and fileNode.dirty:
+                self.syncValues()
         subNode = node.find(name)
         if subNode == None:
             raise Exception("%s has no '%s' node" %(node.attrib['id'], name))
@@ -237,25 +638,75 @@ class SimXml(object):
     def set(self, node, name, text, save=True):
         subNode = node.find(name)
         subNode.text = text
+        if name == "value":
+            self.bodies.pop(node, None)
+        fileNode = self.nodes.get(node)
+        if fileNode != None and name in fileNode.attributes:
+            self.dirtyFiles.discard(fileNode)
+            fileNode.decode(name)
         if save:
-            writeXml(self.file, self.root)
+            self.save()
 
     def setValue(self, node, text):
         self.set(node, "value", text)
 
+    def getBuffer(self, file):
+        # Decoded value of an EF, kept in memory between commands.
+        node = self.nodes.get(file)
+        if not isinstance(node, EfNode):
+            return None
+        if node.buffer == None and file in self.bodies:
+            node.buffer = self.image.getBody(*self.bodies[file])
+        elif node.buffer == None:
+            hexStr = self.getValue(file)
+            node.buffer = bytearray(hexStr.replace(" ", "").replace("\n", "").decode("hex"))
+        return node.buffer
+
     def getBinaryValue(self, file):
+        buffer = self.getBuffer(file)
+        if buffer != None:
+            return list(buffer)
         hexStr = self.getValue(file)
         return hextools.hex2bytes(hexStr.replace(" ", "").replace("\n", ""))
 
+    def getBinaryValueSlice(self, file, start, end):
+        buffer = self.getBuffer(file)
+        if buffer == None:
+            return self.getBinaryValue(file)[start:end]
+        return list(buffer[start:end])
+
     def setBinaryValue(self, file, data):
-        value = hextools.bytes2hex(data)
-        #value = bytesToXmlValue(data)
-        self.setValue(file, value)
+        node = self.nodes.get(file)
+        if not isinstance(node, EfNode):
+            value = hextools.bytes2hex(data)
+            self.setValue(file, value)
+            return
+        node.buffer = bytearray(data)
+        self.setBufferModified(node)
+
+    def updateBinaryValue(self, file, start, end, data):
+        buffer = self.getBuffer(file)
+        if buffer == None:
+            value = self.getBinaryValue(file)
+            value[start:end] = data
+            self.setBinaryValue(file, value)
+            return
+        buffer[start:end] = bytearray(data)
+        self.setBufferModified(self.nodes[file])
+
+    def setBufferModified(self, node):
+        self.bodies.pop(node.element, None)
+        node.dirty = True
+        self.dirtyFiles.add(node)
+        self.save()
 
     def getBinaryFromText(self, node):
         return hextools.hex2bytes(node.text.replace(" ", ""))
 
     def getFileType(self, file):
+        node = self.nodes.get(file)
+        if node != None:
+            return node.type
         typeStr = file.tag
         if typeStr == "mf":
             type = types.FILE_TYPE_MF
@@ -268,17 +719,25 @@ class SimXml(object):
         return type
 
     def getEfDir(self):
-        return self.root.find("./mf/ef[@id='2F00']")
+        return self.lookupKey((("mf", "3F00"), ("ef", "2F00")))
 
     def getFileAid(self, file):
         if self.getFileType(file) != types.FILE_TYPE_DF:
             raise Exception("Expecting DF")
+        node = self.nodes.get(file)
+        if isinstance(node, AdfNode):
+            return node.aid
         return self.get(file, "aid")
 
     def setFileAid(self, file, aid):
         if self.getFileType(file) != types.FILE_TYPE_DF:
             raise Exception("Expecting DF")
+        node = self.nodes.get(file)
+        if isinstance(node, AdfNode) and self.aids.get(node.aid) is file:
+            del self.aids[node.aid]
         self.set(file, "aid", aid, save="False")
+        if isinstance(node, AdfNode) and node.aid not in self.aids:
+            self.aids[node.aid] = file
 
     def getFileId(self, file):
         return file.attrib['id']
@@ -286,11 +745,17 @@ class SimXml(object):
     def getFileStruct(self, file):
         if self.getFileType(file) != types.FILE_TYPE_EF:
             raise Exception("Expecting EF")
+        node = self.nodes.get(file)
+        if node != None:
+            return node.struct
         return self.getInt(file, "struct")
 
     def getFileSize(self, file):
         if self.getFileType(file) != types.FILE_TYPE_EF:
             raise Exception("Expecting EF")
+        node = self.nodes.get(file)
+        if node != None:
+            return node.size
         return self.getInt(file, "size")
 
     def setFileSize(self, file, size):
@@ -301,6 +766,9 @@ class SimXml(object):
     def getPathFromFile(self, file):
         if file == None:
             return
+        node = self.nodes.get(file)
+        if node != None:
+            return node.path
         pathXml = etree.ElementTree(self.root).getpath(file)
         pathXml = pathXml.split("mf")[1]
         path = "./mf[@id='3F00']"
@@ -317,6 +785,15 @@ class SimXml(object):
 
     def findFileInParrent(self, dir, id):
         #Search recursively until an ADF or the MF is reached.
+        key = pathToKey(dir)
+        if key != None:
+            while 1:
+                file = self.lookupKey(key + (("*", id),))
+                if file != None:
+                    return file
+                if len(key) == 1:
+                    return None
+                key = key[:-1]
         while 1:
             file = self.findFileInDir(dir, id)
             if file !=  None:
@@ -328,63 +805,48 @@ class SimXml(object):
             dir = self.getParentDir(dir)
 
     def findFileInDir(self, dir, id):
-        if id != "3F00":
-            path = dir + "/*[@id='" + id + "']"
-        else:
-            path = "./mf"
-        return self.root.find(path)
+        if id == "3F00":
+            return self.lookupKey((("mf", "3F00"),))
+        key = pathToKey(dir)
+        if key == None:
+            return self.root.find(dir + "/*[@id='" + id + "']")
+        return self.lookupKey(key + (("*", id),))
 
     def findAdf(self, aid):
         aidValue = bytesToXmlValue(aid)
-        path = "./mf/*[aid='" + aidValue + "']"
-        return self.root.find(path)
+        return self.aids.get(aidValue)
 
     def findFile(self, path):
         if path != None:
-            return self.root.find(path)
+            return self.lookup(path)
         else:
             return None
 
-    def countChildDf(self, dir):
-        #dir = self.currentDir
-
-        filePath = "%s/df" %dir
-        files = self.root.findall(filePath)
-
-        if not files:
+    def countChild(self, dir, tag):
+        file = self.findFile(dir)
+        if file == None:
             return 0
-        else:
-            return len(files)
-
-    def countChildEf(self, dir):
-        #dir = self.currentDir
+        return len([child for child in file if child.tag == tag])
 
-        filePath = "%s/ef" %dir
-        files = self.root.findall(filePath)
+    def countChildDf(self, dir):
+        return self.countChild(dir, "df")
 
-        if not files:
-            return 0
-        else:
-            return len(files)
+    def countChildEf(self, dir):
+        return self.countChild(dir, "ef")
 
     def getFileRecord(self, file, record):
         recordLength = self.getFileRecordLength(file)
         if not recordLength:
             return []
-        fileSize = self.getFileSize(file)
-        value = self.getBinaryValue(file)
         start = (record-1) * recordLength
         end = start + recordLength
-        return value[start:end]
+        return self.getBinaryValueSlice(file, start, end)
 
     def updateFileRecord(self, file, record, data):
         recordLength = self.getFileRecordLength(file)
-        fileSize = self.getFileSize(file)
-        value = self.getBinaryValue(file)
         start = (record-1) * recordLength
         end = start + len(data)
-        value[start:end] = data
-        self.setBinaryValue(file, value)
+        self.updateBinaryValue(file, start, end, data)
 
 
     def getFileRecordLength(self, file):
@@ -393,6 +855,9 @@ class SimXml(object):
         if self.getFileStruct(file) == types.FILE_STRUCTURE_TRANSPARENT:
             logging.warning("Record not available for transparent EF")
             return None
+        node = self.nodes.get(file)
+        if node != None:
+            return node.recordLen
         return self.getInt(file, "record_len")
 
     def getFileNumberOfRecords(self, file):
@@ -402,26 +867,23 @@ class SimXml(object):
         return numOfRecords
 
     def getChv(self, chv):
-        chvPath = "./chv/"
-        chvX = self.root.find(chvPath + chv)
+        chvX = self.chvs.get(chv)
         if chvX == None:
             raise Exception("Incorrect CHV:%s" %chv)
         return chvX
 
     def getNumberOfChv(self):
-        chvPath = "./chv"
-        NbrOfChild = 0
-        root = self.root.find(chvPath)
-        for child in root:
-            NbrOfChild += 1
-        return NbrOfChild
+        return len(self.chvs)
 
     def SetChvNotVerified(self):
-        chvPath = "./chv"
-        root = self.root.find(chvPath)
-        for child in root:
-            if "unblock" not in child.tag:
-                self.set(child, "verified", "0")
+        modified = False
+        for child in self.chvs.itervalues():
+            if "unblock" in child.tag or child.findtext("verified") == CODE_NOT_VERIFIED:
+                continue
+            self.set(child, "verified", CODE_NOT_VERIFIED, save=False)
+            modified = True
+        if modified:
+            self.save()
 
     def getValueChv(self, chv):
         return self.getValue(self.getChv(chv))
@@ -464,11 +926,17 @@ class SimXml(object):
         return value
 
     def findEfArr(self, file):
+        node = self.nodes.get(file)
+        if node != None and node.arrId != None:
+            return node.arrId, node.arrRule
         arrId = self.get(file, "arr_id")
         arrRule = self.getInt(file, "arr_rule")
         return arrId, arrRule
 
     def isFileEnabled(self, file):
+        node = self.nodes.get(file)
+        if isinstance(node, EfNode):
+            return not node.invalidated
         return not self.getInt(file, "invalidated")
 
     def setFileEnabled(self, file):
@@ -478,7 +946,7 @@ class SimXml(object):
         self.set(file, "invalidated", "1")
 
     def createDirectory(self, path, fid, arrId, arrRule, aid=None):
-        parentNode = self.root.find(path)
+        parentNode = self.findFile(path)
 
         node = createFileNode(parentNode, 'df', "%X" % fid)
 
@@ -488,12 +956,13 @@ class SimXml(object):
         if aid != None:
             aidValue = bytesToXmlValue(aid)
             addFileAttribute(node, "aid", aidValue)
+        self.indexFile(node, self.nodes.get(parentNode))
 
-        writeXml(self.file, self.root)
+        self.save()
         return node
 
     def createFile(self, path, fid, struct, size, recordLen, arrId, arrRule, data=[]):
-        parentNode = self.root.find(path)
+        parentNode = self.findFile(path)
         node = createFileNode(parentNode, 'ef', "%X" % fid)
 
         addFileAttribute(node, "sfi", "")
@@ -513,13 +982,23 @@ class SimXml(object):
         # fill with 'FF' len(data)
         value += bytesToXmlValue([0xFF] * (size - len(data)))
         addFileAttribute(node, "value", value)
+        self.indexFile(node, self.nodes.get(parentNode))
 
-        writeXml(self.file, self.root)
+        self.save()
         return node
 
     def deleteFile(self, file):
-        file.getparent().remove(file)
-        writeXml(self.file, self.root)
+        parent = file.getparent()
+        self.unindexFile(file)
+        parent.remove(file)
+        # Files with the same id (if any) become reachable again.
+        parentNode = self.nodes.get(parent)
+        if parentNode != None:
+            for child in parent:
+                if child.get('id') == file.get('id'):
+                    self.indexFile(child, parentNode)
+                    break
+        self.save()
 
     def resizeFile(self, file, size, data):
         value = self.getBinaryValue(file)
@@ -548,4 +1027,4 @@ class SimXml(object):
             self.setBinaryValue(file, value[:size])
 
         self.setFileSize(file, str(size))
-        writeXml(self.file, self.root)
+        self.save()
@@ -0,0 +1,304 @@
+#!/usr/bin/python
+# LICENSE: GPL2
+
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+import gc
+import json
+import logging
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from optparse import OptionParser
+from timeit import default_timer as timer
+
+from sim import apdu_replay
+from sim import sim_router
+from sim_soft import sim_auth
+from sim_soft import sim_soft_ctrl
+from sim_soft import sim_xml
+from sim import sim_codes
+from util import hextools
+from util import types
+from util import types_g
+
+dir = os.path.dirname(__file__)
+resultDir = os.path.join(dir, "result")
+
+TARGET_SOFT_CARD = "soft_card"
+TARGET_ROUTER = "router"
+TARGETS = (TARGET_SOFT_CARD, TARGET_ROUTER)
+
+# Number of times each workload is repeated.
+ITERATIONS = 20
+
+AID_USIM = "A0000000871002FF81FFFF89060200FF"
+PIN_1 = sim_codes.defaultCard[sim_codes.PIN_1]
+ADN_RECORDS = 150
+ADN_RECORD_LEN = 38
+
+def selectPath(path):
+    return "00A40804%02X%s" %(len(path) / 2, path)
+
+def selectFid(fid):
+    return "00A4000402%s" %fid
+
+def readBinary(length):
+    return "00B00000%02X" %length
+
+def readRecord(record, length):
+    return "00B2%02X04%02X" %(record, length)
+
+def verifyPin(pin):
+    pin = pin.encode("hex") + "FF" * (8 - len(pin))
+    return "0020000108%s" %pin
+
+def authenticate(rand):
+    key = sim_codes.defaultCard[sim_codes.AUTH_KEY]
+    sqn = sim_codes.defaultCard[sim_codes.AUTH_SQN]
+    amf = "8000"
+    autn = sim_auth.dummyXorHex(key, rand, sqn, amf, None)['autn']
+    return "008800812210%s10%s" %(rand, autn)
+
+def selectAdf():
+    return "00A4040410%s" %AID_USIM
+
+def workloadBoot():
+    """Handset boot: SELECT MF/ADF and read the files needed to register."""
+    return [
+        selectFid("3F00"),
+        selectFid("2FE2"),
+        readBinary(10),
+        selectFid("2F00"),
+        readRecord(1, 0x24),
+        selectAdf(),
+        verifyPin(PIN_1),
+        selectFid("6F07"),    # EF_IMSI
+        readBinary(9),
+        selectFid("6F7E"),    # EF_LOCI
+        readBinary(11),
+        selectFid("6F73"),    # EF_PSLOCI
+        readBinary(14),
+        selectFid("6F60"),    # EF_PLMNwAcT
+        readBinary(10),
+        selectFid("6F78"),    # EF_ACC
+        readBinary(2),
+        selectFid("6F38"),    # EF_UST
+        readBinary(4),
+        "80F2000000",         # STATUS
+        ]
+
+def workloadReadRecord():
+    """Read all records of EF_ADN."""
+    apdus = [verifyPin(PIN_1), selectPath("7F105F3A4F3A")]
+    for record in range(1, ADN_RECORDS + 1):
+        apdus.append(readRecord(record, ADN_RECORD_LEN))
+    return apdus
+
+def workloadSearchRecord():
+    """Search EF_ADN for empty and not existing entries."""
+    apdus = [verifyPin(PIN_1), selectPath("7F105F3A4F3A")]
+    for i in range(25):
+        apdus.append("00A2010401FF")
+        apdus.append("00A20104044E6F6E65")
+    return apdus
+
+def workloadVerifyPin():
+    """Verify PIN1, e.g. repeated by the terminal after every reset."""
+    return [verifyPin(PIN_1)] * 50
+
+def workloadAuthenticate():
+    """AUTHENTICATE bursts in the USIM application."""
+    apdus = [selectAdf()]
+    for i in range(25):
+        apdus.append(authenticate("%032X" %(0x41EC50D284B5284FB9A317E9F089F247 + i)))
+    return apdus
+
+WORKLOADS = (
+    ("boot", workloadBoot),
+    ("read_record", workloadReadRecord),
+    ("search_record", workloadSearchRecord),
+    ("verify_pin", workloadVerifyPin),
+    ("authenticate", workloadAuthenticate),
+    )
+
+class SoftCardTarget(object):
+    """Sends APDUs directly to SoftCard.transmit()."""
+    def __init__(self, imageDir, savePolicy):
+        self.card = sim_soft_ctrl.SoftCard(types.TYPE_USIM, savePolicy=savePolicy)
+        self.card.file = apdu_replay.copyImage(self.card, imageDir)
+        self.card.connect()
+
+    def transmit(self, apdu):
+        data, sw = self.card.transmit(hextools.hex2bytes(apdu))
+        return sw >> 8, sw & 0xFF, data
+
+    def close(self):
+        self.card.disconnect()
+
+class RouterTarget(object):
+    """Sends APDUs over SimRouter with SimCtrl.sendApdu()."""
+    def __init__(self, imageDir, savePolicy):
+        self.router = apdu_replay.createSoftRouter(types.TYPE_USIM, imageDir, savePolicy)
+        self.router.run(mode=sim_router.ROUTER_MODE_DISABLED)
+        self.simCtrl = self.router.simCtrl
+
+    def transmit(self, apdu):
+        return self.simCtrl.sendApdu(apdu)
+
+    def close(self):
+        apdu_replay.getSoftCard(self.router.getMainCard(0)).flush()
+        self.router.close()
+
+def exchange(target, apdu, latencies):
+    """Send APDU, fetch response data on 61XX and repeat with Le from 6CXX."""
+    while True:
+        startTime = timer()
+        sw1, sw2, data = target.transmit(apdu)
+        latencies.append(timer() - startTime)
+        if sw1 == types_g.sw1.RESPONSE_DATA_AVAILABLE_3G:
+            apdu = "%sC00000%02X" %(apdu[0:2], sw2)
+        elif sw1 == types_g.sw1.REPEAT_COMMAND_WITH_LE:
+            apdu = "%s%02X" %(apdu[0:8], sw2)
+        else:
+            return sw1, sw2, data
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    values = sorted(values)
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+def runWorkload(target, apdus, iterations):
+    # Warm up and check that the workload is accepted by the card.
+    for apdu in apdus:
+        sw1, sw2, data = exchange(target, apdu, [])
+        if types.packSw(sw1, sw2) != types_g.sw.NO_ERROR and sw1 != types_g.sw1.NO_ERROR_PROACTIVE_DATA:
+            logging.warning("%s -> %02X%02X" %(apdu, sw1, sw2))
+    latencies = []
+    gc.collect()
+    objects = len(gc.get_objects())
+    startTime = timer()
+    for i in xrange(iterations):
+        for apdu in apdus:
+            exchange(target, apdu, latencies)
+    duration = timer() - startTime
+    gc.collect()
+    objects = len(gc.get_objects()) - objects
+    ops = len(latencies)
+    result = {
+        "ops" : ops,
+        "duration" : duration,
+        "ops_per_s" : ops / duration,
+        "p50_ms" : percentile(latencies, 50) * 1000,
+        "p99_ms" : percentile(latencies, 99) * 1000,
+        "max_ms" : max(latencies) * 1000,
+        # Objects still allocated after the run, grows with leaks and caches.
+        "objects_per_op" : float(objects) / ops,
+        }
+    return result
+
+def createTarget(name, imageDir, savePolicy):
+    if name == TARGET_SOFT_CARD:
+        return SoftCardTarget(imageDir, savePolicy)
+    elif name == TARGET_ROUTER:
+        return RouterTarget(imageDir, savePolicy)
+    raise Exception("Unknown target: %s" %name)
+
+def getCommit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.abspath(dir)).strip()
+    except Exception:
+        return None
+
+def runBenchmark(targets=TARGETS, workloads=None, iterations=ITERATIONS,
+                 savePolicy=sim_xml.SAVE_POLICY):
+    # Logging every APDU would dominate the measurement.
+    loggers = [logging.getLogger("router"), logging.getLogger("sim_soft")]
+    levels = [logger.level for logger in loggers]
+    for logger in loggers:
+        logger.setLevel(logging.WARNING)
+    try:
+        return runTargets(targets, workloads, iterations, savePolicy)
+    finally:
+        for logger, level in zip(loggers, levels):
+            logger.setLevel(level)
+
+def runTargets(targets, workloads, iterations, savePolicy):
+    results = {
+        "commit" : getCommit(),
+        "python" : platform.python_version(),
+        "time" : time.strftime("%Y-%m-%d %H:%M:%S"),
+        "iterations" : iterations,
+        "save_policy" : savePolicy,
+        "results" : {},
+        }
+    for targetName in targets:
+        # Each target works on its own copy of the card image.
+        imageDir = tempfile.mkdtemp()
+        target = None
+        try:
+            target = createTarget(targetName, imageDir, savePolicy)
+            targetResults = {}
+            for name, workload in WORKLOADS:
+                if workloads and name not in workloads:
+                    continue
+                result = runWorkload(target, workload(), iterations)
+                logging.info("%-10s %-14s %8.0f ops/s  p50 %6.3fms  p99 %6.3fms"
+                             %(targetName, name, result["ops_per_s"],
+                               result["p50_ms"], result["p99_ms"]))
+                targetResults[name] = result
+            results["results"][targetName] = targetResults
+        finally:
+            if target:
+                target.close()
+            shutil.rmtree(imageDir)
+    return results
+
+def compare(results, baseline):
+    """Log ops/s change against the baseline results."""
+    logging.info("Compared to %s:" %baseline.get("commit"))
+    for targetName, targetResults in results["results"].iteritems():
+        for name, result in targetResults.iteritems():
+            try:
+                base = baseline["results"][targetName][name]
+            except KeyError:
+                continue
+            change = (result["ops_per_s"] / base["ops_per_s"] - 1) * 100
+            logging.info("%-10s %-14s %+6.1f%% ops/s" %(targetName, name, change))
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("-t", "--target", dest="targets", action="append",
+                      help="Target: %s (default: all)" %", ".join(TARGETS))
+    parser.add_option("-w", "--workload", dest="workloads", action="append",
+                      help="Workload: %s (default: all)"
+                      %", ".join([name for name, workload in WORKLOADS]))
+    parser.add_option("-n", "--iterations", dest="iterations", type="int",
+                      default=ITERATIONS, help="Workload repetitions")
+    parser.add_option("-p", "--save-policy", dest="savePolicy", type="int",
+                      default=sim_xml.SAVE_POLICY, help="Card image save policy")
+    parser.add_option("-o", "--output", dest="output", help="JSON result file")
+    parser.add_option("-c", "--compare", dest="baseline",
+                      help="JSON result file to compare with")
+    (options, args) = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    results = runBenchmark(options.targets or TARGETS, options.workloads,
+                           options.iterations, options.savePolicy)
+    output = options.output
+    if not output:
+        if not os.path.exists(resultDir):
+            os.makedirs(resultDir)
+        output = os.path.join(resultDir, "bench_soft_%s.json" %(results["commit"] or "local"))
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    logging.info("Results saved in %s" %output)
+    if options.baseline:
+        with open(options.baseline) as f:
+            compare(results, json.load(f))
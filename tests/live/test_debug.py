@@ -88,6 +88,7 @@ class TestDebug(unittest.TestCase):
 
     @classmethod
     def tearDownClass(cls):
+        cls.simRouter.close()
         cls.sim1.stop()
         cls.sim2.stop()
 
@@ -258,6 +258,7 @@ class TestSimShell(unittest.TestCase):
 
     @classmethod
     def tearDownClass(cls):
+        cls.simRouter.close()
         cls.simCard.stop()
 
 if __name__ == "__main__":
@@ -267,6 +267,7 @@ class TestSim(unittest.TestCase):
 
     @classmethod
     def tearDownClass(cls):
+        cls.simRouter.close()
         cls.simCard.stop()
 
 if __name__ == "__main__":
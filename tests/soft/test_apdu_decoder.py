@@ -0,0 +1,122 @@
+#!/usr/bin/python
+# LICENSE: GPL2
+
+import sys,os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+
+import shutil
+import StringIO
+import tempfile
+import unittest
+import logging
+
+from sim import apdu_decoder
+from sim import apdu_replay
+from sim import apdu_trace
+from sim_soft import sim_soft_ctrl
+from sim_soft import sim_xml
+from util import hextools
+from util import types
+
+BACKUP_XML = os.path.join(os.path.dirname(__file__), "../../sim_soft/sim_backup.xml.bak")
+
+APDUS = [
+    "00A40004023F00",
+    "00C000001B",
+    "00A40804047F206F07",
+    "00C000001E",
+    "00B0000009",
+    "80F2000C00",
+    ]
+
+# DISPLAY TEXT "Hi"
+FETCH = "8012000010"
+PROACTIVE_COMMAND = "D00E8103012100820281028D0304486990 00".replace(" ", "")
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(record.getMessage())
+
+class TestApduDecoder(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.decoder = apdu_decoder.ApduDecoder(types.TYPE_USIM)
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        file = os.path.join(self.dir, "card.xml")
+        shutil.copy2(BACKUP_XML, file)
+        card = sim_soft_ctrl.SoftCard(types.TYPE_USIM, file, sim_xml.SAVE_EXPLICIT)
+        card.connect()
+        self.log = []
+        for i in range(20):
+            for apdu in APDUS:
+                data, sw = card.transmit(hextools.hex2bytes(apdu))
+                self.log.append("C-APDU%d: %s" %(i % 2, apdu))
+                self.log.append("SELECT_FILE MF")
+                self.log.append("*R-APDU1")
+                self.log.append("R-APDU%d: %s%04X" %(i % 2, hextools.bytes2hex(data), sw))
+        self.log += ["C-APDU0: " + FETCH, "R-APDU0: " + PROACTIVE_COMMAND]
+        self.file = os.path.join(self.dir, "apdu.log")
+        with open(self.file, "w") as f:
+            f.write("\n".join(self.log) + "\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_1_decode(self):
+        lines = self.decoder.decode(0, hextools.hex2bytes("00A40804047F206F07"),
+                                    hextools.hex2bytes("611E"))
+        self.assertEqual(lines, ["C-APDU0: 00A40804047F206F07 SELECT_FILE EF_IMSI",
+                                 "R-APDU0: 611E RESPONSE_DATA_AVAILABLE_3G 1E"])
+        records = apdu_replay.parseApduLog(self.file)
+        lines = self.decoder.decodeRecords(records[:4])
+        index = lines.index("C-APDU0: 00C000001E GET_RESPONSE")
+        self.assertTrue(lines[index + 1].endswith("9000 NO_ERROR"))
+        self.assertEqual(lines[index + 2][:8], "  FCP: 8")
+        self.assertTrue("    FILE_IDENTIFIER: 6F07 (EF_IMSI)" in lines)
+        self.assertTrue("    FILE_IDENTIFIER: 3F00 (MF)" in lines)
+
+    def test_2_proactive(self):
+        lines = self.decoder.decode(0, hextools.hex2bytes(FETCH), hextools.hex2bytes(PROACTIVE_COMMAND))
+        self.assertEqual(lines[2:], ["  PROACTIVE",
+                                     "    COMMAND_DETAILS: 012100 (DISPLAY_TEXT)",
+                                     "    DEVICE_IDENTITIES: 8102",
+                                     "    TEXT_STRING: 044869"])
+        self.assertEqual(apdu_decoder.parseTlvs([0x81, 0x02, 0x01]), ([], [0x81, 0x02, 0x01]))
+        self.assertEqual(apdu_decoder.parseTlvs([0x62, 0x81, 0x90, 0x01]), ([], [0x62, 0x81, 0x90, 0x01]))
+        self.assertEqual(apdu_decoder.parseTlvs([0x80, 0x01, 0x05, 0x62, 0x82, 0x01, 0x00, 0x01]),
+                         ([(0x80, [0x05])], [0x62, 0x82, 0x01, 0x00, 0x01]))
+
+    def test_3_parallel(self):
+        expected = StringIO.StringIO()
+        apdu_decoder.decodeLog(self.file, expected, processes=1)
+        lines = expected.getvalue().splitlines()
+        self.assertEqual(lines, self.decoder.decodeRecords(apdu_replay.parseApduLog(self.file)))
+        # Chunks split C-APDU and R-APDU lines.
+        for chunkSize in (37, 100, 1000):
+            output = StringIO.StringIO()
+            apdu_decoder.decodeLog(self.file, output, processes=2, chunkSize=chunkSize)
+            self.assertEqual(output.getvalue(), expected.getvalue())
+
+    def test_4_online(self):
+        handler = ListHandler()
+        logger = logging.getLogger("test_apdu_decoder")
+        logger.propagate = False
+        logger.handlers = [handler]
+        logger.setLevel(logging.INFO)
+        trace = apdu_trace.ApduTrace()
+        trace.addSink(apdu_decoder.DecoderSink(logger, self.decoder))
+        trace.cApdu(1, hextools.hex2bytes("00A40004026F07"))
+        trace.rApdu(1, hextools.hex2bytes("6A82"))
+        trace.close()
+        self.assertEqual(handler.lines, ["C-APDU1: 00A40004026F07 SELECT_FILE EF_IMSI",
+                                         "R-APDU1: 6A82 FILE_NOT_FOUND"])
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+# LICENSE: GPL2
+
+import sys,os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+
+import shutil
+import tempfile
+import unittest
+import logging
+
+from sim import apdu_replay
+
+APDU_LOG = """
+19:16:37 ============
+19:16:37 == simLAB ==
+19:16:37 C-APDU0: 0070000001
+19:16:37 R-APDU0: 019000
+19:16:37 MANAGE_CHANNEL
+19:16:37 C-APDU0: 01A40804022F00
+19:16:37 R-APDU0: 611E
+19:16:37 C-APDU0: 01C000001E
+19:16:37 R-APDU0: 621C8205422100240383022F00A5038001718A01058B032F06088002006C9000
+19:16:37 C-APDU0: 01B2010424
+19:16:37 R-APDU0: 611B4F10A0000000871002FF81FFFF89060200FF5007414E5249545355FFFFFFFFFFFFFF9000
+19:16:37 C-APDU0: 01A4040410A0000000871002FF81FFFF89060200FF
+19:16:37 R-APDU0: 612E
+19:16:37 C-APDU0: 01A40004023F00
+19:16:37 R-APDU0: 611B
+19:16:37 C-APDU0: 01A40804022FE2
+19:16:37 R-APDU0: 611B
+19:16:37 C-APDU0: 01C000001B
+19:16:37 R-APDU0: 62198202412183022FE2A5038001718A01058B032F06048002000A9000
+"""
+
+class TestApduReplay(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file = os.path.join(self.dir, "apdu.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def writeLog(self, log):
+        with open(self.file, "w") as f:
+            f.write(log)
+
+    def test_1_parse(self):
+        self.writeLog(APDU_LOG)
+        records = apdu_replay.parseApduLog(self.file)
+        self.assertEqual(len(records), 8)
+        self.assertEqual(records[0].apdu, [0x00, 0x70, 0x00, 0x00, 0x01])
+        self.assertEqual(records[0].rapdu, [0x01, 0x90, 0x00])
+        self.assertEqual(records[0].line, 4)
+
+    def test_2_replay(self):
+        self.writeLog(APDU_LOG)
+        logger = logging.getLogger("sim_soft")
+        level = logger.level
+        replay = apdu_replay.replayApduLog(self.file)
+        # The logging of the replay is restored.
+        self.assertEqual(logger.level, level)
+        logging.info(replay)
+        self.assertEqual(replay.index, 8)
+        self.assertEqual(replay.responses, 8)
+        self.assertFalse(replay.mismatches)
+
+    def test_3_mismatch(self):
+        self.writeLog(APDU_LOG.replace("R-APDU0: 612E", "R-APDU0: 6A82"))
+        replay = apdu_replay.replayApduLog(self.file, stopOnMismatch=True)
+        logging.info(replay)
+        self.assertEqual(replay.index, 5)
+        record, rapdu = replay.getFirstMismatch()
+        self.assertEqual(record.rapdu, [0x6A, 0x82])
+        self.assertEqual(rapdu, [0x61, 0x2E])
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    unittest.main()
@@ -0,0 +1,162 @@
+#!/usr/bin/python
+# LICENSE: GPL2
+
+import sys,os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+
+import shutil
+import tempfile
+import unittest
+import logging
+
+from sim import apdu_trace
+from util import gsmtap
+from util import hextools
+from util import pcapng
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(record.getMessage())
+
+class LossySink(object):
+    lossy = True
+
+    def __init__(self):
+        self.records = []
+
+    def isEnabled(self):
+        return True
+
+    def write(self, record):
+        self.records.append(record.data)
+
+    def drop(self, count):
+        self.records.append(count)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class TestApduTrace(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.handler = ListHandler()
+        self.logger = logging.getLogger("test_apdu_trace")
+        self.logger.propagate = False
+        self.logger.handlers = [self.handler]
+        self.logger.setLevel(logging.INFO)
+        self.trace = apdu_trace.ApduTrace(size=4)
+        self.trace.addSink(apdu_trace.TextSink(self.logger, lambda apdu: "MF"))
+
+    def tearDown(self):
+        self.trace.close()
+        shutil.rmtree(self.dir)
+
+    def test_1_text(self):
+        apdu = hextools.hex2bytes("00A40004023F00")
+        self.trace.cApdu(0, apdu, separator=True)
+        self.trace.ins(0, apdu)
+        self.trace.rApdu(0, [0x61, 0x1B])
+        self.trace.rApdu(1, None, prefix="*")
+        self.trace.flush()
+        self.assertEqual(self.handler.lines,
+                         ["", "C-APDU0: 00A40004023F00", "SELECT_FILE MF", "R-APDU0: 611B", "*R-APDU1"])
+
+    def test_2_full(self):
+        # The pending records are written when the ring is full.
+        self.trace.writer.stop()
+        for i in range(6):
+            self.trace.rApdu(0, [0x90, i])
+        self.assertEqual(self.handler.lines, ["R-APDU0: 90%02X" %i for i in range(4)])
+        self.trace.write()
+        self.assertEqual(self.handler.lines, ["R-APDU0: 90%02X" %i for i in range(6)])
+
+    def test_3_disabled(self):
+        self.logger.setLevel(logging.WARNING)
+        self.assertTrue(self.trace.enabled)
+        self.trace.update()
+        self.assertFalse(self.trace.enabled)
+        self.trace.text("warning", logging.WARNING)
+        self.trace.flush()
+        self.assertEqual(self.handler.lines, ["warning"])
+
+    def test_4_capture(self):
+        file = os.path.join(self.dir, "capture.bin")
+        self.trace.addSink(apdu_trace.CaptureSink(file))
+        self.trace.cApdu(1, [0x00, 0xB0, 0x00, 0x00, 0x02])
+        self.trace.rApdu(1, [0x12, 0x34, 0x90, 0x00])
+        self.trace.text("not captured")
+        self.trace.close()
+        records = apdu_trace.readCapture(file)
+        self.assertEqual([record[1:] for record in records],
+                         [(apdu_trace.TRACE_C_APDU, 1, [0x00, 0xB0, 0x00, 0x00, 0x02]),
+                          (apdu_trace.TRACE_R_APDU, 1, [0x12, 0x34, 0x90, 0x00])])
+        self.assertTrue(records[0][0] <= records[1][0])
+
+    def test_5_pcapng(self):
+        file = os.path.join(self.dir, "capture.pcapng")
+        # Two packets of two cards in each file.
+        sink = apdu_trace.PcapngSink(file, maxSize=250)
+        self.trace.addSink(sink)
+        for i in range(4):
+            simId = i % 2
+            self.trace.cApdu(simId, [0x00, 0xB0, 0x00, 0x00, 0x01])
+            self.trace.rApdu(simId, [i, 0x90, 0x00])
+            self.trace.flush()
+        self.trace.close()
+        self.assertEqual(len(sink.files), 2)
+        packets = []
+        for file in sink.files:
+            packets += pcapng.readPackets(file)
+        self.assertEqual([packet[0] for packet in packets], ["SIM0", "SIM1", "SIM0", "SIM1"])
+        for i, (name, timestamp, packet) in enumerate(packets):
+            # nanoseconds
+            self.assertTrue(timestamp > 10**18)
+            ipHeader = packet[:gsmtap.IP_HEADER.size]
+            self.assertEqual(gsmtap.ipChecksum(ipHeader), 0)
+            payload = packet[gsmtap.IP_HEADER.size + gsmtap.UDP_HEADER.size:]
+            self.assertEqual(payload, gsmtap.packet([0x00, 0xB0, 0x00, 0x00, 0x01], [i, 0x90, 0x00]))
+
+    def test_6_pcapng_lossy(self):
+        file = os.path.join(self.dir, "capture.pcapng")
+        sink = apdu_trace.PcapngSink(file, lossy=True)
+        self.trace.writer.stop()
+        self.trace.addSink(sink)
+        self.logger.setLevel(logging.WARNING)
+        self.trace.update()
+        # The third pair of each run is dropped.
+        for run in [[0, 1, 2], [3], [4, 5, 6]]:
+            for i in run:
+                self.trace.cApdu(0, [0x00, 0xB0, 0x00, 0x00, 0x01])
+                self.trace.rApdu(0, [i, 0x90, 0x00])
+            if run != [4, 5, 6]:
+                self.trace.write()
+        self.trace.close()
+        packets = pcapng.readPackets(file, comments=True)
+        self.assertEqual([ord(packet[2][-3]) for packet in packets], [0, 1, 3, 4, 5])
+        self.assertEqual([packet[3] for packet in packets],
+                         [None, None, "2 APDU trace records dropped before this packet", None, None])
+        with open(file, "rb") as f:
+            self.assertTrue("2 APDU trace records dropped at the end" in f.read())
+
+    def test_7_full_lossy(self):
+        # Records are dropped only if all the sinks are lossy.
+        sink = LossySink()
+        self.trace.writer.stop()
+        self.trace.addSink(sink)
+        self.logger.setLevel(logging.WARNING)
+        self.trace.update()
+        for i in range(6):
+            self.trace.rApdu(0, [0x90, i])
+        self.trace.write()
+        self.assertEqual(sink.records, [[0x90, i] for i in range(4)] + [2])
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# LICENSE: GPL2
+
+import sys,os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+
+import shutil
+import tempfile
+import unittest
+import logging
+
+from sim import bulk_backup
+from sim import card_farm
+from util import types
+
+IMSI = "080910101032547698"
+IMSI_CHANGED = "080910101032547699"
+
+class TestBulkBackup(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.farm = card_farm.CardFarm()
+        cls.farm.addSoftCards(2, types.TYPE_USIM)
+        cls.targets = bulk_backup.getFarmTargets(cls.farm)
+
+    @classmethod
+    def tearDownClass(cls):
+        for target in cls.targets:
+            target.close()
+        cls.farm.close()
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def getStatuses(self, results):
+        return [status for status, result in results.values()]
+
+    def test_1_backup(self):
+        progress = []
+        bulkBackup = bulk_backup.BulkBackup(self.dir, progress=lambda *args: progress.append(args))
+        results = bulkBackup.backup(self.targets)
+        self.assertEqual(results.keys(), ["card0", "card1"])
+        self.assertEqual(self.getStatuses(results), [bulk_backup.STATUS_DONE] * 2)
+        self.assertEqual(sorted([args[3] for args in progress]), [1, 2])
+        for status, image in results.values():
+            self.assertEqual(bulk_backup.getImageFiles(image)["/ADF0/6F07"], (IMSI, 0))
+        # Cards done are skipped by the next run.
+        results = bulk_backup.BulkBackup(self.dir).backup(self.targets)
+        self.assertEqual(self.getStatuses(results), [bulk_backup.STATUS_SKIPPED] * 2)
+        results = bulk_backup.BulkBackup(self.dir, resume=False).backup(self.targets)
+        self.assertEqual(self.getStatuses(results), [bulk_backup.STATUS_DONE] * 2)
+
+    def test_2_restore(self):
+        bulkBackup = bulk_backup.BulkBackup(self.dir, jobs=1)
+        status, image = bulkBackup.backup(self.targets[:1])["card0"]
+        shell = self.targets[1].shell
+        shell.assertOk(*shell.write("/ADF0/6F07", IMSI_CHANGED))
+
+        results = bulkBackup.diff(self.targets, image)
+        self.assertEqual(results["card0"], (bulk_backup.STATUS_DONE, []))
+        self.assertEqual(results["card1"], (bulk_backup.STATUS_DONE,
+                                            [("/ADF0/6F07", IMSI_CHANGED, IMSI)]))
+
+        results = bulkBackup.restore(self.targets, image)
+        self.assertEqual(results["card0"][1]["written"], [])
+        self.assertEqual(results["card1"], (bulk_backup.STATUS_DONE,
+                                            {"written": ["/ADF0/6F07"], "failed": [], "missing": []}))
+        status, data = shell.read("/ADF0/6F07")
+        self.assertEqual(types.getDataValue(data), IMSI)
+        results = bulkBackup.diff(self.targets, image)
+        self.assertEqual(results["card1"], (bulk_backup.STATUS_DONE, []))
+        # A card changed after the restore is restored again by the next run.
+        shell.assertOk(*shell.write("/ADF0/6F07", IMSI_CHANGED))
+        results = bulkBackup.restore(self.targets, image)
+        self.assertEqual(results["card0"][1]["written"], [])
+        self.assertEqual(results["card1"][1]["written"], ["/ADF0/6F07"])
+        status, data = shell.read("/ADF0/6F07")
+        self.assertEqual(types.getDataValue(data), IMSI)
+
+    def test_3_close(self):
+        target = self.targets[1]
+        router = target.router
+        threads = [router.loop, router.timeoutThread, router.trace.writer]
+        self.assertTrue(all([thread.isAlive() for thread in threads]))
+        target.close()
+        self.assertFalse(any([thread.isAlive() for thread in threads]))
+        self.assertRaises(Exception, router.injectApdu, "00A40004023F00", router.getMainCard(0))
+        # The card can be leased again.
+        self.targets[1:] = bulk_backup.getFarmTargets(self.farm, 1)
+        self.assertEqual(len(self.targets), 2)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    unittest.main()
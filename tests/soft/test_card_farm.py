@@ -0,0 +1,106 @@
+#!/usr/bin/python
+# LICENSE: GPL2
+
+import sys,os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+
+import unittest
+import logging
+
+from sim import card_farm
+from sim import sim_codes
+from util import types
+
+SELECT_DF_GSM = "00A40004027F20"
+SELECT_IMSI = "00A40004026F07"
+SELECT_IMSI_PATH = "00A40804047F206F07"
+PIN_1 = sim_codes.defaultCard[sim_codes.PIN_1]
+VERIFY_PIN_1 = "0020000108%s" %(PIN_1.encode("hex") + "FF" * (8 - len(PIN_1)))
+
+class TestCardFarm(unittest.TestCase):
+    def setUp(self):
+        self.farm = card_farm.CardFarm()
+        self.farm.addSoftCards(2, types.TYPE_USIM)
+
+    def tearDown(self):
+        self.farm.close()
+
+    def test_1_lease(self):
+        lease1 = self.farm.lease(timeout=0)
+        lease2 = self.farm.lease(timeout=0)
+        self.assertNotEqual(lease1.card, lease2.card)
+        self.assertEqual(self.farm.lease(timeout=0), None)
+        self.assertEqual(self.farm.lease(types.TYPE_SIM, timeout=0), None)
+        card = lease1.card
+        lease1.release()
+        with self.farm.lease(timeout=0) as lease:
+            self.assertEqual(lease.card, card)
+        self.assertRaises(Exception, lease1.release)
+        lease2.release()
+        self.assertEqual([status["leases"] for status in self.farm.getStatus()], [2, 1])
+
+    def test_2_resetOnRelease(self):
+        with self.farm.lease() as lease:
+            card = lease.card
+            lease.apdu(SELECT_DF_GSM)
+            self.assertEqual(types.sw1(lease.apdu(SELECT_IMSI)), 0x61)
+        with self.farm.lease() as lease:
+            self.assertEqual(lease.card, card)
+            # MF is selected after the reset.
+            self.assertEqual(types.sw(lease.apdu(SELECT_IMSI)), 0x6A82)
+
+    def test_3_separateImages(self):
+        lease1 = self.farm.lease()
+        lease2 = self.farm.lease()
+        self.assertNotEqual(lease1.card.image, lease2.card.image)
+        apdus = [VERIFY_PIN_1, SELECT_IMSI_PATH, "00B0000009"]
+        imsi = types.responseData(lease1.apduMany(apdus)[-1])
+        lease1.apduMany([VERIFY_PIN_1, SELECT_IMSI_PATH, "00D6000001AA"])
+        self.assertEqual(types.responseData(lease1.apduMany(apdus)[-1])[0], 0xAA)
+        self.assertEqual(types.responseData(lease2.apduMany(apdus)[-1]), imsi)
+        lease1.release()
+        lease2.release()
+
+    def test_4_restoreOnRelease(self):
+        apdus = [VERIFY_PIN_1, SELECT_IMSI_PATH, "00B0000009"]
+        with self.farm.lease() as lease:
+            card = lease.card
+            image = card.image
+            imsi = types.responseData(lease.apduMany(apdus)[-1])
+            lease.apduMany([VERIFY_PIN_1, SELECT_IMSI_PATH, "00D6000001AA"])
+            # Wrong PIN, one attempt left less.
+            self.assertEqual(types.sw(lease.apdu("0020000108" + "FF" * 8)), 0x63C2)
+        with self.farm.lease() as lease:
+            self.assertEqual(lease.card, card)
+            self.assertNotEqual(card.image, image)
+            self.assertFalse(os.path.exists(image))
+            self.assertEqual(types.sw(lease.apdu("0020000100")), 0x63C3)
+            self.assertEqual(types.responseData(lease.apduMany(apdus)[-1]), imsi)
+
+    def test_5_keepImages(self):
+        self.farm.close()
+        self.farm = card_farm.CardFarm(restoreImages=False)
+        self.farm.addSoftCards(1, types.TYPE_USIM)
+        apdus = [VERIFY_PIN_1, SELECT_IMSI_PATH, "00B0000009"]
+        with self.farm.lease() as lease:
+            image = lease.card.image
+            lease.apduMany([VERIFY_PIN_1, SELECT_IMSI_PATH, "00D6000001AA"])
+        with self.farm.lease() as lease:
+            self.assertEqual(lease.card.image, image)
+            self.assertEqual(types.responseData(lease.apduMany(apdus)[-1])[0], 0xAA)
+
+    def test_6_healthCheck(self):
+        self.assertEqual(self.farm.checkHealth(all=True), [])
+        self.assertTrue(all([status["healthy"] for status in self.farm.getStatus()]))
+
+    def test_7_server(self):
+        server = card_farm.CardFarmServer(self.farm)
+        id = server.lease()
+        self.assertEqual(server.transmit(id, VERIFY_PIN_1), "9000")
+        self.assertEqual(server.transmitMany(id, ["00A40004023F00"])[0][-4:], "9000")
+        server.release(id)
+        self.assertRaises(Exception, server.transmit, id, "00A40004023F00")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    unittest.main()
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# LICENSE: GPL2
+
+import sys,os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+
+import shutil
+import tempfile
+import unittest
+import logging
+
+from sim import sim_card
+from sim import sim_reader
+from sim import sim_router
+from sim_soft import card_process
+from sim_soft import sim_soft_ctrl
+from sim_soft import sim_xml
+from util import hextools
+from util import types
+
+BACKUP_XML = os.path.join(os.path.dirname(__file__), "../../sim_soft/sim_backup.xml.bak")
+
+APDUS = [
+    "00A40004023F00",
+    "00A40004022FE2",
+    "00B000000A",
+    "0020000108%sFFFFFFFF" %"1111".encode("hex"),
+    "00A40804047F206F07",
+    "00B0000009",
+    "00D6000001AA",
+    "00B0000009",
+    "0070000001",
+    "80F2000C00",
+    ]
+
+class TestCardProcess(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cards = []
+        for name in ("card.xml", "card_process.xml"):
+            shutil.copy2(BACKUP_XML, os.path.join(self.dir, name))
+        self.card = sim_soft_ctrl.SoftCard(types.TYPE_USIM, os.path.join(self.dir, "card.xml"),
+                                           sim_xml.SAVE_EXPLICIT)
+        self.cardProcess = card_process.SoftCardProcess(sim_soft_ctrl.SoftCard, types.TYPE_USIM,
+                                                        os.path.join(self.dir, "card_process.xml"),
+                                                        sim_xml.SAVE_EXPLICIT)
+        self.card.connect()
+        self.cardProcess.connect()
+
+    def tearDown(self):
+        self.cardProcess.close()
+        shutil.rmtree(self.dir)
+
+    def test_1_ring(self):
+        ring = card_process.ApduRing(nbrOfSlots=2, slotSize=8)
+        ring.put("ab")
+        ring.put("")
+        self.assertEqual(ring.get(), "ab")
+        ring.put("cdefgh")
+        self.assertEqual(ring.get(), "")
+        self.assertEqual(ring.get(), "cdefgh")
+        self.assertEqual(ring.get(timeout=0.01), None)
+        self.assertRaises(Exception, ring.put, "abcdefgh")
+
+    def test_2_transmit(self):
+        self.assertEqual(self.cardProcess.getATR(), self.card.getATR())
+        for apdu in APDUS:
+            apdu = hextools.hex2bytes(apdu)
+            self.assertEqual(self.cardProcess.transmit(apdu), self.card.transmit(apdu))
+        self.cardProcess.reset()
+        self.card.reset()
+        for apdu in ["00A40004026F07", "00A40804047F206F07", "00B0000009"]:
+            apdu = hextools.hex2bytes(apdu)
+            self.assertEqual(self.cardProcess.transmit(apdu), self.card.transmit(apdu))
+
+    def test_3_error(self):
+        self.assertRaises(Exception, self.cardProcess.transmit, [])
+        data, sw = self.cardProcess.transmit(hextools.hex2bytes("00A40004023F00"))
+        self.assertEqual(sw >> 8, 0x61)
+
+    def test_4_router(self):
+        simCard = sim_card.SimCard(mode=sim_reader.MODE_SIM_SOFT, type=types.TYPE_USIM)
+        simCard.simReader.setCardProcess(True)
+        simCard.simReader.setCardImage(0, os.path.join(self.dir, "card_process.xml"),
+                                       sim_xml.SAVE_EXPLICIT)
+        simCard.connect(0)
+        softCard = simCard.simReader.getHandler().getCard(simCard.index)
+        self.assertTrue(isinstance(softCard, card_process.SoftCardProcess))
+        simRouter = sim_router.SimRouter(cards=[simCard], type=types.TYPE_USIM,
+                                         mode=sim_router.SIMTRACE_OFFLINE)
+        simRouter.run(mode=sim_router.ROUTER_MODE_DISABLED)
+        sw1, sw2, data = simRouter.simCtrl.sendApdu("00A40004023F00")
+        types.assertSw(sw1, sw2, checkSw1='RESPONSE_DATA_AVAILABLE_3G', raiseException=True)
+        simRouter.close()
+        simCard.stop()
+        self.assertFalse(softCard.process.is_alive())
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    unittest.main()
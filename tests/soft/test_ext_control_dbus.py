@@ -47,6 +47,23 @@ class TestDBus(unittest.TestCase):
         result = self.interface.get_plmn()
         self.assertStatus(result)
 
+    def test_4_overlapping_calls(self):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.interface.pwd()))
+                   for i in range(4)]
+        startTime = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # No polling delay between the calls.
+        self.assertLess(time.time() - startTime, 1)
+        self.assertEqual(len(results), 4)
+        for result in results:
+            self.assertStatus(result)
+        latency = self.interface.call_latency()
+        self.assertIn("pending=0", latency)
+
     def assertStatus(self, status):
         if 'status OK' in status:
             logging.info('Test OK')
@@ -5,6 +5,7 @@
 
 import sys
 import os.path
+import threading
 import time
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
@@ -106,9 +107,33 @@ class TestSimRouter(unittest.TestCase):
         # fetch
         sw1, sw2, data = self.sendApdu("A0120000%02X" %length)
 
+    def test_7_list_cards(self):
+        satCtrl = self.simCard.simReader.getHandler().getCard(self.simCard.index).satCtrl
+        texts = []
+        threads = []
+        displayText = satCtrl.displayText
+        def recordText(text, duration=None):
+            texts.append(text)
+            threads.append(threading.current_thread())
+            displayText(text, duration)
+        satCtrl.displayText = recordText
+        try:
+            status, data = self.simRouter.call(self.simRouter.shell.sat, "list_cards")
+            self.simRouter.shell.assertOk(status, data)
+            for i in range(50):
+                if texts and texts[-1].startswith("Cards connected"):
+                    break
+                time.sleep(0.1)
+        finally:
+            del satCtrl.displayText
+        self.assertTrue(texts[-1].startswith("Cards connected"))
+        # The post-action handler reads the cards in a greenlet of the main loop.
+        self.assertEqual(set(threads), set([self.simRouter.loop]))
+
     @classmethod
     def tearDownClass(cls):
         time.sleep(1)
+        cls.simRouter.close()
         cls.simCard.stop()
 
 if __name__ == "__main__":
@@ -7,6 +7,7 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
 
 from sim import sim_router
 from sim import sim_card
+from sim import sim_codes
 from util import types_g
 from util import types
 import unittest
@@ -33,6 +34,11 @@ class TestSimShell(unittest.TestCase):
         cls.simRouter.run(mode=sim_router.ROUTER_MODE_DISABLED)
         cls.shell = cls.simRouter.shell
 
+    @classmethod
+    def tearDownClass(cls):
+        cls.simRouter.close()
+        cls.simCard.stop()
+
     def test_01_read_iccid(self):
         status, data = self.shell.read("/2FE2")
         self.assertEqual(status, "status OK")
@@ -210,6 +216,61 @@ class TestSimShell(unittest.TestCase):
         status, out = self.shell.delete(parentPath)
         self.shell.assertOk(status, out)
 
+    def test_12_fcp_cache(self):
+        router = self.simRouter
+        apdus = []
+        router.injectApdu = lambda apdu, *args, **kwargs: apdus.append(apdu) or \
+                                sim_router.SimRouter.injectApdu(router, apdu, *args, **kwargs)
+        router.injectApdus = lambda _apdus, *args, **kwargs: apdus.extend(_apdus) or \
+                                sim_router.SimRouter.injectApdus(router, _apdus, *args, **kwargs)
+        try:
+            status, out = self.shell.cd("/7F10")
+            self.shell.assertOk(status, out)
+            status, files = self.shell.ls()
+            self.shell.assertOk(status, files)
+            # Listed and checked again from the cache.
+            del apdus[:]
+            self.assertEqual(self.shell.ls(), (status, files))
+            self.assertEqual(self.shell.cd("."), (status, out))
+            self.assertEqual(apdus, [])
+            # Only EF_ARR is selected, to read the rule of the file.
+            self.assertTrue(self.shell.checkFileConditions("/7F10/6F3C", types.AM_EF_READ))
+            self.assertFalse([apdu for apdu in apdus if apdu.endswith("7F106F3C")])
+
+            # Creating and deleting the file invalidates the cache.
+            filePath = "/ADF0/DEAD"
+            self.shell.assertNok(*self.shell.cd(filePath))
+            del apdus[:]
+            self.shell.assertNok(*self.shell.cd(filePath))
+            self.assertEqual(apdus, [])
+            status, out = self.shell.create(filePath + "/")
+            self.shell.assertOk(status, out)
+            self.shell.assertOk(*self.shell.cd(filePath))
+            status, out = self.shell.delete(filePath + "/")
+            self.shell.assertOk(status, out)
+            self.shell.assertNok(*self.shell.cd(filePath))
+
+            # Enabling or disabling PIN1 changes the PIN status of the DF FCP.
+            status, out = self.shell.cd("/ADF0")
+            self.shell.assertOk(status, out)
+            simCtrl = router.simCtrl
+            pin = sim_codes.defaultCard[sim_codes.PIN_1].encode("hex")
+            if simCtrl.pin1Enabled():
+                insList = ["26", "28"] # disable, enable
+            else:
+                insList = ["28", "26"] # enable, disable
+            sw1, sw2, data = simCtrl.sendApdu("00%s000108%sFFFFFFFF" %(insList[0], pin))
+            types.assertSw(sw1, sw2, checkSw='NO_ERROR', raiseException=True)
+            statusPin, outPin = self.shell.cd(".")
+            self.shell.assertOk(statusPin, outPin)
+            self.assertNotEqual(outPin, out)
+            sw1, sw2, data = simCtrl.sendApdu("00%s000108%sFFFFFFFF" %(insList[1], pin))
+            types.assertSw(sw1, sw2, checkSw='NO_ERROR', raiseException=True)
+            self.assertEqual(self.shell.cd("."), (status, out))
+        finally:
+            del router.injectApdu
+            del router.injectApdus
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, format='%(message)s')
     unittest.main()
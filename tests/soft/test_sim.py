@@ -10,6 +10,8 @@ from sim import sim_card
 from util import hextools
 from util import types_g
 from util import types
+import gevent
+import threading
 import unittest
 import logging
 
@@ -345,11 +347,139 @@ class TestSim(unittest.TestCase):
         sw1, sw2, data = self.sendApdu("00C00000%02X" %length)
         types.assertSw(sw1, sw2, checkSw='NO_ERROR', raiseException=True)
 
+    def test_10_reset(self):
+        softCard = self.simCard.simReader.getHandler().getCard(self.simCard.index)
+        simXml = softCard.simXml
+        #VERIFY
+        sw1, sw2, data = self.sendApdu("0020000108%sFFFFFFFF" %PIN_1.encode("hex"))
+        types.assertSw(sw1, sw2, checkSw='NO_ERROR', raiseException=True)
+        # MANAGE CHANNEL: OPEN (first free)
+        sw1, sw2, data = self.sendApdu("0070000001")
+        types.assertSw(sw1, sw2, checkSw='NO_ERROR', raiseException=True)
+        channel = data[0]
+
+        self.simCard.reset()
+        # Only the volatile state is cleared, the image is not read again.
+        self.assertIs(self.simCard.simReader.getHandler().getCard(self.simCard.index), softCard)
+        self.assertIs(softCard.simXml, simXml)
+        self.assertFalse(softCard.simHandler.isChannelOpen(channel))
+        self.assertEqual(simXml.verifiedChv("chv1"), 0)
+        self.assertEqual(self.simCard.getATR(), simXml.getAtr())
+
+    def test_11_send_apdus(self):
+        responses = self.simCtrl.sendApdus([
+            "0020000108%sFFFFFFFF" %PIN_1.encode("hex"), #VERIFY
+            "00A40804067F105F3A4F3A", #SELECT_FILE EF_ADN (by path from MF)
+            "00B2010426", #READ_RECORD
+            "80F2000000", #STATUS, repeated with Le from 6CXX
+            ])
+        self.assertEqual(len(responses), 4)
+        for sw1, sw2, data in responses:
+            types.assertSw(sw1, sw2, checkSw='NO_ERROR', raiseException=True)
+        # FCP fetched with GET_RESPONSE
+        sw1, sw2, data = responses[1]
+        self.assertEqual(data[0], types.FCP_TEMPLATE_TAG)
+        self.assertEqual(len(responses[2][2]), 0x26)
+        self.assertGreater(len(responses[3][2]), 2)
+
+        # Stop on the first error.
+        responses = self.simCtrl.sendApdus(["00A40804027FFF", "00B2010426"],
+                                           stopOnError=True)
+        self.assertEqual(len(responses), 1)
+        sw1, sw2, data = responses[0]
+        types.assertSw(sw1, sw2, checkSw='FILE_NOT_FOUND', raiseException=True)
+
+    def test_12_task(self):
+        card = self.simRouter.getMainCard(0)
+        rapdus = []
+        done = threading.Event()
+        def task():
+            rapdu = yield self.simRouter.inject("00A40004023F00", card)
+            rapdus.append(rapdu)
+            rapdu = yield self.simRouter.inject("00C00000%02X" %types.sw2(rapdu), card)
+            rapdus.append(rapdu)
+            done.set()
+        # The task runs on the router main loop, no thread waits for it.
+        self.simRouter.spawn(task())
+        self.assertTrue(done.wait(5))
+        self.assertEqual(types.sw1(rapdus[0]), types_g.sw1.RESPONSE_DATA_AVAILABLE_3G)
+        self.assertEqual(rapdus[1][0], types.FCP_TEMPLATE_TAG)
+
+    def test_13_timeout(self):
+        card = self.simRouter.getMainCard(0)
+        busy = threading.Event()
+        release = threading.Event()
+        def task():
+            yield self.simRouter.inject("00A40004023F00", card)
+            # Runs on the main loop and keeps it busy.
+            busy.set()
+            release.wait(10)
+        self.simRouter.spawn(task())
+        self.assertTrue(busy.wait(5))
+        try:
+            self.assertRaises(Exception, self.simRouter.injectApdu, "00A40004023F00", card, timeout=0)
+        finally:
+            release.set()
+        # The timed out APDU is skipped by the main loop.
+        rapdu = self.simRouter.injectApdu("00A40004023F00", card)
+        self.assertEqual(types.sw1(rapdu), types_g.sw1.RESPONSE_DATA_AVAILABLE_3G)
+
+    def test_14_reconnect(self):
+        softCard = self.simCard.simReader.getHandler().getCard(self.simCard.index)
+        # The soft card is dropped with the reader, a new one is created on connect.
+        self.simCard.disconnect()
+        self.simCard.connect(self.simCard.index)
+        self.assertIsNot(self.simCard.simReader.getHandler().getCard(self.simCard.index), softCard)
+
+    def test_15_empty_records(self):
+        #SELECT_FILE EF_ADN (by path from MF)
+        sw1, sw2, fcp = self.simCtrl.sendApdus(["00A40804067F105F3A4F3A"])[0]
+        types.assertSw(sw1, sw2, checkSw='NO_ERROR', raiseException=True)
+        # FILE_DESCRIPTOR: number of records set to 0
+        self.assertEqual(fcp[2:4], [types_g.selectTag.FILE_DESCRIPTOR, 0x05])
+        fcp[8] = 0
+        sw = types_g.sw.INVALID_DATA_ADDRESS
+        self.assertEqual(self.simCtrl.readCurrentFileRecord(fcp, 0xFF), (sw >> 8, sw & 0xFF, []))
+        self.assertEqual(self.simCtrl.writeCurrentFileRecord(fcp, [], 0xFF), (sw >> 8, sw & 0xFF, []))
+
+    def test_16_call(self):
+        card = self.simRouter.getMainCard(0)
+        threads = []
+        def select():
+            threads.append(threading.current_thread())
+            return self.simRouter.injectApdu("00A40004023F00", card)
+        def selectMany():
+            # Each greenlet waits for its APDU, the main loop keeps running.
+            greenlets = [gevent.spawn(select) for i in range(3)]
+            gevent.joinall(greenlets, raise_error=True)
+            return [greenlet.value for greenlet in greenlets]
+        rapdus = self.simRouter.call(selectMany)
+        self.assertEqual([types.sw1(rapdu) for rapdu in rapdus],
+                         [types_g.sw1.RESPONSE_DATA_AVAILABLE_3G] * 3)
+        self.assertEqual(threads, [self.simRouter.loop] * 3)
+        # So do the commands of the plac interpreter.
+        threads = []
+        waitInjected = self.simRouter.waitInjected
+        def recordThread(injected, timeout):
+            threads.append(threading.current_thread())
+            return waitInjected(injected, timeout)
+        self.simRouter.waitInjected = recordThread
+        try:
+            interpreter = sim_router.LoopInterpreter(self.simRouter.shell, self.simRouter)
+            with interpreter:
+                task = interpreter.send("read EF_ICCID")
+        finally:
+            del self.simRouter.waitInjected
+        self.assertEqual(task.etype, None)
+        self.assertTrue(threads)
+        self.assertEqual(set(threads), set([self.simRouter.loop]))
+
     def tearDown(self):
         self.simCard.reset()
 
     @classmethod
     def tearDownClass(cls):
+        cls.simRouter.close()
         cls.simCard.stop()
 
 if __name__ == "__main__":
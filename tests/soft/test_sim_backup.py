@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# LICENSE: GPL2
+
+import sys,os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+
+from sim import sim_router
+from sim import sim_card
+from sim import sim_reader
+from sim_soft import sim_xml
+from util import types
+import unittest
+import logging
+
+MODE_SIM = sim_reader.MODE_SIM_SOFT
+SIM_TYPE = types.TYPE_USIM
+
+ARR_FILE = "/ADF0/6F06"
+DENIED_FILE = "/ADF0/6F60"
+
+class TestSimBackup(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.simCard = sim_card.SimCard(mode=MODE_SIM, type=SIM_TYPE)
+        cls.simCard.removeAllReaders()
+        cls.simCard.connect(0)
+        cls.simRouter = sim_router.SimRouter(cards=[cls.simCard], type=SIM_TYPE, mode=sim_router.SIMTRACE_OFFLINE)
+        cls.simRouter.run(mode=sim_router.ROUTER_MODE_DISABLED)
+        cls.shell = cls.simRouter.shell
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.simRouter.close()
+        cls.simCard.stop()
+
+    def getValue(self, root, xmlPath):
+        return root.find(xmlPath + "/value").text
+
+    def test_1_backup(self):
+        shell = self.shell
+        simCtrl = shell.simCtrl
+        status, data = shell.readi("/ADF0/EF_IMSI")
+        shell.assertOk(status, data)
+        imsi = types.getDataValue(data)
+
+        status, data = shell.read(DENIED_FILE)
+        shell.assertOk(status, data)
+        deniedFileValue = types.getDataValue(data).replace(";", "")
+
+        # Deny reading of the files using the EF_PLMNwAcT rule.
+        arrRecord, recordValue = simCtrl.getArrRecordForFile(DENIED_FILE)
+        self.assertTrue(shell.checkFileConditions(ARR_FILE, types.AM_EF_UPDATE))
+        self.assertTrue(simCtrl.setArrCondition(ARR_FILE, arrRecord, recordValue[:],
+                                                types.AM_EF_READ, types.AC_NEVER))
+        deniedRecord, deniedValue = simCtrl.getArrRecordForFile(DENIED_FILE)
+        status, data = shell.read(ARR_FILE)
+        shell.assertOk(status, data)
+        arrValue = types.getDataValue(data).replace(";", "")
+        modifications = []
+        modifyArrConditions = shell.modifyArrConditions
+        shell.modifyArrConditions = lambda *args: modifications.append(args) or modifyArrConditions(*args)
+        try:
+            status, data = shell.backup()
+            pwdStatus, path = shell.pwd()
+            restoredArr = simCtrl.getArrRecordForFile(DENIED_FILE)
+        finally:
+            del shell.modifyArrConditions
+            simCtrl.setConditions(ARR_FILE, arrRecord, recordValue)
+        shell.assertOk(status, data)
+        xmlPath = types.getDataValue(data)
+        root = sim_xml.readXml(xmlPath)
+        os.remove(xmlPath)
+
+        # One relaxation for all the files of the ARR record, restored after.
+        self.assertEqual(len(modifications), 1)
+        self.assertEqual(modifications[0][:2], (ARR_FILE, arrRecord))
+        self.assertEqual(restoredArr, (deniedRecord, deniedValue))
+
+        self.assertTrue(os.path.basename(xmlPath).endswith(imsi + ".xml"))
+        adf = "./mf[@id='3F00']/df[@id='ADF0']"
+        self.assertEqual(root.find(adf + "/aid").text, "A0000000871002FF81FFFF89060200FF")
+        self.assertEqual(self.getValue(root, adf + "/ef[@id='6F07']"), "080910101032547698")
+        self.assertEqual(self.getValue(root, adf + "/ef[@id='6F60']"), deniedFileValue)
+        # EF_ARR as before the relaxation.
+        self.assertEqual(self.getValue(root, adf + "/ef[@id='6F06']"), arrValue)
+        self.assertEqual(root.find("./mf[@id='3F00']/df[@id='7F10']/ef[@id='6F3C']/record_len").text, "176")
+        self.assertEqual(path, "data path=/,name=MF,simId=0")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    unittest.main()
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# LICENSE: GPL2
+
+import sys,os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import logging
+
+from sim import sim_card
+from sim import sim_control
+from sim import sim_reader
+from sim import sim_router
+from util import types
+
+class TestSimControl(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.simCard = sim_card.SimCard(mode=sim_reader.MODE_SIM_SOFT, type=types.TYPE_USIM)
+        cls.simCard.removeAllReaders()
+        cls.simCard.connect(0)
+        cls.simRouter = sim_router.SimRouter(cards=[cls.simCard], type=types.TYPE_USIM,
+                                             mode=sim_router.SIMTRACE_OFFLINE)
+        cls.simRouter.run(mode=sim_router.ROUTER_MODE_DISABLED)
+        cls.dir = tempfile.mkdtemp()
+        cls.servers = []
+        for address in [("127.0.0.1", 0), os.path.join(cls.dir, "control.sock")]:
+            server = sim_control.ControlServer(cls.simRouter.shell, address)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.setDaemon(True)
+            thread.start()
+            cls.servers.append(server)
+
+    @classmethod
+    def tearDownClass(cls):
+        for server in cls.servers:
+            server.close()
+        cls.simRouter.close()
+        shutil.rmtree(cls.dir)
+        cls.simCard.stop()
+
+    def setUp(self):
+        self.clients = [sim_control.ControlClient(server.server_address) for server in self.servers]
+        self.client = self.clients[0]
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+
+    def test_1_call(self):
+        imsi = types.getDataValue(self.simRouter.shell.read("EF_IMSI")[1])
+        for client in self.clients:
+            response = client.call("read", "EF_IMSI")
+            self.assertTrue(response["ok"])
+            self.assertEqual(response["data"], imsi)
+            response = client.call("read", path="/7F20/EF_IMSI")
+            self.assertEqual(response["data"], imsi)
+        response = self.client.call("cd", "/7F20")
+        self.assertEqual(response["status"], sim_control.STATUS_OK)
+        response = self.client.call("read", "EF_FOO")
+        self.assertEqual(response["status"], sim_control.STATUS_NOK)
+
+    def test_2_errors(self):
+        self.assertEqual(self.client.call("foo")["error"], "Unknown method: foo")
+        self.assertEqual(self.client.call("read")["error"], "Missing parameters: path")
+        self.assertEqual(self.client.call("read", foo=1)["error"], "Unknown parameters: foo")
+        self.client.socket.sendall("{\n")
+        response = self.client.receive()
+        self.assertEqual(response["status"], sim_control.STATUS_ERROR)
+        # Connection still works.
+        self.assertTrue(self.client.call("pwd")["ok"])
+
+    def test_3_pipeline(self):
+        calls = [("read", ["EF_IMSI"]), ("read", ["/2FE2"]), ("pwd", None)] * 10
+        responses = self.client.pipeline(calls)
+        self.assertEqual([response["id"] for response in responses],
+                         range(responses[0]["id"], responses[0]["id"] + len(calls)))
+        self.assertTrue(all([response["ok"] for response in responses]))
+        self.assertEqual(responses[0]["data"], responses[3]["data"])
+
+    def test_4_batch(self):
+        calls = [("read", ["EF_IMSI"]), ("read", ["EF_FOO"]), ("read", ["/2FE2"])]
+        results = self.client.batch(calls)
+        self.assertEqual([result["ok"] for result in results], [True, False, True])
+        results = self.client.batch(calls, stopOnError=True)
+        self.assertEqual(len(results), 2)
+        streamed = list(self.client.stream(calls))
+        self.assertEqual([result["index"] for result in streamed], [0, 1, 2])
+        self.assertEqual(streamed[0]["data"], results[0]["data"])
+        # Still in sync after the stream.
+        self.assertTrue(self.client.call("pwd")["ok"])
+
+    def test_5_sessions(self):
+        # All the sessions are served by the server thread.
+        nbrOfThreads = threading.active_count()
+        clients = [sim_control.ControlClient(self.servers[0].server_address) for i in range(20)]
+        try:
+            for client in clients:
+                client.send([client.request("pwd")])
+            self.assertTrue(all([client.receive()["ok"] for client in clients]))
+            self.assertEqual(threading.active_count(), nbrOfThreads)
+        finally:
+            for client in clients:
+                client.close()
+
+    def test_6_long_pipeline(self):
+        # More requests and responses than the socket buffers hold.
+        for client in self.clients:
+            responses = client.pipeline([("pwd", None)] * 20000)
+            self.assertEqual(len(responses), 20000)
+            self.assertTrue(all([response["ok"] for response in responses]))
+
+    def test_7_stalled_client(self):
+        # A client not reading its responses doesn't hold up the others.
+        stalled = sim_control.ControlClient(self.servers[0].server_address)
+        requests = [stalled.request("pwd") for i in range(20000)]
+        sender = threading.Thread(target=stalled.send, args=(requests,))
+        sender.setDaemon(True)
+        sender.start()
+        try:
+            client = sim_control.ControlClient(self.servers[0].server_address, timeout=10)
+            try:
+                time.sleep(0.5)
+                self.assertTrue(client.call("pwd")["ok"])
+            finally:
+                client.close()
+            # The stalled client gets all its responses once it reads them.
+            responses = [stalled.receive() for request in requests]
+            self.assertTrue(all([response["ok"] for response in responses]))
+            sender.join()
+        finally:
+            stalled.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    unittest.main()
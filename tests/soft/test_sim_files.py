@@ -0,0 +1,60 @@
+#!/usr/bin/python
+# LICENSE: GPL2
+
+import sys,os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+
+import unittest
+import logging
+
+from sim import sim_files
+from util import types
+
+EF_DIR_DATA = ("61184F10A0000000871002FF33FF018907090000FFFFFFFF;"
+               "61184F10A0000000871004FF33FF018907090000FFFFFFFF")
+
+class TestSimFiles(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.simFiles = sim_files.SimFiles(types.TYPE_USIM)
+
+    def setUp(self):
+        self.simFiles.adfs = None
+        self.simFiles.clearCache()
+        self.simFiles.setCurrentDirPath("/")
+
+    def test_1_index(self):
+        simFiles = self.simFiles
+        self.assertEqual(simFiles.findFileByNameInDirs("EF_IMSI"), "3F00/ADF_USIM/6F07")
+        self.assertEqual(simFiles.findFileByIdInDirs("6F3A"), "3F00/7F10/6F3A")
+        self.assertEqual(simFiles.getNameFromFid("6F07"), "EF_IMSI")
+        self.assertEqual(simFiles.getPathFromRawPath("/7F10/EF_ADN"), "3F00/7F10/6F3A")
+        self.assertEqual(simFiles.getParentPath("/7F10/6F3A"), "3F00/7F10")
+        node, xmlPath = simFiles.findFileById("/7F10", "6F06")
+        self.assertEqual(xmlPath, "./mf[@id='3F00']/df[@id='7F10']/df[@id='5F50']/ef[@id='6F06']")
+        self.assertEqual(simFiles.findFileByName("/7F10", "EF_IMSI"), (None, None))
+        self.assertEqual(simFiles.findFileByNameInDirs("EF_FOO"), None)
+        self.assertRaises(Exception, simFiles.getNameFromFid, "1234")
+
+    def test_2_cache(self):
+        simFiles = self.simFiles
+        self.assertEqual(simFiles.getPathFromRawPath("/ADF0/EF_IMSI"), None)
+        self.assertEqual(simFiles.findFileOrDirectory("/ADF1/6F07"), (None, None))
+        simFiles.resolveAdfs(EF_DIR_DATA)
+        self.assertEqual(simFiles.getPathFromRawPath("/ADF0/EF_IMSI"), "3F00/ADF_USIM/6F07")
+        self.assertEqual(simFiles.findFileOrDirectory("/ADF1/6F07")[1],
+                         "./mf[@id='3F00']/df[@id='ADF_ISIM']/ef[@id='6F07']")
+        # ADFs swapped.
+        simFiles.resolveAdfs(";".join(reversed(EF_DIR_DATA.split(";"))))
+        self.assertEqual(simFiles.getPathFromRawPath("/ADF0/EF_IMSI"), None)
+        self.assertEqual(simFiles.findFileOrDirectory("/ADF1/6F07")[1],
+                         "./mf[@id='3F00']/df[@id='ADF_USIM']/ef[@id='6F07']")
+        # Relative to the current directory.
+        self.assertEqual(simFiles.findFileOrDirectory("./6F3A"), (None, None))
+        simFiles.setCurrentDirPath("/7F10")
+        self.assertEqual(simFiles.findFileOrDirectory("./6F3A")[1],
+                         "./mf[@id='3F00']/df[@id='7F10']/ef[@id='6F3A']")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    unittest.main()
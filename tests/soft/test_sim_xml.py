@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# LICENSE: GPL2
+
+import sys,os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+
+import shutil
+import tempfile
+import time
+import unittest
+import logging
+
+from sim_soft import sim_bin
+from sim_soft import sim_xml
+
+BACKUP_XML = os.path.join(os.path.dirname(__file__), "../../sim_soft/sim_backup.xml.bak")
+
+class TestSimXml(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file = os.path.join(self.dir, "sim_backup.xml")
+        shutil.copy2(BACKUP_XML, self.file + ".bak")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def openXml(self, policy):
+        simXml = sim_xml.SimXml(self.file, savePolicy=policy)
+        return simXml
+
+    def readAttempts(self):
+        simXml = sim_xml.SimXml(self.file, savePolicy=sim_xml.SAVE_EXPLICIT)
+        return simXml.remaningAttemptsChv("chv1")
+
+    def test_1_saveImmediate(self):
+        simXml = self.openXml(sim_xml.SAVE_IMMEDIATE)
+        simXml.decrementRemaningAttemptsChv("chv1")
+        self.assertEqual(self.readAttempts(), 2)
+        self.assertFalse(os.path.exists(self.file + ".tmp"))
+
+    def test_2_saveExplicit(self):
+        simXml = self.openXml(sim_xml.SAVE_EXPLICIT)
+        simXml.decrementRemaningAttemptsChv("chv1")
+        simXml.reset()
+        self.assertEqual(self.readAttempts(), 3)
+        simXml.flush()
+        self.assertEqual(self.readAttempts(), 2)
+
+    def test_3_saveOnReset(self):
+        simXml = self.openXml(sim_xml.SAVE_ON_RESET)
+        simXml.decrementRemaningAttemptsChv("chv1")
+        self.assertEqual(self.readAttempts(), 3)
+        simXml.reset()
+        self.assertEqual(self.readAttempts(), 2)
+
+    def test_4_saveBatched(self):
+        simXml = self.openXml(sim_xml.SAVE_BATCHED)
+        simXml.writer.batchWrites = 2
+        simXml.writer.batchInterval = 50
+        simXml.decrementRemaningAttemptsChv("chv1")
+        self.assertEqual(self.readAttempts(), 3)
+        simXml.decrementRemaningAttemptsChv("chv1")
+        self.assertEqual(self.readAttempts(), 1)
+        simXml.decrementRemaningAttemptsChv("chv1")
+        time.sleep(0.2)
+        self.assertEqual(self.readAttempts(), 0)
+
+    def test_5_binaryValue(self):
+        simXml = self.openXml(sim_xml.SAVE_EXPLICIT)
+        file = simXml.findFile("./mf/df[@id='7F20']/ef[@id='6F07']")
+        simXml.updateBinaryValue(file, 1, 3, [0xAA, 0xBB])
+        value = simXml.getBinaryValue(file)
+        self.assertEqual(value[1:3], [0xAA, 0xBB])
+        simXml.flush()
+        simXml = sim_xml.SimXml(self.file, savePolicy=sim_xml.SAVE_EXPLICIT)
+        file = simXml.findFile("./mf[@id='3F00']/df[@id='7F20']/ef[@id='6F07']")
+        self.assertEqual(simXml.getBinaryValue(file), value)
+
+    def test_6_binaryImage(self):
+        imsiPath = "./mf/df[@id='7F20']/ef[@id='6F07']"
+        binFile = os.path.join(self.dir, "sim_backup.simb")
+        xmlFile = os.path.join(self.dir, "sim_converted.xml")
+        simXml = self.openXml(sim_xml.SAVE_EXPLICIT)
+        imsi = simXml.getBinaryValue(simXml.findFile(imsiPath))
+        sim_xml.convertImage(self.file, binFile, sim_xml.FORMAT_BIN)
+        self.assertTrue(sim_bin.isBinaryImage(binFile))
+
+        simXml = sim_xml.SimXml(binFile, savePolicy=sim_xml.SAVE_EXPLICIT)
+        self.assertEqual(simXml.format, sim_xml.FORMAT_BIN)
+        file = simXml.findFile(imsiPath)
+        # EF bodies are read from the image on first access.
+        self.assertTrue(file in simXml.bodies)
+        self.assertEqual(simXml.getBinaryValue(file), imsi)
+        simXml.updateBinaryValue(file, 1, 3, [0xAA, 0xBB])
+        self.assertFalse(file in simXml.bodies)
+        simXml.flush()
+
+        sim_xml.convertImage(binFile, xmlFile, sim_xml.FORMAT_XML)
+        self.assertFalse(sim_bin.isBinaryImage(xmlFile))
+        simXml = sim_xml.SimXml(xmlFile, savePolicy=sim_xml.SAVE_EXPLICIT)
+        file = simXml.findFile(imsiPath)
+        imsi[1:3] = [0xAA, 0xBB]
+        self.assertEqual(simXml.getBinaryValue(file), imsi)
+        self.assertEqual(simXml.getAtr(), self.openXml(sim_xml.SAVE_EXPLICIT).getAtr())
+
+    def test_7_binaryImageRewrite(self):
+        imsiPath = "./mf/df[@id='7F20']/ef[@id='6F07']"
+        dirPath = "./mf/ef[@id='2F00']"
+        binFile = os.path.join(self.dir, "sim_backup.simb")
+        sim_xml.convertImage(self.file, binFile, sim_xml.FORMAT_BIN)
+        simXml = sim_xml.SimXml(binFile, savePolicy=sim_xml.SAVE_EXPLICIT)
+        efDir = simXml.getBinaryValue(simXml.findFile(dirPath))
+        simXml.close()
+        simXml = sim_xml.SimXml(binFile, savePolicy=sim_xml.SAVE_IMMEDIATE)
+        image = simXml.image
+        file = simXml.findFile(imsiPath)
+        simXml.updateBinaryValue(file, 1, 3, [0xAA, 0xBB])
+        # The image is written and mapped again, the old map is closed.
+        self.assertIsNot(simXml.image, image)
+        self.assertRaises(ValueError, image.getBody, 0, 1)
+        self.assertEqual(simXml.getBinaryValue(simXml.findFile(dirPath)), efDir)
+        image = simXml.image
+        simXml.close()
+        self.assertEqual(simXml.image, None)
+        self.assertRaises(ValueError, image.getBody, 0, 1)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    unittest.main()
@@ -3,12 +3,14 @@
 # (c) 2016 Janusz Kuszczynski
 """
 DBus service made as separate process, as GLib.MainLoop() is a blocking loop, interfering with gevent module.
+Tasks and results are passed through a pipe, both loops wake up when it is readable.
+Every call has a request id, so calls can be outstanding while the shell executes a task.
 """
 
+import itertools
 import logging
 import time
 import multiprocessing
-import Queue
 import dbus
 import dbus.service
 from dbus.mainloop.glib import DBusGMainLoop
@@ -21,12 +23,11 @@ from sim import sim_shell
 
 def startDbusProcess(self):
     gevent.spawn(privateInterpreter, self) # plac.interpreter.interact is blocking, overriding
-    taskQueue = multiprocessing.Queue()
-    resultQueue = multiprocessing.Queue()
-    dbusProcess = DbusProcess(taskQueue, resultQueue)
+    connection, dbusConnection = multiprocessing.Pipe()
+    dbusProcess = DbusProcess(dbusConnection)
     dbusProcess.daemon = True
     dbusProcess.start()
-    dbusReceiveTask(self, taskQueue, resultQueue)  # acts as mainloop
+    dbusReceiveTask(self, connection)  # acts as mainloop
     gevent.sleep(0.01)  # freeze main loop  for given amount of time
     dbusProcess.join(0.5)  # try gentle
     dbusProcess.terminate()
@@ -54,40 +55,34 @@ def privateInterpreter(self):
     except KeyboardInterrupt:
         pass
 
-def dbusReceiveTask(self, taskQueue, resultQueue):
-    """Loop to execute tasks from queue"""
+def dbusReceiveTask(self, connection):
+    """Loop to execute tasks from the pipe, result is sent back with the request id and execution time"""
     try:
         while True:
-            try:
-                task = taskQueue.get(timeout=0.1)
+            geventSelect.select([connection], [], [])  # other greenlets run until a task arrives
+            while connection.poll():
+                requestId, task = connection.recv()
                 logging.info("Received task from dbus: " + str(task))
+                startTime = time.time()
                 with self.interpreter:
                     result = self.interpreter.send(task)
-                    resultQueue.put(result.str)
-            except Queue.Empty:
-                pass  # nothing in receive task queue
-            gevent.sleep(1)
-    except KeyboardInterrupt:
+                connection.send((requestId, result.str, time.time() - startTime))
+    except (KeyboardInterrupt, EOFError):
         pass
 
 class DbusProcess(multiprocessing.Process):
-    def __init__(self, taskQueue, resultQueue):
+    def __init__(self, connection):
         multiprocessing.Process.__init__(self)
-        self.taskQueue = taskQueue
-        self.resultQueue = resultQueue
-
-    @staticmethod
-    def _idleQueueSync():
-        time.sleep(0.01)  # just to synchronize queue, otherwise task can be dropped
-        return True
+        self.connection = connection
 
     def run(self):
         logging.info('D-Bus process started')
         GLib.threads_init()  # allow threads in GLib
-        GLib.idle_add(self._idleQueueSync)
 
         DBusGMainLoop(set_as_default=True)
-        dbusService = SessionDBus(self.taskQueue, self.resultQueue)
+        dbusService = SessionDBus(self.connection)
+        GLib.io_add_watch(self.connection.fileno(), GLib.PRIORITY_DEFAULT,
+                          GLib.IO_IN | GLib.IO_HUP, dbusService.receiveResults)
 
         try:
             GLib.MainLoop().run()
@@ -98,20 +93,64 @@ class DbusProcess(multiprocessing.Process):
 
 
 class SessionDBus(dbus.service.Object, sim_shell.SimShell):
-    def __init__(self, taskQueue, resultQueue):
-        self.taskQueue = taskQueue
-        self.resultQueue = resultQueue
+    def __init__(self, connection):
+        self.connection = connection
+        self.requestIds = itertools.count()
+        # reply and error callbacks, call time by request id
+        self.pendingCalls = {}
+        self.nbrOfCalls = 0
+        self.lastLatency = 0
+        self.maxLatency = 0
+        self.totalLatency = 0
         bus_name = dbus.service.BusName('org.sim.simlab', bus=dbus.SessionBus())
         dbus.service.Object.__init__(self, bus_name, '/org/sim/simlab')
 
+    def call(self, task, reply, error):
+        """Send task to the shell, D-Bus reply is sent when its result is received"""
+        requestId = next(self.requestIds)
+        self.pendingCalls[requestId] = (reply, error, time.time(), task)
+        self.connection.send((requestId, task))
+
+    def receiveResults(self, fd, condition):
+        try:
+            while self.connection.poll():
+                requestId, result, executionTime = self.connection.recv()
+                reply, error, callTime, task = self.pendingCalls.pop(requestId)
+                latency = time.time() - callTime
+                self.nbrOfCalls += 1
+                self.lastLatency = latency
+                self.maxLatency = max(self.maxLatency, latency)
+                self.totalLatency += latency
+                logging.info("D-Bus call %d '%s': %.1f ms, executed in %.1f ms"
+                             %(requestId, task.strip(), latency * 1000, executionTime * 1000))
+                reply(result)
+        except EOFError:
+            logging.error("D-Bus task pipe closed")
+            for reply, error, callTime, task in self.pendingCalls.values():
+                error(Exception("simLAB closed"))
+            self.pendingCalls = {}
+            return False
+        return True
+
+    @dbus.service.method('org.sim.simlab')
+    def call_latency(self):
+        """Latency of the D-Bus calls, from call to reply"""
+        average = 0
+        if self.nbrOfCalls:
+            average = self.totalLatency / self.nbrOfCalls
+        return "calls=%d last=%.1fms average=%.1fms max=%.1fms pending=%d" %(
+               self.nbrOfCalls, self.lastLatency * 1000, average * 1000,
+               self.maxLatency * 1000, len(self.pendingCalls))
+
     """
     Dynamically create functions, based on sim_shell.SimShell.commands. They are exported to D-Bus.
+    Calls are asynchronous, the GLib loop is not blocked while the shell executes them.
     """
     functionTemplate = "" \
-                       "def command_name(self,args=None): \n" \
-                       "    self.taskQueue.put('command_name ' + args) \n" \
-                       "    return self.resultQueue.get() \n" \
-                       "command_name = dbus.service.method('org.sim.simlab')(command_name)   "
+                       "def command_name(self,args=None,reply=None,error=None): \n" \
+                       "    self.call('command_name ' + args, reply, error) \n" \
+                       "command_name = dbus.service.method('org.sim.simlab', " \
+                       "async_callbacks=('reply', 'error'))(command_name)   "
     for command in sim_shell.SimShell.commands:
         functionCode = functionTemplate.replace('command_name', command)
         # check how many parameters takes original function
@@ -12,29 +12,64 @@ import struct
 # from util import gsmtap
 # gsmtap.loghex("A0A40000023f00", "9000")
 
+GSMTAP_PORT = 4729
+GSMTAP_VERSION = 2
+GSMTAP_TYPE_SIM = 4
 
-gsmtap_hdr = [2, # GSMTAP_VERSION,
-              4, # nb of u32 in header
-              4, # GSMTAP_TYPE_SIM,
-              0,0,0,0,0,0,0,0,0,0,0,0,0]
+# version, header length in u32, type, timeslot, arfcn, signal dbm, snr,
+# frame number, sub type, antenna number, sub slot, reserved
+GSMTAP_HEADER = struct.Struct(">BBBBHbbIBBBB")
+GSMTAP_SIM_HEADER = GSMTAP_HEADER.pack(GSMTAP_VERSION, GSMTAP_HEADER.size / 4,
+                                       GSMTAP_TYPE_SIM, 0, 0, 0, 0, 0, 0, 0, 0, 0)
 
-# gsmtap_addr = ("127.0.0.1", 4729)
-gsmtap_addr = ("<broadcast>", 4729)
-gsmtap_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-gsmtap_sock.bind(('127.0.0.1', 0))
-# broadcast avoids ICMP port unreachable
-gsmtap_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+# version and header length, tos, total length, id, fragment, ttl,
+# protocol, checksum, source, destination
+IP_HEADER = struct.Struct(">BBHHHBBH4s4s")
+IP_PROTOCOL_UDP = 17
+IP_ADDRESS = socket.inet_aton("127.0.0.1")
+# source port, destination port, length, checksum
+UDP_HEADER = struct.Struct(">HHHH")
 
+# gsmtap_addr = ("127.0.0.1", GSMTAP_PORT)
+gsmtap_addr = ("<broadcast>", GSMTAP_PORT)
+gsmtap_sock = None
+
+def getSocket():
+    global gsmtap_sock
+    if not gsmtap_sock:
+        gsmtap_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        gsmtap_sock.bind(('127.0.0.1', 0))
+        # broadcast avoids ICMP port unreachable
+        gsmtap_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    return gsmtap_sock
 
-def bytes2str(bytes):
-    return struct.pack('B'*len(bytes), *bytes)
 def hex2bytes(hex):
-    return map(ord,hex.decode("hex"))
+    return bytearray(hex.decode("hex"))
+
+def packet(c_apdu, r_apdu=[]):
+    """GSMTAP SIM packet of the C-APDU followed by the R-APDU."""
+    return GSMTAP_SIM_HEADER + str(bytearray(c_apdu)) + str(bytearray(r_apdu))
+
+def ipChecksum(header):
+    words = struct.unpack(">%dH" %(len(header) / 2), header)
+    checksum = sum(words)
+    checksum = (checksum >> 16) + (checksum & 0xFFFF)
+    checksum += checksum >> 16
+    return ~checksum & 0xFFFF
+
+def ipPacket(payload):
+    """UDP/IPv4 packet to the GSMTAP port, as captured on "lo"."""
+    udpLength = UDP_HEADER.size + len(payload)
+    length = IP_HEADER.size + udpLength
+    header = IP_HEADER.pack(0x45, 0, length, 0, 0, 64, IP_PROTOCOL_UDP, 0, IP_ADDRESS, IP_ADDRESS)
+    header = IP_HEADER.pack(0x45, 0, length, 0, 0, 64, IP_PROTOCOL_UDP, ipChecksum(header),
+                            IP_ADDRESS, IP_ADDRESS)
+    # UDP checksum is optional in IPv4.
+    return header + UDP_HEADER.pack(GSMTAP_PORT, GSMTAP_PORT, udpLength, 0) + payload
 
 # input = bytes
 def log(c_apdu, r_apdu=[]):
-    msg = list(gsmtap_hdr) + list(c_apdu) + list(r_apdu)
-    gsmtap_sock.sendto(bytes2str(msg), gsmtap_addr)
+    getSocket().sendto(packet(c_apdu, r_apdu), gsmtap_addr)
 
 # input = hex string
 def loghex(c, r=""):
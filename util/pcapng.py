@@ -0,0 +1,141 @@
+# LICENSE: GPL2
+
+# Minimal pcapng writer, see
+# https://github.com/pcapng/pcapng
+# Timestamps are in nanoseconds.
+
+import struct
+
+BLOCK_SECTION_HEADER = 0x0A0D0D0A
+BLOCK_INTERFACE_DESCRIPTION = 0x00000001
+BLOCK_ENHANCED_PACKET = 0x00000006
+BLOCK_INTERFACE_STATISTICS = 0x00000005
+BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+OPTION_END = 0
+OPTION_COMMENT = 1
+OPTION_IF_NAME = 2
+OPTION_IF_TSRESOL = 9
+# Packets dropped, 64 bit.
+OPTION_ISB_IFDROP = 5
+# Timestamp resolution 10^-9 s.
+TSRESOL_NS = 9
+
+LINKTYPE_RAW = 101
+
+# type, total length
+BLOCK_HEADER = struct.Struct("<II")
+# byte order magic, major, minor, section length
+SECTION_HEADER = struct.Struct("<IHHq")
+# link type, reserved, snap length
+INTERFACE_DESCRIPTION = struct.Struct("<HHI")
+# interface id, timestamp high, timestamp low, captured length, packet length
+ENHANCED_PACKET = struct.Struct("<IIIII")
+# interface id, timestamp high, timestamp low
+INTERFACE_STATISTICS = struct.Struct("<III")
+OPTION_HEADER = struct.Struct("<HH")
+
+def pad(data):
+    return data + "\0" * (-len(data) % 4)
+
+def option(code, value):
+    return OPTION_HEADER.pack(code, len(value)) + pad(value)
+
+def block(type, body):
+    length = BLOCK_HEADER.size + len(body) + 4
+    return BLOCK_HEADER.pack(type, length) + body + struct.pack("<I", length)
+
+class PcapngWriter(object):
+    def __init__(self, file, linkType=LINKTYPE_RAW):
+        self.file = open(file, "wb")
+        self.linkType = linkType
+        self.nbrOfInterfaces = 0
+        self.size = 0
+        self.write(block(BLOCK_SECTION_HEADER,
+                         SECTION_HEADER.pack(BYTE_ORDER_MAGIC, 1, 0, -1)))
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def addInterface(self, name):
+        """Returns id of the interface."""
+        body = INTERFACE_DESCRIPTION.pack(self.linkType, 0, 0)
+        body += option(OPTION_IF_NAME, name)
+        body += option(OPTION_IF_TSRESOL, chr(TSRESOL_NS))
+        body += option(OPTION_END, "")
+        self.write(block(BLOCK_INTERFACE_DESCRIPTION, body))
+        self.nbrOfInterfaces += 1
+        return self.nbrOfInterfaces - 1
+
+    def writePacket(self, interfaceId, timestamp, data, comment=None):
+        """Timestamp in nanoseconds since the epoch."""
+        body = ENHANCED_PACKET.pack(interfaceId, timestamp >> 32, timestamp & 0xFFFFFFFF,
+                                    len(data), len(data))
+        body += pad(data)
+        if comment:
+            body += option(OPTION_COMMENT, comment) + option(OPTION_END, "")
+        self.write(block(BLOCK_ENHANCED_PACKET, body))
+
+    def writeStatistics(self, interfaceId, timestamp, dropped, comment=None):
+        """Number of packets dropped on the interface."""
+        body = INTERFACE_STATISTICS.pack(interfaceId, timestamp >> 32, timestamp & 0xFFFFFFFF)
+        if comment:
+            body += option(OPTION_COMMENT, comment)
+        body += option(OPTION_ISB_IFDROP, struct.pack("<Q", dropped))
+        body += option(OPTION_END, "")
+        self.write(block(BLOCK_INTERFACE_STATISTICS, body))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def readOptions(body, offset):
+    """Returns the options of the block by code."""
+    options = {}
+    while offset + OPTION_HEADER.size <= len(body):
+        code, optionLength = OPTION_HEADER.unpack_from(body, offset)
+        offset += OPTION_HEADER.size
+        if code == OPTION_END:
+            break
+        options[code] = body[offset:offset + optionLength]
+        offset += optionLength + (-optionLength % 4)
+    return options
+
+def readPackets(file, comments=False):
+    """
+    Returns (interface name, timestamp, data) of the packets in the file,
+    with the comment of the packet (or None) if comments is set.
+    """
+    packets = []
+    interfaces = []
+    with open(file, "rb") as f:
+        data = f.read()
+    offset = 0
+    while offset < len(data):
+        type, length = BLOCK_HEADER.unpack_from(data, offset)
+        body = data[offset + BLOCK_HEADER.size:offset + length - 4]
+        if type == BLOCK_SECTION_HEADER:
+            interfaces = []
+        elif type == BLOCK_INTERFACE_DESCRIPTION:
+            name = None
+            optionOffset = INTERFACE_DESCRIPTION.size
+            while optionOffset < len(body):
+                code, optionLength = OPTION_HEADER.unpack_from(body, optionOffset)
+                optionOffset += OPTION_HEADER.size
+                if code == OPTION_IF_NAME:
+                    name = body[optionOffset:optionOffset + optionLength]
+                optionOffset += optionLength + (-optionLength % 4)
+            interfaces.append(name)
+        elif type == BLOCK_ENHANCED_PACKET:
+            interfaceId, high, low, capturedLength, packetLength = ENHANCED_PACKET.unpack_from(body)
+            packet = body[ENHANCED_PACKET.size:ENHANCED_PACKET.size + capturedLength]
+            packet = (interfaces[interfaceId], (high << 32) + low, packet)
+            if comments:
+                optionOffset = ENHANCED_PACKET.size + capturedLength + (-capturedLength % 4)
+                packet += (readOptions(body, optionOffset).get(OPTION_COMMENT),)
+            packets.append(packet)
+        offset += length
+    return packets
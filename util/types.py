@@ -379,6 +379,31 @@ def swNoError(rapdu):
 def responseData(rapdu):
     return rapdu[0:-2]
 
+def transmitMany(transmit, apdus, stopOnError=False):
+    """
+    Send APDUs with transmit(apdu), which returns (data, sw1, sw2).
+    Response data is fetched with GET RESPONSE on 61XX/9FXX and a command
+    without data is repeated with the Le from 6CXX. Returns (data, sw1, sw2)
+    for each APDU, up to the first error if stopOnError is set.
+    """
+    responses = []
+    for apdu in apdus:
+        apdu = list(apdu)
+        data, sw1, sw2 = transmit(apdu)
+        if sw1 == types_g.sw1.REPEAT_COMMAND_WITH_LE and len(apdu) <= 5:
+            apdu = apdu[0:4] + [sw2]
+            data, sw1, sw2 = transmit(apdu)
+        data = list(data)
+        while sw1 in [types_g.sw1.RESPONSE_DATA_AVAILABLE_2G,
+                      types_g.sw1.RESPONSE_DATA_AVAILABLE_3G]:
+            #GET_RESPONSE
+            moreData, sw1, sw2 = transmit([apdu[0], 0xC0, 0x00, 0x00, sw2])
+            data.extend(moreData)
+        responses.append((data, sw1, sw2))
+        if stopOnError and not swNoError([sw1, sw2]):
+            break
+    return responses
+
 def packSw(sw1, sw2):
     return (sw1<<8) + sw2
 